@@ -3,7 +3,7 @@
 
 import numpy as np
 
-from . import periods
+from . import holders, periods
 
 
 def permanent_default_value(formula, simulation, period, *extra_params):
@@ -24,7 +24,11 @@ def requested_period_added_value(formula, simulation, period, *extra_params):
     period_unit = period.unit
     if holder._array_by_period is not None and (period_size > 1 or period_unit == u'year'):
         after_instant = period.start.offset(period_size, period_unit)
-        if period_size > 1:
+        if period_size > 1 and period_unit == u'month':
+            array = holder.sum_known_months(period.start, period_size, dtype = column.dtype)
+            if array is not None:
+                return period, array
+        elif period_size > 1:
             array = formula.zeros(dtype = column.dtype)
             sub_period = period.start.period(period_unit)
             while sub_period.start < after_instant:
@@ -37,15 +41,7 @@ def requested_period_added_value(formula, simulation, period, *extra_params):
             if array is not None:
                 return period, array
         if period_unit == u'year':
-            array = formula.zeros(dtype = column.dtype)
-            month = period.start.period(u'month')
-            while month.start < after_instant:
-                month_array = holder._array_by_period.get(month)
-                if month_array is None:
-                    array = None
-                    break
-                array += month_array
-                month = month.offset(1)
+            array = holder.sum_known_months(period.start, 12 * period_size, dtype = column.dtype)
             if array is not None:
                 return period, array
     if formula.function is not None:
@@ -78,14 +74,14 @@ def requested_period_last_value(formula, simulation, period, *extra_params, **kw
     # It returns the latest known value for the requested period.
     accept_future_value = kwargs.pop('accept_future_value', False)
     holder = formula.holder
-    if holder._array_by_period is not None:
-        known_values = sorted(holder._array_by_period.iteritems(), reverse = True)
-        for last_period, last_array in known_values:
-            if last_period.start <= period.start and (formula.function is None or last_period.stop >= period.stop):
-                return period, last_array
+    array_by_period = holder._array_by_period
+    if array_by_period:
+        last_item = get_last_known_item(array_by_period, period, cover_stop = formula.function is not None)
+        if last_item is not None:
+            return period, last_item[1]
         if accept_future_value:
-            next_period, next_array = known_values[-1]
-            return period, last_array
+            next_period = min(array_by_period)
+            return period, array_by_period[next_period]
     if formula.function is not None:
         return formula.function(simulation, period, *extra_params)
     column = holder.column
@@ -100,14 +96,29 @@ def requested_period_last_or_next_value(formula, simulation, period, *extra_para
     return requested_period_last_value(formula, simulation, period, *extra_params, accept_future_value = True)
 
 
+def get_last_known_item(array_by_period, period, cover_stop = False):
+    """Return the last known (period, array) starting before the requested period, or None.
+
+    When cover_stop is True, the known period must also end after the requested period.
+    """
+    if isinstance(array_by_period, holders.PeriodArrayStore):
+        return array_by_period.get_last_item(period, cover_stop = cover_stop)
+    for last_period, last_array in sorted(array_by_period.iteritems(), reverse = True):
+        if last_period.start <= period.start and (not cover_stop or last_period.stop >= period.stop):
+            return last_period, last_array
+    return None
+
+
 def last_duration_last_value(formula, simulation, period, *extra_params):
     # This formula is used for variables that are constants between events but are period size dependent.
     # It returns the latest known value for the requested start of period but with the last period size.
     holder = formula.holder
-    if holder._array_by_period is not None:
-        for last_period, last_array in sorted(holder._array_by_period.iteritems(), reverse = True):
-            if last_period.start <= period.start and (formula.function is None or last_period.stop >= period.stop):
-                return periods.Period((last_period[0], period.start, last_period[2])), last_array
+    array_by_period = holder._array_by_period
+    if array_by_period:
+        last_item = get_last_known_item(array_by_period, period, cover_stop = formula.function is not None)
+        if last_item is not None:
+            last_period, last_array = last_item
+            return periods.Period((last_period[0], period.start, last_period[2])), last_array
     if formula.function is not None:
         return formula.function(simulation, period, *extra_params)
     column = holder.column
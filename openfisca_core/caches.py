@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+
+
+"""Bound the memory used by the arrays cached in the holders of a simulation."""
+
+
+import collections
+
+
+class CacheBudget(object):
+    """A byte budget for the arrays computed by the formulas of a simulation.
+
+    When the cached arrays exceed the budget, the least recently used ones are removed from their holder. They will be
+    computed again if they are requested later.
+    Input arrays (given through set_input, or put in the cache of a variable without formula) are pinned: they are
+    counted, but never evicted, because they can't be computed again.
+    """
+    bytes_count = 0  # Number of bytes of all the arrays in the budget, pinned or not
+    evictions_count = 0
+    max_bytes = None
+    pinning = 0  # When > 0, the arrays put in cache are pinned.
+
+    def __init__(self, max_bytes):
+        assert max_bytes >= 0, max_bytes
+        self.max_bytes = max_bytes
+        # The data structure of entry_by_key is: {(variable_name, period, extra_params): (holder, bytes_count)}
+        # The least recently used entries come first.
+        self.entry_by_key = collections.OrderedDict()
+        # Pinned entries are never evicted, so they are kept apart from the LRU order.
+        self.pinned_entry_by_key = {}
+
+    def add(self, holder, period, extra_params, array):
+        """Register an array put in the cache of a holder and evict old arrays if the budget is exceeded."""
+        key = (holder.column.name, period, tuple(extra_params) if extra_params else None)
+        # A pinned array stays pinned when it is replaced. The arrays of input variables are pinned however they are
+        # put in cache (for example by the array setter of the holder), because their default value would replace them.
+        pinned = self.pinning > 0 or key in self.pinned_entry_by_key or holder.column.is_input_variable()
+        self.remove(holder, period, extra_params)
+        array_bytes_count = getattr(array, 'nbytes', 0)
+        if pinned:
+            self.pinned_entry_by_key[key] = (holder, array_bytes_count)
+        else:
+            self.entry_by_key[key] = (holder, array_bytes_count)
+        self.bytes_count += array_bytes_count
+        self.evict(keep_key = key)
+
+    def clone(self, holder_by_name):
+        """Copy the budget for a cloned simulation, whose holders are given."""
+        new = self.__class__(self.max_bytes)
+        new.bytes_count = self.bytes_count
+        new.entry_by_key = collections.OrderedDict(
+            (key, (holder_by_name[key[0]], array_bytes_count))
+            for key, (holder, array_bytes_count) in self.entry_by_key.iteritems()
+            )
+        new.pinned_entry_by_key = {
+            key: (holder_by_name[key[0]], array_bytes_count)
+            for key, (holder, array_bytes_count) in self.pinned_entry_by_key.iteritems()
+            }
+        return new
+
+    def evict(self, keep_key = None):
+        """Remove the least recently used (and not pinned) arrays from their holder, until the budget is respected."""
+        entry_by_key = self.entry_by_key
+        while self.bytes_count > self.max_bytes and entry_by_key:
+            key, (holder, array_bytes_count) = entry_by_key.popitem(last = False)
+            if key == keep_key:
+                # Never evict the array that has just been added: its dated holder is about to be read.
+                entry_by_key[key] = (holder, array_bytes_count)
+                if len(entry_by_key) == 1:
+                    break
+                continue
+            variable_name, period, extra_params = key
+            holder.delete_array(period, extra_params)
+            self.bytes_count -= array_bytes_count
+            self.evictions_count += 1
+
+    def remove(self, holder, period, extra_params = None):
+        """Forget an array removed from the cache of a holder."""
+        key = (holder.column.name, period, tuple(extra_params) if extra_params else None)
+        entry = self.entry_by_key.pop(key, None) or self.pinned_entry_by_key.pop(key, None)
+        if entry is not None:
+            self.bytes_count -= entry[1]
+
+    def touch(self, holder, period, extra_params = None):
+        """Mark an array as the most recently used one."""
+        key = (holder.column.name, period, tuple(extra_params) if extra_params else None)
+        entry = self.entry_by_key.pop(key, None)
+        if entry is not None:
+            self.entry_by_key[key] = entry
+
+
+class DependenciesRecorder(object):
+    """Record which formula calls use each variable while a simulation is calculated.
+
+    A formula call is identified by its key: (variable name, requested period).
+    """
+
+    def __init__(self):
+        # The data structure of consumer_keys_by_variable_name is: {variable_name: set([formula_key1, formula_key2])}
+        self.consumer_keys_by_variable_name = {}
+        self.formula_keys_stack = []
+
+    def clone(self, simulation):
+        new = self.__class__()
+        new.consumer_keys_by_variable_name = self.consumer_keys_by_variable_name
+        return new
+
+    def enter(self, variable_name, period):
+        self.formula_keys_stack.append((variable_name, period))
+
+    def exit(self, variable_name, period, computed = True):
+        self.formula_keys_stack.pop()
+
+    def use(self, variable_name):
+        formula_keys_stack = self.formula_keys_stack
+        if formula_keys_stack:
+            self.consumer_keys_by_variable_name.setdefault(variable_name, set()).add(formula_keys_stack[-1])
+
+
+class EvaluationPlanRecorder(object):
+    """Record the formula calls of a simulation in the order they end, which is a topological order of their
+    dependencies.
+
+    Formula calls where cycles are allowed (by max_nb_cycles), with all the formula calls they do, and calls of
+    formulas with extra parameters are not recorded: they are done recursively, by the recorded formulas using them.
+    Formula calls which raise an error are not recorded either.
+    """
+    simulation = None
+
+    def __init__(self, simulation):
+        self.simulation = simulation
+        self.formula_keys = []
+        self.in_cycle_stack = []  # For each running formula call, True when it may be part of a cycle
+
+    def clone(self, simulation):
+        return self.__class__(simulation)
+
+    def enter(self, variable_name, period):
+        in_cycle_stack = self.in_cycle_stack
+        in_cycle = self.simulation.max_nb_cycles is not None or bool(in_cycle_stack) and in_cycle_stack[-1]
+        in_cycle_stack.append(in_cycle)
+
+    def exit(self, variable_name, period, computed = True):
+        in_cycle = self.in_cycle_stack.pop()
+        if computed and not in_cycle and not self.simulation.holder_by_name[variable_name].formula.has_extra_params():
+            self.formula_keys.append((variable_name, period))
+
+    def use(self, variable_name):
+        pass
+
+
+class ParametersRecorder(DependenciesRecorder):
+    """Record, like DependenciesRecorder, which formula calls use each variable, and also which parameters each formula
+    call reads through Simulation.legislation_at().
+
+    Used by Simulation.invalidate_parameters(), to delete only the arrays calculated from changed parameters.
+    """
+
+    def __init__(self):
+        super(ParametersRecorder, self).__init__()
+        # The data structure of parameters_name_by_formula_key is: {formula_key: set of dotted parameter names}
+        self.parameters_name_by_formula_key = {}
+
+    def clone(self, simulation):
+        new = super(ParametersRecorder, self).clone(simulation)
+        # Copy the records, so that the formula calls of the clone don't change the records of this simulation.
+        new.consumer_keys_by_variable_name = {
+            variable_name: consumer_keys.copy()
+            for variable_name, consumer_keys in self.consumer_keys_by_variable_name.iteritems()
+            }
+        new.parameters_name_by_formula_key = {
+            formula_key: parameters_name.copy()
+            for formula_key, parameters_name in self.parameters_name_by_formula_key.iteritems()
+            }
+        return new
+
+    def read(self, parameter_name):
+        formula_keys_stack = self.formula_keys_stack
+        if formula_keys_stack:
+            self.parameters_name_by_formula_key.setdefault(formula_keys_stack[-1], set()).add(parameter_name)
+
+
+class ArraysReleaser(object):
+    """Free the arrays of the intermediate variables of a simulation, once all the formulas using them have run.
+
+    The formulas using each variable come from a DependenciesRecorder (for example used on a smaller simulation).
+    Output variables, variables without formula and variables with input arrays are never freed. When a freed variable
+    is requested again (for example because its consumers differ from the recorded ones), it is computed again.
+    """
+    released_count = 0
+    simulation = None
+
+    def __init__(self, simulation, consumer_keys_by_variable_name, output_variables_name):
+        self.simulation = simulation
+        self.consumer_keys_by_variable_name = consumer_keys_by_variable_name
+        self.output_variables_name = set(output_variables_name)
+        self.remaining_consumer_keys_by_variable_name = {
+            variable_name: set(consumer_keys)
+            for variable_name, consumer_keys in consumer_keys_by_variable_name.iteritems()
+            }
+        self.used_variables_name_by_consumer_key = used_variables_name_by_consumer_key = {}
+        for variable_name, consumer_keys in consumer_keys_by_variable_name.iteritems():
+            for consumer_key in consumer_keys:
+                used_variables_name_by_consumer_key.setdefault(consumer_key, set()).add(variable_name)
+
+    def clone(self, simulation):
+        new = self.__class__(simulation, self.consumer_keys_by_variable_name, self.output_variables_name)
+        new.remaining_consumer_keys_by_variable_name = {
+            variable_name: consumer_keys.copy()
+            for variable_name, consumer_keys in self.remaining_consumer_keys_by_variable_name.iteritems()
+            }
+        return new
+
+    def enter(self, variable_name, period):
+        pass
+
+    def exit(self, variable_name, period, computed = True):
+        consumer_key = (variable_name, period)
+        used_variables_name = self.used_variables_name_by_consumer_key.get(consumer_key)
+        if used_variables_name is None:
+            return
+        remaining_consumer_keys_by_variable_name = self.remaining_consumer_keys_by_variable_name
+        for used_variable_name in used_variables_name:
+            remaining_consumer_keys = remaining_consumer_keys_by_variable_name[used_variable_name]
+            remaining_consumer_keys.discard(consumer_key)
+            if not remaining_consumer_keys:
+                self.release(used_variable_name)
+
+    def release(self, variable_name):
+        simulation = self.simulation
+        if variable_name in self.output_variables_name or variable_name in simulation.input_variables_name:
+            return
+        holder = simulation.holder_by_name.get(variable_name)
+        if holder is None or holder.column.is_permanent or holder.column.is_input_variable() \
+                or holder._array_by_period is None:
+            return
+        holder.delete_arrays()
+        self.released_count += 1
+
+    def use(self, variable_name):
+        pass
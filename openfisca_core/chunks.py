@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+
+
+"""Run a simulation over chunks of its population, to bound the memory used by big scenarios."""
+
+
+from __future__ import division
+
+import collections
+import ctypes
+import multiprocessing
+
+import numpy as np
+
+
+# State of the calculation shared with the worker processes of calculate_in_processes. The workers are forked, so they
+# inherit it without pickling: input arrays are shared copy-on-write and output arrays live in shared memory.
+process_context = None
+
+
+def calculate(scenario, variables_name, entity_key_plural, chunk_size, period = None, **new_simulation_kwargs):
+    """Calculate variables chunk by chunk and return a dict {variable_name: array} for the whole population.
+
+    See iter_chunks() for the meaning of entity_key_plural and chunk_size.
+    The values of the entities without members (which belong to no chunk) are the default values of the variables.
+    """
+    tax_benefit_system = scenario.tax_benefit_system
+    count_by_entity_key_plural = get_count_by_entity_key_plural(scenario)
+    array_by_variable_name = collections.OrderedDict()
+    for variable_name in variables_name:
+        column = tax_benefit_system.get_column(variable_name)
+        array = np.empty(count_by_entity_key_plural[column.entity_key_plural], dtype = column.dtype)
+        array.fill(column.default)
+        array_by_variable_name[variable_name] = array
+    for chunk_array_by_variable_name, positions_by_entity_key_plural in iter_calculate(scenario, variables_name,
+            entity_key_plural, chunk_size, period = period, **new_simulation_kwargs):
+        for variable_name, chunk_array in chunk_array_by_variable_name.iteritems():
+            column = tax_benefit_system.get_column(variable_name)
+            array_by_variable_name[variable_name][positions_by_entity_key_plural[column.entity_key_plural]] = \
+                chunk_array
+    return array_by_variable_name
+
+
+def calculate_chunk_in_process(chunk_index):
+    """Calculate a chunk in a worker process of calculate_in_processes."""
+    context = process_context
+    scenario = context['scenario']
+    tax_benefit_system = scenario.tax_benefit_system
+    positions_by_entity_key_plural = context['chunks_positions'][chunk_index]
+    chunk_scenario = tax_benefit_system.new_scenario()
+    chunk_scenario.period = scenario.period
+    chunk_scenario.input_variables = get_chunk_input_variables(scenario, context['index_array_by_entity_key_plural'],
+        positions_by_entity_key_plural)
+    simulation = chunk_scenario.new_simulation(**context['new_simulation_kwargs'])
+    # Arrays which can't be stored in shared memory are sent back to the main process.
+    returned_array_by_variable_name = {}
+    for variable_name in context['variables_name']:
+        array = simulation.calculate(variable_name, period = context['period'])
+        shared_array = context['shared_array_by_variable_name'].get(variable_name)
+        if shared_array is None:
+            returned_array_by_variable_name[variable_name] = array
+        else:
+            column = tax_benefit_system.get_column(variable_name)
+            shared_array[positions_by_entity_key_plural[column.entity_key_plural]] = array
+    return chunk_index, returned_array_by_variable_name
+
+
+def calculate_in_processes(scenario, variables_name, entity_key_plural, chunk_size, processes = None, period = None,
+        **new_simulation_kwargs):
+    """Like calculate(), but calculate the chunks in a pool of processes.
+
+    Works only where processes are forked (Unix). The result arrays are allocated in shared memory (except for object
+    arrays) and filled directly by the worker processes.
+    """
+    global process_context
+    assert process_context is None, 'calculate_in_processes is not reentrant'
+    tax_benefit_system = scenario.tax_benefit_system
+    count_by_entity_key_plural = get_count_by_entity_key_plural(scenario)
+    persons_count = count_by_entity_key_plural[get_persons_key_plural(tax_benefit_system)]
+    array_by_variable_name = collections.OrderedDict()
+    shared_array_by_variable_name = {}
+    for variable_name in variables_name:
+        column = tax_benefit_system.get_column(variable_name)
+        count = count_by_entity_key_plural[column.entity_key_plural]
+        dtype = np.dtype(column.dtype)
+        if dtype.hasobject:
+            array = np.empty(count, dtype = dtype)
+        else:
+            shared_buffer = multiprocessing.RawArray(ctypes.c_char, max(count * dtype.itemsize, 1))
+            array = shared_array_by_variable_name[variable_name] = np.frombuffer(shared_buffer, dtype = dtype,
+                count = count)
+        array.fill(column.default)
+        array_by_variable_name[variable_name] = array
+    chunks_positions = list(iter_chunks_positions(scenario, entity_key_plural, chunk_size))
+    process_context = dict(
+        chunks_positions = chunks_positions,
+        index_array_by_entity_key_plural = get_index_array_by_entity_key_plural(scenario, persons_count),
+        new_simulation_kwargs = new_simulation_kwargs,
+        period = period,
+        scenario = scenario,
+        shared_array_by_variable_name = shared_array_by_variable_name,
+        variables_name = variables_name,
+        )
+    try:
+        pool = multiprocessing.Pool(processes = processes)
+    finally:
+        process_context = None
+    try:
+        for chunk_index, returned_array_by_variable_name in pool.imap_unordered(calculate_chunk_in_process,
+                xrange(len(chunks_positions))):
+            for variable_name, array in returned_array_by_variable_name.iteritems():
+                column = tax_benefit_system.get_column(variable_name)
+                array_by_variable_name[variable_name][
+                    chunks_positions[chunk_index][column.entity_key_plural]] = array
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return array_by_variable_name
+
+
+def get_chunk_input_variables(scenario, index_array_by_entity_key_plural, positions_by_entity_key_plural):
+    """Return the input variables of a chunk, given the positions of its entities in the whole population."""
+    tax_benefit_system = scenario.tax_benefit_system
+    persons_positions = positions_by_entity_key_plural[get_persons_key_plural(tax_benefit_system)]
+    input_variables = {}
+    for variable_name, array_by_period in scenario.input_variables.iteritems():
+        positions = positions_by_entity_key_plural[tax_benefit_system.get_column(variable_name).entity_key_plural]
+        input_variables[variable_name] = {
+            variable_period: np.asarray(array)[positions]
+            for variable_period, array in array_by_period.iteritems()
+            }
+    # Renumber the entities of the chunk.
+    for entity_key_plural, index_array in index_array_by_entity_key_plural.iteritems():
+        index_variable_name = tax_benefit_system.entity_class_by_key_plural[entity_key_plural] \
+            .index_for_person_variable_name
+        chunk_index_array = np.searchsorted(positions_by_entity_key_plural[entity_key_plural],
+            index_array[persons_positions]).astype(tax_benefit_system.get_column(index_variable_name).dtype)
+        array_by_period = scenario.input_variables.get(index_variable_name)
+        input_variables[index_variable_name] = {
+            variable_period: chunk_index_array
+            for variable_period in (array_by_period or {scenario.period: None})
+            }
+    return input_variables
+
+
+def get_count_by_entity_key_plural(scenario):
+    """Return the number of members of each entity of a scenario defined by input variables."""
+    tax_benefit_system = scenario.tax_benefit_system
+    count_by_entity_key_plural = {}
+    for variable_name, array_by_period in scenario.input_variables.iteritems():
+        entity_key_plural = tax_benefit_system.get_column(variable_name).entity_key_plural
+        for array in array_by_period.itervalues():
+            count_by_entity_key_plural[entity_key_plural] = len(array)
+    persons_key_plural = get_persons_key_plural(tax_benefit_system)
+    persons_count = count_by_entity_key_plural.setdefault(persons_key_plural, 1)
+    for entity_key_plural, index_array in get_index_array_by_entity_key_plural(scenario, persons_count).iteritems():
+        count_by_entity_key_plural.setdefault(entity_key_plural, index_array.max() + 1 if len(index_array) else 0)
+    return count_by_entity_key_plural
+
+
+def get_index_array_by_entity_key_plural(scenario, persons_count):
+    """Return the index array of each group entity, like fill_simulation builds it for input variables."""
+    tax_benefit_system = scenario.tax_benefit_system
+    index_array_by_entity_key_plural = {}
+    for entity_key_plural, entity_class in tax_benefit_system.entity_class_by_key_plural.iteritems():
+        if entity_class.is_persons_entity:
+            continue
+        array_by_period = scenario.input_variables.get(entity_class.index_for_person_variable_name)
+        index_array_by_entity_key_plural[entity_key_plural] = np.asarray(array_by_period.values()[0]) \
+            if array_by_period \
+            else np.arange(persons_count)
+    return index_array_by_entity_key_plural
+
+
+def get_persons_key_plural(tax_benefit_system):
+    for entity_key_plural, entity_class in tax_benefit_system.entity_class_by_key_plural.iteritems():
+        if entity_class.is_persons_entity:
+            return entity_key_plural
+    raise Exception('Tax-benefit system has no persons entity')
+
+
+def iter_calculate(scenario, variables_name, entity_key_plural, chunk_size, period = None, **new_simulation_kwargs):
+    """Calculate variables chunk by chunk.
+
+    Yield the couple (array_by_variable_name, positions_by_entity_key_plural) of each chunk.
+    """
+    for simulation, positions_by_entity_key_plural in iter_simulations(scenario, entity_key_plural, chunk_size,
+            **new_simulation_kwargs):
+        array_by_variable_name = collections.OrderedDict(
+            (variable_name, simulation.calculate(variable_name, period = period))
+            for variable_name in variables_name
+            )
+        yield array_by_variable_name, positions_by_entity_key_plural
+
+
+def iter_chunks(scenario, entity_key_plural, chunk_size):
+    """Split the input variables of a scenario into chunks of chunk_size members of an entity.
+
+    Every member of the other entities must belong to the same chunk: the other entities must be nested in the
+    chunk entity (for example individuals and families in households).
+    Yield the couple (input_variables, positions_by_entity_key_plural) of each chunk, where positions are the indexes
+    of the entities of the chunk in the whole population.
+    """
+    persons_count = get_count_by_entity_key_plural(scenario)[get_persons_key_plural(scenario.tax_benefit_system)]
+    index_array_by_entity_key_plural = get_index_array_by_entity_key_plural(scenario, persons_count)
+    for positions_by_entity_key_plural in iter_chunks_positions(scenario, entity_key_plural, chunk_size):
+        yield (
+            get_chunk_input_variables(scenario, index_array_by_entity_key_plural, positions_by_entity_key_plural),
+            positions_by_entity_key_plural,
+            )
+
+
+def iter_chunks_positions(scenario, entity_key_plural, chunk_size):
+    """Yield the positions of the members of each entity, for each chunk of a scenario.
+
+    See iter_chunks().
+    """
+    assert scenario.test_case is None and scenario.input_variables is not None, \
+        'Only scenarios with input_variables can be split in chunks'
+    assert chunk_size > 0, chunk_size
+    tax_benefit_system = scenario.tax_benefit_system
+    count_by_entity_key_plural = get_count_by_entity_key_plural(scenario)
+    persons_key_plural = get_persons_key_plural(tax_benefit_system)
+    persons_count = count_by_entity_key_plural[persons_key_plural]
+    index_array_by_entity_key_plural = get_index_array_by_entity_key_plural(scenario, persons_count)
+
+    if entity_key_plural == persons_key_plural:
+        persons_chunk_index = np.arange(persons_count) // chunk_size
+    else:
+        persons_chunk_index = index_array_by_entity_key_plural[entity_key_plural] // chunk_size
+    chunks_count = persons_chunk_index.max() + 1 if persons_count else 0
+
+    # Chunk of each member of each entity (chunks_count for the members without persons)
+    chunk_index_by_entity_key_plural = {persons_key_plural: persons_chunk_index}
+    for group_key_plural, index_array in index_array_by_entity_key_plural.iteritems():
+        first_chunk_index = np.empty(count_by_entity_key_plural[group_key_plural], dtype = persons_chunk_index.dtype)
+        first_chunk_index.fill(chunks_count)
+        np.minimum.at(first_chunk_index, index_array, persons_chunk_index)
+        last_chunk_index = np.zeros_like(first_chunk_index)
+        np.maximum.at(last_chunk_index, index_array, persons_chunk_index)
+        assert ((first_chunk_index == last_chunk_index) | (first_chunk_index == chunks_count)).all(), \
+            'Entity {} is not nested in entity {}'.format(group_key_plural, entity_key_plural)
+        chunk_index_by_entity_key_plural[group_key_plural] = first_chunk_index
+
+    # Positions of the members of each entity, sorted by chunk
+    sorted_positions_by_entity_key_plural = {}
+    chunk_offsets_by_entity_key_plural = {}
+    for group_key_plural, chunk_index in chunk_index_by_entity_key_plural.iteritems():
+        sorted_positions_by_entity_key_plural[group_key_plural] = np.argsort(chunk_index, kind = 'mergesort')
+        chunk_offsets_by_entity_key_plural[group_key_plural] = np.concatenate((
+            [0],
+            np.cumsum(np.bincount(chunk_index, minlength = chunks_count + 1)[:chunks_count]),
+            ))
+
+    for chunk_index in xrange(chunks_count):
+        positions_by_entity_key_plural = {
+            group_key_plural: sorted_positions[
+                chunk_offsets_by_entity_key_plural[group_key_plural][chunk_index]:
+                chunk_offsets_by_entity_key_plural[group_key_plural][chunk_index + 1]
+                ]
+            for group_key_plural, sorted_positions in sorted_positions_by_entity_key_plural.iteritems()
+            }
+        if len(positions_by_entity_key_plural[persons_key_plural]) == 0:
+            continue
+        yield positions_by_entity_key_plural
+
+
+def iter_simulations(scenario, entity_key_plural, chunk_size, **new_simulation_kwargs):
+    """Yield the couple (simulation, positions_by_entity_key_plural) of each chunk of a scenario.
+
+    See iter_chunks().
+    """
+    tax_benefit_system = scenario.tax_benefit_system
+    for input_variables, positions_by_entity_key_plural in iter_chunks(scenario, entity_key_plural, chunk_size):
+        chunk_scenario = tax_benefit_system.new_scenario()
+        chunk_scenario.period = scenario.period
+        chunk_scenario.input_variables = input_variables
+        yield chunk_scenario.new_simulation(**new_simulation_kwargs), positions_by_entity_key_plural
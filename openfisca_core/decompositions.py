@@ -11,6 +11,25 @@ from . import conv, decompositionsxml, legislations
 
 def calculate(simulations, decomposition_json):
     response_json = copy.deepcopy(decomposition_json)  # Use decomposition as a skeleton for response.
+    leaves_code = []
+    for node in iter_decomposition_nodes(response_json):
+        if not node.get('children') and node['code'] not in leaves_code:
+            leaves_code.append(node['code'])
+    # Calculate all the leaves of the decomposition in a single pass over each simulation.
+    values_by_code = {}
+    for simulation_index, simulation in enumerate(simulations):
+        for code in leaves_code:
+            try:
+                simulation.calculate_output(code)
+            except legislations.ParameterNotFound as exc:
+                exc.simulation_index = simulation_index
+                raise
+            holder = simulation.get_holder(code)
+            column = holder.column
+            values_by_code.setdefault(code, []).extend(
+                column.transform_value_to_json(value)
+                for value in holder.new_test_case_array(simulation.period).tolist()
+                )
     for node in iter_decomposition_nodes(response_json, children_first = True):
         children = node.get('children')
         if children:
@@ -19,19 +38,7 @@ def calculate(simulations, decomposition_json):
                 for child in children
                 ))
         else:
-            node['values'] = values = []
-            for simulation_index, simulation in enumerate(simulations):
-                try:
-                    simulation.calculate_output(node['code'])
-                except legislations.ParameterNotFound as exc:
-                    exc.simulation_index = simulation_index
-                    raise
-                holder = simulation.get_holder(node['code'])
-                column = holder.column
-                values.extend(
-                    column.transform_value_to_json(value)
-                    for value in holder.new_test_case_array(simulation.period).tolist()
-                    )
+            node['values'] = list(values_by_code.get(node['code'], []))
     return response_json
 
 
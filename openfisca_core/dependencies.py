@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+
+
+"""Find the variables and the parameters used by the formulas, by parsing their source code.
+
+The dependencies are found without running any simulation, so they are limited to what the source code of the formula
+functions shows:
+  * a variable is found when its name is a literal string given to simulation.calculate() (or to a similar method);
+  * a parameter is found when it is reached by attributes of simulation.legislation_at(...), directly or through
+    local variables. A node given to a function, iterated or read with a computed key is used as a whole.
+When a formula calls one of these methods with a computed variable name, its input variables are unknown (None).
+When it uses the simulation in any other way than calling one of these methods or reading simulation.period (for
+example giving it to another function, putting it in a container or taking one of its methods), its input variables
+and its parameters are unknown. When it uses the whole legislation in any other way than reading its attributes, its
+parameters are unknown.
+"""
+
+
+import ast
+import inspect
+import textwrap
+
+from .formulas import AbstractEntityToEntity, DatedFormula, SimpleFormula
+
+
+# Names of the simulation methods whose first argument is the name of a variable
+VARIABLE_METHODS_NAME = frozenset([
+    'calculate',
+    'calculate_add',
+    'calculate_add_divide',
+    'calculate_divide',
+    'compute',
+    'compute_add',
+    'compute_add_divide',
+    'compute_divide',
+    'get_array',
+    'get_holder',
+    'get_or_new_holder',
+    ])
+# Names of all the simulation methods that can be called by a formula without hiding its dependencies
+SIMULATION_METHODS_NAME = VARIABLE_METHODS_NAME | frozenset(['legislation_at'])
+# Names of the simulation attributes that can be read by a formula
+SIMULATION_ATTRIBUTES_NAME = frozenset(['period'])
+
+
+class FunctionDependenciesVisitor(ast.NodeVisitor):
+    """Collect the names of the variables and the paths of the parameters used by the AST of a function.
+
+    A legislation node is used where the chain of attributes (or of literal keys) reaching it ends: the nodes of the
+    chain before it are not recorded.
+    """
+    simulation_name = None  # Name of the simulation argument of the function
+
+    def __init__(self):
+        self.parameter_path_by_name = {}  # Local variables containing a node of the legislation
+        self.parameters_path = set()  # None when the parameters are unknown
+        self.parent_by_node = {}
+        self.variables_name = set()  # None when the input variables are unknown
+
+    def add_parameter_path(self, path):
+        """Add the path of a used legislation node. The empty path, of the whole legislation, is unknown."""
+        if path is None or self.parameters_path is None:
+            return
+        if path:
+            self.parameters_path.add(path)
+        else:
+            self.parameters_path = None
+
+    def get_parameter_path(self, node):
+        """Return the path (a tuple of names) of the legislation node given by an expression, or None."""
+        if isinstance(node, ast.Call):
+            if self.is_simulation_method_call(node, 'legislation_at'):
+                return ()
+            return None
+        if isinstance(node, ast.Attribute):
+            if self.is_called(node):
+                # A method of a legislation node (like tax_scale.calc) is not a legislation node.
+                return None
+            path = self.get_parameter_path(node.value)
+            return None if path is None else path + (node.attr,)
+        if isinstance(node, ast.Name):
+            return self.parameter_path_by_name.get(node.id)
+        if isinstance(node, ast.Subscript) and isinstance(node.slice, ast.Index) \
+                and isinstance(node.slice.value, ast.Str):
+            path = self.get_parameter_path(node.value)
+            return None if path is None else path + (node.slice.value.s,)
+        return None
+
+    def is_called(self, node):
+        parent = self.parent_by_node.get(node)
+        return isinstance(parent, ast.Call) and parent.func is node
+
+    def is_simulation_method_call(self, node, *methods_name):
+        func = node.func
+        return isinstance(func, ast.Attribute) and isinstance(func.value, ast.Name) \
+            and func.value.id == self.simulation_name and func.attr in methods_name
+
+    def record_parameter_use(self, node):
+        """Add the path of the legislation node given by an expression, unless the expression is only a step of a
+        longer chain, or is assigned to local variables (which are followed instead)."""
+        path = self.get_parameter_path(node)
+        if path is None:
+            return
+        parent = self.parent_by_node.get(node)
+        if isinstance(parent, (ast.Attribute, ast.Subscript)) and parent.value is node \
+                and self.get_parameter_path(parent) is not None:
+            return
+        if isinstance(parent, ast.Assign) and parent.value is node \
+                and all(isinstance(target, ast.Name) for target in parent.targets):
+            return
+        # Any other use (given to a function, put in a container, iterated, read with a computed key, etc) can read
+        # any parameter of the node.
+        self.add_parameter_path(path)
+
+    def set_unknown(self):
+        self.parameters_path = None
+        self.variables_name = None
+
+    def visit_Assign(self, node):
+        self.visit(node.value)
+        path = self.get_parameter_path(node.value)
+        for target in node.targets:
+            if isinstance(target, ast.Name):
+                if path is None:
+                    self.parameter_path_by_name.pop(target.id, None)
+                else:
+                    self.parameter_path_by_name[target.id] = path
+            self.visit(target)
+
+    def visit_Attribute(self, node):
+        self.record_parameter_use(node)
+        self.generic_visit(node)
+
+    def visit_Call(self, node):
+        self.record_parameter_use(node)
+        if self.is_simulation_method_call(node, *VARIABLE_METHODS_NAME) and self.variables_name is not None:
+            if node.args and isinstance(node.args[0], ast.Str):
+                self.variables_name.add(node.args[0].s)
+            else:
+                # The variable name is computed: the input variables of the function are unknown.
+                self.variables_name = None
+        self.generic_visit(node)
+
+    def visit_FunctionDef(self, node):
+        if self.simulation_name is None and len(node.args.args) >= 2 and isinstance(node.args.args[1], ast.Name):
+            # The formula function is function(self, simulation, period).
+            self.simulation_name = node.args.args[1].id
+        self.generic_visit(node)
+
+    def visit_Module(self, node):
+        for parent in ast.walk(node):
+            for child in ast.iter_child_nodes(parent):
+                self.parent_by_node[child] = parent
+        self.generic_visit(node)
+
+    def visit_Name(self, node):
+        if node.id == self.simulation_name:
+            if isinstance(node.ctx, ast.Param):
+                return
+            parent = self.parent_by_node.get(node)
+            if isinstance(parent, ast.Attribute):
+                if parent.attr in SIMULATION_ATTRIBUTES_NAME:
+                    return
+                if parent.attr in SIMULATION_METHODS_NAME and self.is_called(parent):
+                    return
+            # The simulation is given to another function, put in a container, bound to another name, or one of its
+            # methods is taken: any variable and any parameter can be used.
+            self.set_unknown()
+        elif isinstance(node.ctx, ast.Load):
+            self.record_parameter_use(node)
+
+    def visit_Subscript(self, node):
+        self.record_parameter_use(node)
+        self.generic_visit(node)
+
+
+def get_formula_class_dependencies(formula_class):
+    """Return the couple (input variables name, parameters name) of a formula class.
+
+    Each of them is None when it can't be found statically. Parameters name are dotted paths of the nodes of
+    the legislation (for example u'ir.bareme').
+    """
+    if formula_class is None:
+        return frozenset(), frozenset()
+    if issubclass(formula_class, AbstractEntityToEntity):
+        return frozenset([formula_class.variable_name]), frozenset()
+    if issubclass(formula_class, DatedFormula):
+        functions = [
+            dated_formula_class['formula_class'].function
+            for dated_formula_class in formula_class.dated_formulas_class
+            ]
+    else:
+        assert issubclass(formula_class, SimpleFormula), formula_class
+        functions = [formula_class.function]
+    variables_name = set()
+    parameters_path = set()
+    for function in functions:
+        if function is None:
+            continue
+        function_variables_name, function_parameters_path = get_function_dependencies(function)
+        if function_variables_name is None:
+            variables_name = None
+        elif variables_name is not None:
+            variables_name.update(function_variables_name)
+        if function_parameters_path is None:
+            parameters_path = None
+        elif parameters_path is not None:
+            parameters_path.update(function_parameters_path)
+    parameters_name = None if parameters_path is None else frozenset(u'.'.join(path) for path in parameters_path)
+    return (None if variables_name is None else frozenset(variables_name)), parameters_name
+
+
+def get_function_dependencies(function):
+    """Return the couple (input variables name, parameters paths) of a formula function.
+
+    Both are None when the source code of the function can't be parsed.
+    """
+    function = getattr(function, '__func__', function)
+    try:
+        source = textwrap.dedent(inspect.getsource(function))
+        tree = ast.parse(source)
+    except (IOError, SyntaxError, TypeError):
+        return None, None
+    visitor = FunctionDependenciesVisitor()
+    visitor.visit(tree)
+    variables_name = visitor.variables_name
+    if variables_name is not None:
+        variables_name = set(
+            variable_name.decode('utf-8') if isinstance(variable_name, str) else variable_name
+            for variable_name in variables_name
+            )
+    return variables_name, visitor.parameters_path
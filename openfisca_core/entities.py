@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 
 
+import numpy as np
+
 from .tools import empty_clone
 
 
@@ -34,12 +36,7 @@ class AbstractEntity(object):
     def clone(self, simulation):
         """Copy the entity just enough to be able to run the simulation without modifying the original simulation."""
         new = empty_clone(self)
-        new_dict = new.__dict__
-
-        for key, value in self.__dict__.iteritems():
-            if key != 'simulation':
-                new_dict[key] = value
-
+        new.__dict__ = new_dict = self.__dict__.copy()
         new_dict['simulation'] = simulation
 
         return new
@@ -48,3 +45,97 @@ class AbstractEntity(object):
         assert not self.is_persons_entity
         raise NotImplementedError('Method "iter_member_persons_role_and_id" is not implemented for class {}'.format(
             self.__class__.__name__))
+
+
+class EntityMembership(object):
+    """Index of the persons belonging to each member of a (non-persons) entity.
+
+    It is built once from the index and role arrays of the persons and shared by every role-aware helper, instead of
+    rebuilding boolean filters on each call.
+    """
+    count = None  # Number of entity members
+    entity_index_array = None  # For each person, the index of its entity member
+    offsets = None  # Persons of member i are sorted_persons[offsets[i]:offsets[i + 1]]
+    role_array = None  # For each person, its role in its entity member
+    sorted_persons = None  # Persons positions sorted (stably) by entity member
+
+    def __init__(self, entity_index_array, role_array, count):
+        assert entity_index_array is not None
+        assert role_array is not None
+        self.count = count
+        self.entity_index_array = entity_index_array
+        self.role_array = role_array
+        self.sorted_persons, self.offsets = sort_by_entity_member(entity_index_array, count)
+        self._positions_by_role = {}
+
+    def aggregate(self, array, operation, default = 0, dtype = None, roles = None):
+        """Reduce a persons array to an entity array in a single pass, whatever the number of roles.
+
+        Supported operations are "add", "count" (number of persons with a non-zero value), "max", "min" and "or".
+        Entity members without any person get the default value with "max", "min" and "or", and 0 (an empty sum or
+        count) with "add" and "count".
+        When no roles are given, it means "all the roles".
+        """
+        count = self.count
+        entity_index_array = self.entity_index_array
+        sorted_persons = self.sorted_persons
+        offsets = self.offsets
+        if roles is not None:
+            persons_positions = np.sort(np.concatenate([
+                self.get_role_positions(role)[0]
+                for role in roles
+                ]))
+            array = array[persons_positions]
+            entity_index_array = entity_index_array[persons_positions]
+            sorted_persons, offsets = sort_by_entity_member(entity_index_array, count)
+
+        if operation == 'count':
+            return np.bincount(entity_index_array[np.flatnonzero(array)], minlength = count)
+        if dtype is None:
+            dtype = np.bool if operation == 'or' else array.dtype
+        if operation == 'add' and np.issubdtype(dtype, np.floating):
+            return np.bincount(entity_index_array, weights = array, minlength = count).astype(dtype)
+
+        ufunc = aggregation_ufunc_by_operation.get(operation)
+        assert ufunc is not None, 'Invalid aggregation operation {}'.format(operation)
+        target_array = np.empty(count, dtype = dtype)
+        target_array.fill(0 if operation == 'add' else default)
+        non_empty_members = offsets[1:] > offsets[:-1]
+        if non_empty_members.any():
+            target_array[non_empty_members] = ufunc.reduceat(
+                array[sorted_persons].astype(dtype, copy = False),
+                offsets[:-1][non_empty_members],
+                )
+        return target_array
+
+    def get_role_positions(self, role):
+        """Return the positions of the persons having the given role and the positions of their entity members."""
+        positions = self._positions_by_role.get(role)
+        if positions is None:
+            persons_positions = np.flatnonzero(self.role_array == role)
+            self._positions_by_role[role] = positions = (
+                persons_positions,
+                self.entity_index_array[persons_positions],
+                )
+        return positions
+
+    def is_up_to_date(self, entity_index_array, role_array, count):
+        return entity_index_array is self.entity_index_array and role_array is self.role_array and count == self.count
+
+
+aggregation_ufunc_by_operation = {
+    'add': np.add,
+    'max': np.maximum,
+    'min': np.minimum,
+    'or': np.logical_or,
+    }
+
+
+def sort_by_entity_member(entity_index_array, count):
+    """Return the persons positions sorted by entity member and the offsets of each member in this order."""
+    sorted_persons = np.argsort(entity_index_array, kind = 'mergesort')
+    offsets = np.concatenate((
+        [0],
+        np.cumsum(np.bincount(entity_index_array, minlength = count)),
+        ))
+    return sorted_persons, offsets
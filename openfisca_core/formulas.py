@@ -56,15 +56,10 @@ class AbstractFormula(object):
     def clone(self, holder, keys_to_skip = None):
         """Copy the formula just enough to be able to run a new simulation without modifying the original simulation."""
         new = empty_clone(self)
-        new_dict = new.__dict__
-
-        if keys_to_skip is None:
-            keys_to_skip = set()
-        keys_to_skip.add('holder')
-        for key, value in self.__dict__.iteritems():
-            if key not in keys_to_skip:
-                new_dict[key] = value
-
+        new.__dict__ = new_dict = self.__dict__.copy()
+        if keys_to_skip is not None:
+            for key in keys_to_skip:
+                new_dict.pop(key, None)
         new_dict['holder'] = holder
 
         return new
@@ -73,6 +68,10 @@ class AbstractFormula(object):
         '''Return a new NumPy array which length is the entity count, filled with default values.'''
         return self.zeros() + self.holder.column.default
 
+    def has_extra_params(self):
+        """Tell whether the formula function needs extra parameters, besides the simulation and the period."""
+        return False
+
     @property
     def real_formula(self):
         return self
@@ -119,39 +118,57 @@ class AbstractEntityToEntity(AbstractFormula):
                 variable_name = column.name,
                 ))
 
-        variable_holder = self.variable_holder
-        parameters["accept_other_period"] = True
-        variable_dated_holder = variable_holder.compute(period = period, **parameters)
-        output_period = variable_dated_holder.period
+        dependencies_tracker = simulation.dependencies_tracker
+        if dependencies_tracker is not None:
+            dependencies_tracker.enter(column.name, period)
+            dependencies_tracker.use(self.variable_name)
+        profiler = simulation.profiler
+        if profiler is not None:
+            profiler.enter(column.name, period)
 
-        array = self.transform(variable_dated_holder, roles = self.roles)
-        if array.dtype != column.dtype:
-            array = array.astype(column.dtype)
+        computed = False
+        try:
+            variable_holder = self.variable_holder
+            parameters["accept_other_period"] = True
+            variable_dated_holder = variable_holder.compute(period = period, **parameters)
+            output_period = variable_dated_holder.period
 
-        if debug or trace:
-            variable_infos = (column.name, output_period)
-            step = simulation.traceback.get(variable_infos)
-            if step is None:
-                simulation.traceback[variable_infos] = step = dict(
-                    holder = holder,
-                    )
-            step.update(simulation.stack_trace.pop())
-            input_variables_infos = step['input_variables_infos']
-            if not debug_all or trace:
-                step['default_input_variables'] = has_only_default_input_variables = all(
-                    np.all(input_holder.get_array(input_variable_period) == input_holder.column.default)
-                    for input_holder, input_variable_period in (
-                        (simulation.get_holder(input_variable_name), input_variable_period1)
-                        for input_variable_name, input_variable_period1 in input_variables_infos
-                        )
-                    )
-            step['is_computed'] = True
-            if debug and (debug_all or not has_only_default_input_variables):
-                log.info(u'<=> {}@{}<{}>({}) --> <{}>{}'.format(column.name, entity.key_plural, str(period),
-                    simulation.stringify_input_variables_infos(input_variables_infos), stringify_array(array),
-                    str(output_period)))
+            array = self.transform(variable_dated_holder, roles = self.roles)
+            if array.dtype != column.dtype:
+                array = array.astype(column.dtype)
 
-        return holder.put_in_cache(array, output_period)
+            if debug or trace:
+                variable_infos = (column.name, output_period)
+                step = simulation.traceback.get(variable_infos)
+                if step is None:
+                    simulation.traceback[variable_infos] = step = dict(
+                        holder = holder,
+                        )
+                step.update(simulation.stack_trace.pop())
+                input_variables_infos = step['input_variables_infos']
+                if not debug_all or trace:
+                    step['default_input_variables'] = has_only_default_input_variables = all(
+                        np.all(input_holder.get_array(input_variable_period) == input_holder.column.default)
+                        for input_holder, input_variable_period in (
+                            (simulation.get_holder(input_variable_name), input_variable_period1)
+                            for input_variable_name, input_variable_period1 in input_variables_infos
+                            )
+                        )
+                step['is_computed'] = True
+                if debug and (debug_all or not has_only_default_input_variables):
+                    log.info(u'<=> {}@{}<{}>({}) --> <{}>{}'.format(column.name, entity.key_plural, str(period),
+                        simulation.stringify_input_variables_infos(input_variables_infos), stringify_array(array),
+                        str(output_period)))
+
+            dated_holder = holder.put_in_cache(array, output_period)
+            computed = True
+            return dated_holder
+        finally:
+            if dependencies_tracker is not None:
+                dependencies_tracker.exit(column.name, period, computed = computed)
+            if profiler is not None:
+                # The array is given only when the formula call succeeded.
+                profiler.exit(column.name, period, array if computed else None)
 
     def graph_parameters(self, edges, get_input_variables_and_parameters, nodes, visited):
         """Recursively build a graph of formulas."""
@@ -283,6 +300,12 @@ class DatedFormula(AbstractGroupedFormula):
         for dated_formula in self.dated_formulas:
             dated_formula['formula'].graph_parameters(edges, get_input_variables_and_parameters, nodes, visited)
 
+    def has_extra_params(self):
+        return any(
+            dated_formula['formula'].has_extra_params()
+            for dated_formula in self.dated_formulas
+            )
+
     def to_json(self, get_input_variables_and_parameters = None, with_input_variables_details = False):
         return collections.OrderedDict((
             ('@type', u'DatedFormula'),
@@ -317,13 +340,13 @@ class EntityToPerson(AbstractEntityToEntity):
         array = dated_holder.array
         target_array = np.empty(persons.count, dtype = array.dtype)
         target_array.fill(dated_holder.column.default)
-        entity_index_array = persons.simulation.holder_by_name[entity.index_for_person_variable_name].array
+        membership = persons.simulation.get_entity_membership(entity)
         if roles is None:
             roles = range(entity.roles_count)
         for role in roles:
-            boolean_filter = persons.simulation.holder_by_name[entity.role_for_person_variable_name].array == role
+            persons_positions, members_positions = membership.get_role_positions(role)
             try:
-                target_array[boolean_filter] = array[entity_index_array[boolean_filter]]
+                target_array[persons_positions] = array[members_positions]
             except:
                 log.error(u'An error occurred while transforming array for role {}[{}] in function {}'.format(
                     entity.key_singular, role, holder.column.name))
@@ -349,31 +372,32 @@ class PersonToEntity(AbstractEntityToEntity):
 
         target_array = np.empty(entity.count, dtype = array.dtype)
         target_array.fill(dated_holder.column.default)
-        entity_index_array = persons.simulation.holder_by_name[entity.index_for_person_variable_name].array
+        membership = persons.simulation.get_entity_membership(entity)
         if roles is not None and len(roles) == 1:
             assert self.operation is None, 'Unexpected operation {} in formula {}'.format(self.operation,
                 holder.column.name)
             role = roles[0]
-            # TODO: Cache filter.
-            boolean_filter = persons.simulation.holder_by_name[entity.role_for_person_variable_name].array == role
+            persons_positions, members_positions = membership.get_role_positions(role)
             try:
-                target_array[entity_index_array[boolean_filter]] = array[boolean_filter]
+                target_array[members_positions] = array[persons_positions]
             except:
                 log.error(u'An error occurred while filtering array for role {}[{}] in function {}'.format(
                     entity.key_singular, role, holder.column.name))
                 raise
         else:
             operation = self.operation
-            assert operation in ('add', 'or'), 'Invalid operation {} in formula {}'.format(operation,
-                holder.column.name)
-            if roles is None:
-                roles = range(entity.roles_count)
-            target_array = self.zeros(dtype = np.bool if operation == 'or' else
-                array.dtype if array.dtype != np.bool else np.int16)
+            assert operation in ('add', 'count', 'max', 'min', 'or'), 'Invalid operation {} in formula {}'.format(
+                operation, holder.column.name)
+            dtype = np.bool if operation == 'or' else array.dtype if array.dtype != np.bool else np.int16
+            if roles is None or operation in ('count', 'max', 'min'):
+                # Like the sums by role, entities without members get 0, except for extrema.
+                return membership.aggregate(array, operation,
+                    default = dated_holder.column.default if operation in ('max', 'min') else 0,
+                    dtype = dtype, roles = roles)
+            target_array = self.zeros(dtype = dtype)
             for role in roles:
-                # TODO: Cache filters.
-                boolean_filter = persons.simulation.holder_by_name[entity.role_for_person_variable_name].array == role
-                target_array[entity_index_array[boolean_filter]] += array[boolean_filter]
+                persons_positions, members_positions = membership.get_role_positions(role)
+                target_array[members_positions] += array[persons_positions]
 
         return target_array
 
@@ -402,14 +426,13 @@ class SimpleFormula(AbstractFormula):
                 'utf-8')
             assert array.size == persons.count, u"Expected an array of size {}. Got: {}".format(persons.count,
                 array.size)
-        entity_index_array = persons.simulation.holder_by_name[entity.index_for_person_variable_name].array
+        membership = simulation.get_entity_membership(entity)
         if roles is None:
-            roles = range(entity.roles_count)
+            return membership.aggregate(array, 'or')
         target_array = self.zeros(dtype = np.bool)
         for role in roles:
-            # TODO Mettre les filtres en cache dans la simulation
-            boolean_filter = persons.simulation.holder_by_name[entity.role_for_person_variable_name].array == role
-            target_array[entity_index_array[boolean_filter]] += array[boolean_filter]
+            persons_positions, members_positions = membership.get_role_positions(role)
+            target_array[members_positions] += array[persons_positions]
         return target_array
 
     def cast_from_entity_to_role(self, array_or_dated_holder, default = None, entity = None, role = None):
@@ -451,13 +474,13 @@ class SimpleFormula(AbstractFormula):
         assert not entity.is_persons_entity
         target_array = np.empty(persons.count, dtype = array.dtype)
         target_array.fill(default)
-        entity_index_array = persons.simulation.holder_by_name[entity.index_for_person_variable_name].array
+        membership = simulation.get_entity_membership(entity)
         if roles is None:
             roles = range(entity.roles_count)
         for role in roles:
-            boolean_filter = persons.simulation.holder_by_name[entity.role_for_person_variable_name].array == role
+            persons_positions, members_positions = membership.get_role_positions(role)
             try:
-                target_array[boolean_filter] = array[entity_index_array[boolean_filter]]
+                target_array[persons_positions] = array[members_positions]
             except:
                 log.error(u'An error occurred while transforming array for role {}[{}] in function {}'.format(
                     entity.key_singular, role, holder.column.name))
@@ -465,52 +488,65 @@ class SimpleFormula(AbstractFormula):
         return target_array
 
     def check_for_cycle(self, period):
+        """Register the formula call as active, or raise a CycleError when it is not allowed by max_nb_cycles.
+
+        A pure circular definition (a formula calling itself for the same period) is an error in all cases.
         """
-        Return a boolean telling if the current variable has already been called without being allowed by
-        the parameter max_nb_cycles of the calculate method.
-        """
-        def get_error_message():
-            return u'Circular definition detected on formula {}<{}>. Formulas and periods involved: {}.'.format(
-                column.name,
-                period,
-                u', '.join(sorted(set(
-                    u'{}<{}>'.format(variable_name, period2)
-                    for variable_name, periods in requested_periods_by_variable_name.iteritems()
-                    for period2 in periods
-                    ))).encode('utf-8'),
-                )
-        simulation = self.holder.entity.simulation
-        requested_periods_by_variable_name = simulation.requested_periods_by_variable_name
-        column = self.holder.column
-        variable_name = column.name
-        if variable_name in requested_periods_by_variable_name:
-            # Make sure the formula doesn't call itself for the same period it is being called for.
-            # It would be a pure circular definition.
-            requested_periods = requested_periods_by_variable_name[variable_name]
-            assert period not in requested_periods and not column.is_permanent, get_error_message()
-            if simulation.max_nb_cycles is None or len(requested_periods) > simulation.max_nb_cycles:
-                message = get_error_message()
-                if simulation.max_nb_cycles is None:
-                    message += ' Hint: use "max_nb_cycles = 0" to get a default value, or "= N" to allow N cycles.'
-                raise CycleError(message)
-            else:
-                requested_periods.append(period)
+        holder = self.holder
+        variable_name = holder.column.name
+        cycle_detection_state = holder.entity.simulation.cycle_detection_state
+        depth_by_variable_name = cycle_detection_state.depth_by_variable_name
+        if variable_name in depth_by_variable_name:
+            self.check_for_nested_cycle(period)
         else:
-            requested_periods_by_variable_name[variable_name] = [period]
+            depth_by_variable_name[variable_name] = 1
+        cycle_detection_state.active_formula_keys.add((variable_name, period))
 
-    def clean_cycle_detection_data(self):
-        """
-        When the value of a formula have been computed, remove the period from
-        requested_periods_by_variable_name[variable_name] and delete the latter if empty.
+    def check_for_nested_cycle(self, period):
+        """Count a formula call made while other calls of the same variable are running (see check_for_cycle)."""
+        holder = self.holder
+        variable_name = holder.column.name
+        simulation = holder.entity.simulation
+        cycle_detection_state = simulation.cycle_detection_state
+        # Make sure the formula doesn't call itself for the same period it is being called for.
+        # It would be a pure circular definition.
+        assert (variable_name, period) not in cycle_detection_state.active_formula_keys \
+            and not holder.column.is_permanent, self.get_cycle_error_message(period)
+        depth = cycle_detection_state.depth_by_variable_name[variable_name]
+        max_nb_cycles = cycle_detection_state.max_nb_cycles
+        if max_nb_cycles is None or depth > max_nb_cycles:
+            simulation.cycles_count += 1
+            message = self.get_cycle_error_message(period)
+            if max_nb_cycles is None:
+                message += ' Hint: use "max_nb_cycles = 0" to get a default value, or "= N" to allow N cycles.'
+            raise CycleError(message)
+        cycle_detection_state.depth_by_variable_name[variable_name] = depth + 1
+
+    def clean_cycle_detection_data(self, period = None):
+        """When the value of a formula has been computed, remove its call from the active formula calls.
+
+        The period can be omitted (like before it was required) only when the variable has a single active call.
         """
-        simulation = self.holder.entity.simulation
-        column = self.holder.column
-        variable_name = column.name
-        requested_periods_by_variable_name = simulation.requested_periods_by_variable_name
-        if variable_name in requested_periods_by_variable_name:
-            requested_periods_by_variable_name[variable_name].pop()
-            if len(requested_periods_by_variable_name[variable_name]) == 0:
-                del requested_periods_by_variable_name[variable_name]
+        holder = self.holder
+        variable_name = holder.column.name
+        cycle_detection_state = holder.entity.simulation.cycle_detection_state
+        depth_by_variable_name = cycle_detection_state.depth_by_variable_name
+        if period is None:
+            depth = depth_by_variable_name.get(variable_name)
+            if depth is None:
+                return
+            assert depth == 1, \
+                'The period of the call of {} to clean must be given, because it has several active calls'.format(
+                    variable_name)
+            period = next(
+                active_period
+                for active_variable_name, active_period in cycle_detection_state.active_formula_keys
+                if active_variable_name == variable_name
+                )
+        cycle_detection_state.active_formula_keys.remove((variable_name, period))
+        depth = depth_by_variable_name.pop(variable_name)
+        if depth != 1:
+            depth_by_variable_name[variable_name] = depth - 1
 
     def compute(self, period = None, **parameters):
         """
@@ -535,105 +571,130 @@ class SimpleFormula(AbstractFormula):
         extra_params = parameters.get('extra_params')
         if max_nb_cycles is not None:
             simulation.max_nb_cycles = max_nb_cycles
+        dependencies_tracker = simulation.dependencies_tracker
+        dependencies_tracker_entered = False
+        profiler = simulation.profiler
+        profiler_entered = False
 
         # Note: Don't compute intersection with column.start & column.end, because holder already does it:
         # output_period = output_period.intersection(periods.instant(column.start), periods.instant(column.end))
         # Note: Don't verify that the function result has already been computed, because this is the task of
         # holder.compute().
 
+        computed = False
+        cycle_checked = False
         try:
-            self.check_for_cycle(period)
-            if debug or trace:
-                simulation.stack_trace.append(dict(
-                    parameters_infos = [],
-                    input_variables_infos = [],
-                    variable_name = column.name,
+            try:
+                self.check_for_cycle(period)
+                cycle_checked = True
+                if dependencies_tracker is not None:
+                    dependencies_tracker.enter(column.name, period)
+                    dependencies_tracker_entered = True
+                if profiler is not None:
+                    profiler.enter(column.name, period)
+                    profiler_entered = True
+                if debug or trace:
+                    simulation.stack_trace.append(dict(
+                        parameters_infos = [],
+                        input_variables_infos = [],
+                        variable_name = column.name,
+                        ))
+                if extra_params:
+                    formula_result = self.base_function(simulation, period, *extra_params)
+                else:
+                    formula_result = self.base_function(simulation, period)
+            except CycleError:
+                if cycle_checked:
+                    self.clean_cycle_detection_data(period)
+                if max_nb_cycles is None:
+                    # Re-raise until reaching the first variable called with max_nb_cycles != None in the stack.
+                    raise
+                simulation.max_nb_cycles = None
+                simulation.cycle_default_values_count += 1
+                return holder.put_in_cache(self.default_values(), period, extra_params)
+            except legislations.ParameterNotFound as exc:
+                if exc.variable_name is None:
+                    raise legislations.ParameterNotFound(
+                        instant = exc.instant,
+                        name = exc.name,
+                        variable_name = column.name,
+                        )
+                else:
+                    raise
+            except:
+                log.error(u'An error occurred while calling formula {}@{}<{}> in module {}'.format(
+                    column.name, entity.key_plural, str(period), self.function.__module__,
                     ))
-            if extra_params:
-                formula_result = self.base_function(simulation, period, *extra_params)
-            else:
-                formula_result = self.base_function(simulation, period)
-        except CycleError:
-            self.clean_cycle_detection_data()
-            if max_nb_cycles is None:
-                # Re-raise until reaching the first variable called with max_nb_cycles != None in the stack.
                 raise
-            simulation.max_nb_cycles = None
-            return holder.put_in_cache(self.default_values(), period, extra_params)
-        except legislations.ParameterNotFound as exc:
-            if exc.variable_name is None:
-                raise legislations.ParameterNotFound(
-                    instant = exc.instant,
-                    name = exc.name,
-                    variable_name = column.name,
-                    )
             else:
-                raise
-        except:
-            log.error(u'An error occurred while calling formula {}@{}<{}> in module {}'.format(
-                column.name, entity.key_plural, str(period), self.function.__module__,
-                ))
-            raise
-        else:
-            try:
-                output_period, array = formula_result
-            except ValueError:
-                raise ValueError(u'A formula must return "period, array": {}@{}<{}> in module {}'.format(
-                    column.name, entity.key_plural, str(period), self.function.__module__,
-                    ).encode('utf-8'))
-        assert output_period[1] <= period[1] <= output_period.stop, \
-            u"Function {}@{}<{}>() --> <{}>{} returns an output period that doesn't include start instant of" \
-            u"requested period".format(column.name, entity.key_plural, str(period), str(output_period),
-                stringify_array(array)).encode('utf-8')
-        assert isinstance(array, np.ndarray), u"Function {}@{}<{}>() --> <{}>{} doesn't return a numpy array".format(
-            column.name, entity.key_plural, str(period), str(output_period), array).encode('utf-8')
-        assert array.size == entity.count, \
-            u"Function {}@{}<{}>() --> <{}>{} returns an array of size {}, but size {} is expected for {}".format(
-                column.name, entity.key_plural, str(period), str(output_period), stringify_array(array),
-                array.size, entity.count, entity.key_singular).encode('utf-8')
-        if debug:
-            try:
-                # cf http://stackoverflow.com/questions/6736590/fast-check-for-nan-in-numpy
-                if np.isnan(np.min(array)):
-                    nan_count = np.count_nonzero(np.isnan(array))
-                    raise NaNCreationError(u"Function {}@{}<{}>() --> <{}>{} returns {} NaN value(s)".format(
-                        column.name, entity.key_plural, str(period), str(output_period), stringify_array(array),
-                        nan_count).encode('utf-8'))
-            except TypeError:
-                pass
-        if array.dtype != column.dtype:
-            array = array.astype(column.dtype)
+                try:
+                    output_period, array = formula_result
+                except ValueError:
+                    raise ValueError(u'A formula must return "period, array": {}@{}<{}> in module {}'.format(
+                        column.name, entity.key_plural, str(period), self.function.__module__,
+                        ).encode('utf-8'))
+            assert output_period[1] <= period[1] <= output_period.stop, \
+                u"Function {}@{}<{}>() --> <{}>{} returns an output period that doesn't include start instant of" \
+                u"requested period".format(column.name, entity.key_plural, str(period), str(output_period),
+                    stringify_array(array)).encode('utf-8')
+            assert isinstance(array, np.ndarray), \
+                u"Function {}@{}<{}>() --> <{}>{} doesn't return a numpy array".format(
+                    column.name, entity.key_plural, str(period), str(output_period), array).encode('utf-8')
+            assert array.size == entity.count, \
+                u"Function {}@{}<{}>() --> <{}>{} returns an array of size {}, but size {} is expected for {}".format(
+                    column.name, entity.key_plural, str(period), str(output_period), stringify_array(array),
+                    array.size, entity.count, entity.key_singular).encode('utf-8')
+            if debug:
+                try:
+                    # cf http://stackoverflow.com/questions/6736590/fast-check-for-nan-in-numpy
+                    if np.isnan(np.min(array)):
+                        nan_count = np.count_nonzero(np.isnan(array))
+                        raise NaNCreationError(u"Function {}@{}<{}>() --> <{}>{} returns {} NaN value(s)".format(
+                            column.name, entity.key_plural, str(period), str(output_period), stringify_array(array),
+                            nan_count).encode('utf-8'))
+                except TypeError:
+                    pass
+            if array.dtype != column.dtype:
+                array = array.astype(column.dtype)
 
-        if debug or trace:
-            variable_infos = (column.name, output_period)
-            step = simulation.traceback.get(variable_infos)
-            if step is None:
-                simulation.traceback[variable_infos] = step = dict(
-                    holder = holder,
-                    )
-            step.update(simulation.stack_trace.pop())
-            input_variables_infos = step['input_variables_infos']
-            if not debug_all or trace:
-                step['default_input_variables'] = has_only_default_input_variables = all(
-                    np.all(input_holder.get_array(input_variable_period) == input_holder.column.default)
-                    for input_holder, input_variable_period in (
-                        (simulation.get_holder(input_variable_name), input_variable_period1)
-                        for input_variable_name, input_variable_period1 in input_variables_infos
+            if debug or trace:
+                variable_infos = (column.name, output_period)
+                step = simulation.traceback.get(variable_infos)
+                if step is None:
+                    simulation.traceback[variable_infos] = step = dict(
+                        holder = holder,
                         )
-                    )
-            step['is_computed'] = True
-            if debug and (debug_all or not has_only_default_input_variables):
-                log.info(u'<=> {}@{}<{}>({}) --> <{}>{}'.format(column.name, entity.key_plural, str(period),
-                    simulation.stringify_input_variables_infos(input_variables_infos), str(output_period),
-                    stringify_array(array)))
+                step.update(simulation.stack_trace.pop())
+                input_variables_infos = step['input_variables_infos']
+                if not debug_all or trace:
+                    step['default_input_variables'] = has_only_default_input_variables = all(
+                        np.all(input_holder.get_array(input_variable_period) == input_holder.column.default)
+                        for input_holder, input_variable_period in (
+                            (simulation.get_holder(input_variable_name), input_variable_period1)
+                            for input_variable_name, input_variable_period1 in input_variables_infos
+                            )
+                        )
+                step['is_computed'] = True
+                if debug and (debug_all or not has_only_default_input_variables):
+                    log.info(u'<=> {}@{}<{}>({}) --> <{}>{}'.format(column.name, entity.key_plural, str(period),
+                        simulation.stringify_input_variables_infos(input_variables_infos), str(output_period),
+                        stringify_array(array)))
 
-        dated_holder = holder.put_in_cache(array, output_period, extra_params)
+            dated_holder = holder.put_in_cache(array, output_period, extra_params)
 
-        self.clean_cycle_detection_data()
-        if max_nb_cycles is not None:
-            simulation.max_nb_cycles = None
+            self.clean_cycle_detection_data(period)
+            computed = True
+            if max_nb_cycles is not None:
+                simulation.max_nb_cycles = None
 
-        return dated_holder
+            return dated_holder
+        finally:
+            if dependencies_tracker_entered:
+                # Tell the tracker whether the formula call succeeded.
+                dependencies_tracker.exit(column.name, period, computed = computed)
+            if profiler_entered:
+                # The array is given only when the formula call succeeded.
+                profiler.exit(column.name, period, array if computed else None)
 
     def filter_role(self, array_or_dated_holder, default = None, entity = None, role = None):
         """Convert a persons array to an entity array, copying only cells of persons having the given role."""
@@ -659,19 +720,30 @@ class SimpleFormula(AbstractFormula):
                 array.size)
             if default is None:
                 default = 0
-        entity_index_array = persons.simulation.holder_by_name[entity.index_for_person_variable_name].array
         assert isinstance(role, int)
         target_array = np.empty(entity.count, dtype = array.dtype)
         target_array.fill(default)
-        boolean_filter = persons.simulation.holder_by_name[entity.role_for_person_variable_name].array == role
+        persons_positions, members_positions = simulation.get_entity_membership(entity).get_role_positions(role)
         try:
-            target_array[entity_index_array[boolean_filter]] = array[boolean_filter]
+            target_array[members_positions] = array[persons_positions]
         except:
             log.error(u'An error occurred while filtering array for role {}[{}] in function {}'.format(
                 entity.key_singular, role, holder.column.name))
             raise
         return target_array
 
+    def get_cycle_error_message(self, period):
+        holder = self.holder
+        active_formula_keys = holder.entity.simulation.cycle_detection_state.active_formula_keys
+        return u'Circular definition detected on formula {}<{}>. Formulas and periods involved: {}.'.format(
+            holder.column.name,
+            period,
+            u', '.join(sorted(
+                u'{}<{}>'.format(variable_name, active_period)
+                for variable_name, active_period in active_formula_keys
+                )).encode('utf-8'),
+            )
+
     def graph_parameters(self, edges, get_input_variables_and_parameters, nodes, visited):
         """Recursively build a graph of formulas."""
         holder = self.holder
@@ -688,6 +760,12 @@ class SimpleFormula(AbstractFormula):
                     'to': column.name,
                     })
 
+    def has_extra_params(self):
+        function = self.function
+        if function is None:
+            return False
+        return getattr(function, '__func__', function).func_code.co_argcount > 3
+
     def split_by_roles(self, array_or_dated_holder, default = None, entity = None, roles = None):
         """dispatch a persons array to several entity arrays (one for each role)."""
         holder = self.holder
@@ -712,7 +790,7 @@ class SimpleFormula(AbstractFormula):
                 array.size)
             if default is None:
                 default = 0
-        entity_index_array = persons.simulation.holder_by_name[entity.index_for_person_variable_name].array
+        membership = simulation.get_entity_membership(entity)
         if roles is None:
             # To ensure that existing formulas don't fail, ensure there is always at least 11 roles.
             # roles = range(entity.roles_count)
@@ -721,9 +799,9 @@ class SimpleFormula(AbstractFormula):
         for role in roles:
             target_array_by_role[role] = target_array = np.empty(entity.count, dtype = array.dtype)
             target_array.fill(default)
-            boolean_filter = persons.simulation.holder_by_name[entity.role_for_person_variable_name].array == role
+            persons_positions, members_positions = membership.get_role_positions(role)
             try:
-                target_array[entity_index_array[boolean_filter]] = array[boolean_filter]
+                target_array[members_positions] = array[persons_positions]
             except:
                 log.error(u'An error occurred while filtering array for role {}[{}] in function {}'.format(
                     entity.key_singular, role, holder.column.name))
@@ -749,14 +827,14 @@ class SimpleFormula(AbstractFormula):
                 'utf-8')
             assert array.size == persons.count, u"Expected an array of size {}. Got: {}".format(persons.count,
                 array.size)
-        entity_index_array = persons.simulation.holder_by_name[entity.index_for_person_variable_name].array
+        membership = simulation.get_entity_membership(entity)
+        dtype = array.dtype if array.dtype != np.bool else np.int16
         if roles is None:
-            roles = range(entity.roles_count)
-        target_array = np.zeros(entity.count, dtype = array.dtype if array.dtype != np.bool else np.int16)
+            return membership.aggregate(array, 'add', dtype = dtype)
+        target_array = np.zeros(entity.count, dtype = dtype)
         for role in roles:
-            # TODO: Mettre les filtres en cache dans la simulation
-            boolean_filter = persons.simulation.holder_by_name[entity.role_for_person_variable_name].array == role
-            target_array[entity_index_array[boolean_filter]] += array[boolean_filter]
+            persons_positions, members_positions = membership.get_role_positions(role)
+            target_array[members_positions] += array[persons_positions]
         return target_array
 
     def to_json(self, get_input_variables_and_parameters = None, with_input_variables_details = False):
@@ -3,6 +3,9 @@
 
 from __future__ import division
 
+from bisect import bisect_left, bisect_right, insort
+import sys
+
 import numpy as np
 
 from . import periods
@@ -11,7 +14,8 @@ from .tools import empty_clone
 
 class DatedHolder(object):
     """A view of an holder, for a given period (and possibly a given set of extra parameters).
-    If the variable is not cached, it also contains the value of the variable for the given date."""
+    If the variable is not cached, or if its cache is bounded by a budget (that may evict it), it also contains the
+    value of the variable for the given date."""
     holder = None
     period = None
     extra_params = None
@@ -24,14 +28,13 @@ class DatedHolder(object):
 
     @property
     def array(self):
-        return self.value if self.value else self.holder.get_array(self.period, self.extra_params)
+        return self.value if self.value is not None else self.holder.get_array(self.period, self.extra_params)
 
     @array.setter
     def array(self, array):
-        if self.value:
+        if self.value is not None:
             self.value = array
-        else:
-            self.holder.put_in_cache(array, self.period, self.extra_params)
+        self.holder.put_in_cache(array, self.period, self.extra_params)
 
     @property
     def column(self):
@@ -49,9 +52,223 @@ class DatedHolder(object):
             ]
 
 
+class PeriodArrayStore(object):
+    """A mapping of periods to arrays, ordered by period, that can replace the dict of an holder.
+
+    Monthly arrays are copied into the rows of a 2-D contiguous buffer indexed by month, so that consecutive months can
+    be read as a single block without copying them. The stored array is then the row of the buffer: the array given
+    is no longer referenced by the store.
+    To bound the memory of the empty rows, a month further than max_gap_months from the buffer is stored apart, like
+    the other periods. The buffer shrinks when most of its rows are removed, and is freed when all of them are.
+    A row is written only once: storing a month whose row was already written (and may be referenced out of the store)
+    copies the buffer first, so that the arrays already returned are never modified.
+    """
+    max_gap_months = 12  # Maximum number of empty rows added to the buffer, before or after its rows
+    _buffer = None  # One row per month, the first row being the month _first_month
+    _buffer_is_shared = False  # When True, the buffer is shared with a copy of the store and must be copied on write.
+    _first_month = None  # Index (year * 12 + month - 1) of the first row of the buffer
+    _month_filled = None  # Tells which rows of the buffer contain an array
+    _month_written = None  # Tells which rows of the buffer have been written, even if they were removed since
+
+    def __init__(self):
+        self._periods = []
+        self._value_by_period = {}
+
+    def __contains__(self, period):
+        return period in self._value_by_period
+
+    def __delitem__(self, period):
+        if period not in self._value_by_period:
+            raise KeyError(period)
+        self.pop(period)
+
+    def __getitem__(self, period):
+        return self._value_by_period[period]
+
+    def __iter__(self):
+        return iter(self._periods)
+
+    def __len__(self):
+        return len(self._periods)
+
+    def __setitem__(self, period, value):
+        value_by_period = self._value_by_period
+        if period not in value_by_period:
+            insort(self._periods, period)
+        month = get_month_index(period)
+        if month is not None and self._is_bufferable(month, value):
+            value = self._put_in_buffer(month, value)
+        elif month is not None:
+            self._remove_from_buffer(month)
+        value_by_period[period] = value
+
+    def _is_bufferable(self, month, value):
+        if not isinstance(value, np.ndarray) or value.ndim != 1:
+            return False
+        buffer = self._buffer
+        if buffer is None:
+            return True
+        first_month = self._first_month
+        return value.dtype == buffer.dtype and value.shape[0] == buffer.shape[1] \
+            and first_month - self.max_gap_months <= month < first_month + len(buffer) + self.max_gap_months
+
+    def _put_in_buffer(self, month, value):
+        buffer = self._buffer
+        if buffer is None:
+            self._buffer = buffer = np.empty((1, value.shape[0]), dtype = value.dtype)
+            self._first_month = month
+            self._month_filled = np.zeros(1, dtype = np.bool)
+            self._month_written = np.zeros(1, dtype = np.bool)
+        elif self._buffer_is_shared:
+            self._resize_buffer(self._first_month, self._first_month + len(buffer))
+        first_month = self._first_month
+        capacity = len(self._buffer)
+        # Grow by the size of the buffer (to amortize the copies), but by max_gap_months at most.
+        growth = min(capacity, self.max_gap_months)
+        if month < first_month:
+            self._resize_buffer(min(month, first_month - growth), first_month + capacity)
+        elif month >= first_month + capacity:
+            self._resize_buffer(first_month, max(month + 1, first_month + capacity + growth))
+        row_index = month - self._first_month
+        if self._month_written[row_index]:
+            # The row may be referenced out of the store: write into a copy of the buffer.
+            self._resize_buffer(self._first_month, self._first_month + len(self._buffer))
+        row = self._buffer[row_index]
+        row[...] = value
+        self._month_filled[row_index] = True
+        self._month_written[row_index] = True
+        return row
+
+    def _remove_from_buffer(self, month):
+        if self._buffer is None:
+            return
+        row_index = month - self._first_month
+        if 0 <= row_index < len(self._buffer) and self._month_filled[row_index]:
+            filled_rows_index = np.flatnonzero(self._month_filled)
+            if len(filled_rows_index) == 1:
+                # Free the buffer. The rows still referenced elsewhere keep their memory.
+                self._buffer = None
+                self._buffer_is_shared = False
+                self._first_month = None
+                self._month_filled = None
+                self._month_written = None
+                return
+            if self._buffer_is_shared:
+                self._resize_buffer(self._first_month, self._first_month + len(self._buffer))
+            self._month_filled[row_index] = False
+            filled_rows_index = filled_rows_index[filled_rows_index != row_index]
+            start_index = filled_rows_index[0]
+            stop_index = filled_rows_index[-1] + 1
+            if 2 * (stop_index - start_index) <= len(self._buffer):
+                # Most of the rows are empty: shrink the buffer to its filled rows.
+                self._resize_buffer(self._first_month + start_index, self._first_month + stop_index)
+
+    def _resize_buffer(self, first_month, stop_month):
+        """Move the buffer to a new (private) array covering the given months, and rebind the stored rows."""
+        old_buffer = self._buffer
+        old_first_month = self._first_month
+        self._buffer = buffer = np.empty((stop_month - first_month, old_buffer.shape[1]), dtype = old_buffer.dtype)
+        month_filled = np.zeros(len(buffer), dtype = np.bool)
+        # Copy the rows of the months covered by both buffers.
+        start = max(first_month, old_first_month)
+        stop = min(stop_month, old_first_month + len(old_buffer))
+        if start < stop:
+            buffer[start - first_month:stop - first_month] = old_buffer[start - old_first_month:stop - old_first_month]
+            month_filled[start - first_month:stop - first_month] = \
+                self._month_filled[start - old_first_month:stop - old_first_month]
+        self._month_filled = month_filled
+        self._month_written = month_filled.copy()
+        self._first_month = first_month
+        self._buffer_is_shared = False
+        value_by_period = self._value_by_period
+        for period in self._periods:
+            month = get_month_index(period)
+            if month is not None and first_month <= month < stop_month and month_filled[month - first_month]:
+                value_by_period[period] = buffer[month - first_month]
+
+    def copy(self):
+        """Return a new store sharing the arrays of this store. The monthly buffer is copied only on write."""
+        new = self.__class__()
+        new._periods = self._periods[:]
+        new._value_by_period = self._value_by_period.copy()
+        if self._buffer is not None:
+            new._buffer = self._buffer
+            new._first_month = self._first_month
+            new._month_filled = self._month_filled
+            new._month_written = self._month_written
+            new._buffer_is_shared = self._buffer_is_shared = True
+        return new
+
+    def get(self, period, default = None):
+        return self._value_by_period.get(period, default)
+
+    def get_last_item(self, period, cover_stop = False):
+        """Return the last known (period, value) starting before the requested period, or None.
+
+        When cover_stop is True, the known period must also end after the requested period.
+        Periods are searched in reverse order, like a reverse sort of the items of a dict, but with bisections.
+        """
+        known_periods = self._periods
+        stop_index = len(known_periods)
+        while stop_index > 0:
+            unit = known_periods[stop_index - 1][0]
+            start_index = bisect_left(known_periods, (unit,), 0, stop_index)
+            index = bisect_right(known_periods, (unit, period.start, sys.maxint), start_index, stop_index)
+            while index > start_index:
+                index -= 1
+                last_period = known_periods[index]
+                if not cover_stop or last_period.stop >= period.stop:
+                    return last_period, self._value_by_period[last_period]
+            stop_index = start_index
+        return None
+
+    def get_months_block(self, start, months_count):
+        """Return a 2-D view of the arrays of consecutive months, or None when one of these months is not buffered."""
+        if self._buffer is None or start.day != 1:
+            return None
+        row_index = start.year * 12 + start.month - 1 - self._first_month
+        if row_index < 0 or row_index + months_count > len(self._buffer) \
+                or not self._month_filled[row_index:row_index + months_count].all():
+            return None
+        return self._buffer[row_index:row_index + months_count]
+
+    def items(self):
+        return list(self.iteritems())
+
+    def iteritems(self):
+        value_by_period = self._value_by_period
+        for period in self._periods:
+            yield period, value_by_period[period]
+
+    def iterkeys(self):
+        return iter(self._periods)
+
+    def itervalues(self):
+        value_by_period = self._value_by_period
+        for period in self._periods:
+            yield value_by_period[period]
+
+    def keys(self):
+        return self._periods[:]
+
+    def pop(self, period, default = None):
+        value_by_period = self._value_by_period
+        if period not in value_by_period:
+            return default
+        del self._periods[bisect_left(self._periods, period)]
+        month = get_month_index(period)
+        if month is not None:
+            self._remove_from_buffer(month)
+        return value_by_period.pop(period)
+
+    def values(self):
+        return list(self.itervalues())
+
+
 class Holder(object):
     _array = None  # Only used when column.is_permanent
     _array_by_period = None  # Only used when not column.is_permanent
+    _array_by_period_shared = False  # When True, _array_by_period is shared with a clone and must be copied on write.
     column = None
     entity = None
     formula = None
@@ -91,20 +308,20 @@ class Holder(object):
     def calculate_output(self, period):
         return self.formula.calculate_output(period)
 
-    def clone(self):
-        """Copy the holder just enough to be able to run a new simulation without modifying the original simulation."""
-        new = empty_clone(self)
-        new_dict = new.__dict__
+    def clone(self, entity = None):
+        """Copy the holder just enough to be able to run a new simulation without modifying the original simulation.
 
-        for key, value in self.__dict__.iteritems():
-            if key in ('_array_by_period',):
-                if value is not None:
-                    # There is no need to copy the arrays, because the formulas don't modify them.
-                    new_dict[key] = value.copy()
-            elif key not in ('entity', 'formula'):
-                new_dict[key] = value
+        The entity of the new simulation should be given, otherwise the new holder keeps the original entity.
+        """
+        new = empty_clone(self)
+        new.__dict__ = new_dict = self.__dict__.copy()
+        new_dict.pop('formula', None)
+        if self._array_by_period is not None:
+            # The store of the arrays is shared until one of the holders modifies it (see get_writable_array_by_period).
+            # The arrays themselves are never copied, because the formulas don't modify them.
+            new_dict['_array_by_period_shared'] = self._array_by_period_shared = True
 
-        new_dict['entity'] = self.entity
+        new_dict['entity'] = self.entity if entity is None else entity
         # Caution: formula must be cloned after the entity has been set into new.
         formula = self.formula
         if formula is not None:
@@ -116,7 +333,10 @@ class Holder(object):
         """Compute array if needed and/or convert it to requested period and return a dated holder containig it.
 
         The returned dated holder is always of the requested period and this method never returns None.
+        The count_lookup parameter is False when the lookup is made by compute_add(), compute_add_divide() or
+        compute_divide(), which have already counted theirs in the profiler.
         """
+        count_lookup = parameters.pop('count_lookup', True)
         entity = self.entity
         simulation = entity.simulation
         if period is None:
@@ -126,8 +346,13 @@ class Holder(object):
 
         # First look for dated_holders covering the whole period (without hole).
         dated_holder = self.get_from_cache(period, parameters.get('extra_params'))
+        profiler = simulation.profiler if count_lookup else None
         if dated_holder.array is not None:
+            if profiler is not None:
+                profiler.hit(column.name, period)
             return dated_holder
+        if profiler is not None:
+            profiler.miss(column.name, period)
         assert self._array is None  # self._array should always be None when dated_holder.array is None.
 
         column_start_instant = periods.instant(column.start)
@@ -145,15 +370,18 @@ class Holder(object):
         array.fill(column.default)
         return self.put_in_cache(array, period)
 
-    def compute_add(self, period = None, **parameters):
-        dated_holder = self.get_from_cache(period, parameters.get('extra_params'))
-        if dated_holder.array is not None:
-            return dated_holder
-
+    def add_periods(self, period, parameters):
+        """Compute the sum of the values of the variable over the period, adding the periods returned by its formula."""
+        extra_params = parameters.get('extra_params')
         array = None
         unit = period.unit
         if unit == u'month':
             remaining_period_months = period.size
+            if not extra_params:
+                # When all the months are already known, add them at once.
+                array = self.sum_known_months(period.start, remaining_period_months)
+                if array is not None:
+                    return self.put_in_cache(array, period)
         else:
             assert unit == u'year', unit
             remaining_period_months = period.size * 12
@@ -161,7 +389,7 @@ class Holder(object):
         # We expect the compute calls to return a period different than the requested one.
         parameters['accept_other_period'] = True
         while True:
-            dated_holder = self.compute(period = requested_period, **parameters)
+            dated_holder = self.compute(period = requested_period, count_lookup = False, **parameters)
             requested_start = requested_period.start
             returned_period = dated_holder.period
             returned_start = returned_period.start
@@ -186,26 +414,39 @@ class Holder(object):
                 "Period {} returned by variable {} is larger than the requested_period {}.".format(
                     returned_period, self.column.name, requested_period)
             if array is None:
+                if remaining_period_months > 0 and not extra_params \
+                        and returned_period == requested_start.period(u'month'):
+                    # The variable is computed by month: compute the next months, then add them all at once.
+                    months_sum = self.compute_months_sum(requested_start, remaining_period_months + 1,
+                        dated_holder.array, parameters)
+                    if months_sum is not None:
+                        return self.put_in_cache(months_sum, period)
                 array = dated_holder.array.copy()
             else:
                 array += dated_holder.array
 
             if remaining_period_months <= 0:
-                return self.put_in_cache(array, period, parameters.get('extra_params'))
+                return self.put_in_cache(array, period, extra_params)
             if remaining_period_months % 12 == 0:
                 requested_period = requested_start.offset(returned_period_months, u'month').period(u'year')
             else:
                 requested_period = requested_start.offset(returned_period_months, u'month').period(u'month')
 
-    def compute_add_divide(self, period = None, **parameters):
-        dated_holder = self.get_from_cache(period, parameters.get('extra_params'))
-        if dated_holder.array is not None:
-            return dated_holder
-
+    def add_divided_periods(self, period, parameters):
+        """Compute the sum of the values of the variable over the period, adding the periods returned by its formula
+        multiplied by their intersection ratio with the period."""
+        extra_params = parameters.get('extra_params')
         array = None
+        # Type of the arrays once multiplied by their intersection ratio
+        divided_dtype = (np.empty(0, dtype = self.column.dtype) * 1 / 1).dtype
         unit = period.unit
         if unit == u'month':
             remaining_period_months = period.size
+            if not extra_params:
+                # When all the months are already known, add them at once.
+                array = self.sum_known_months(period.start, remaining_period_months, dtype = divided_dtype)
+                if array is not None:
+                    return self.put_in_cache(array, period)
         else:
             assert unit == u'year', unit
             remaining_period_months = period.size * 12
@@ -213,7 +454,7 @@ class Holder(object):
         # We expect the compute calls to return a period different than the requested one.
         parameters['accept_other_period'] = True
         while True:
-            dated_holder = self.compute(period = requested_period, **parameters)
+            dated_holder = self.compute(period = requested_period, count_lookup = False, **parameters)
             requested_start = requested_period.start
             returned_period = dated_holder.period
             returned_start = returned_period.start
@@ -235,23 +476,98 @@ class Holder(object):
                 intersection_months = min(requested_start_months + requested_period.size,
                     returned_start_months + returned_period.size * 12) - requested_start_months
                 intersection_array = dated_holder.array * intersection_months / (returned_period.size * 12)
+            remaining_period_months -= intersection_months
             if array is None:
+                if remaining_period_months > 0 and not extra_params \
+                        and returned_period == requested_start.period(u'month'):
+                    # The variable is computed by month: compute the next months, then add them all at once.
+                    months_sum = self.compute_months_sum(requested_start, remaining_period_months + 1,
+                        dated_holder.array, parameters, dtype = divided_dtype)
+                    if months_sum is not None:
+                        return self.put_in_cache(months_sum, period)
                 array = intersection_array.copy()
             else:
                 array += intersection_array
 
-            remaining_period_months -= intersection_months
             if remaining_period_months <= 0:
-                return self.put_in_cache(array, period, parameters.get('extra_params'))
+                return self.put_in_cache(array, period, extra_params)
             if remaining_period_months % 12 == 0:
                 requested_period = requested_start.offset(intersection_months, u'month').period(u'year')
             else:
                 requested_period = requested_start.offset(intersection_months, u'month').period(u'month')
 
+    def compute_add(self, period = None, **parameters):
+        extra_params = parameters.get('extra_params')
+        dated_holder = self.get_from_cache(period, extra_params)
+        profiler = self.entity.simulation.profiler
+        if dated_holder.array is not None:
+            if profiler is not None:
+                profiler.hit(self.column.name, period)
+            return dated_holder
+        if profiler is None:
+            return self.add_periods(period, parameters)
+        profiler.miss(self.column.name, period)
+        # Profile the addition like a formula call, so that its time is not counted in the formula calling it.
+        profiler.enter(self.column.name, period)
+        dated_holder = None
+        try:
+            dated_holder = self.add_periods(period, parameters)
+            return dated_holder
+        finally:
+            # The array is given only when the addition succeeded.
+            profiler.exit(self.column.name, period, None if dated_holder is None else dated_holder.array)
+
+    def compute_add_divide(self, period = None, **parameters):
+        extra_params = parameters.get('extra_params')
+        dated_holder = self.get_from_cache(period, extra_params)
+        profiler = self.entity.simulation.profiler
+        if dated_holder.array is not None:
+            if profiler is not None:
+                profiler.hit(self.column.name, period)
+            return dated_holder
+        if profiler is None:
+            return self.add_divided_periods(period, parameters)
+        profiler.miss(self.column.name, period)
+        # Profile the addition like a formula call, so that its time is not counted in the formula calling it.
+        profiler.enter(self.column.name, period)
+        dated_holder = None
+        try:
+            dated_holder = self.add_divided_periods(period, parameters)
+            return dated_holder
+        finally:
+            # The array is given only when the addition succeeded.
+            profiler.exit(self.column.name, period, None if dated_holder is None else dated_holder.array)
+
+    def compute_months_sum(self, start, months_count, first_month_array, parameters, dtype = None):
+        """Return the sum of the arrays of consecutive months, computing the missing months first.
+
+        The array of the first month is already computed. The months are added at once, like in sum_known_months().
+        Return None when the formula returns another period than a requested month: the caller then adds the periods
+        one by one.
+        """
+        months_sum = self.sum_known_months(start, months_count, dtype = dtype)
+        if months_sum is not None:
+            return months_sum
+        # Keep the arrays, because computing the next months may evict the previous ones from the cache.
+        months_array = [first_month_array]
+        month = start.period(u'month')
+        for month_index in xrange(1, months_count):
+            month = month.offset(1)
+            dated_holder = self.compute(period = month, count_lookup = False, **parameters)
+            if dated_holder.period != month:
+                return None
+            months_array.append(dated_holder.array)
+        return np.sum(months_array, axis = 0, dtype = dtype or first_month_array.dtype)
+
     def compute_divide(self, period = None, **parameters):
         dated_holder = self.get_from_cache(period, parameters.get('extra_params'))
+        profiler = self.entity.simulation.profiler
         if dated_holder.array is not None:
+            if profiler is not None:
+                profiler.hit(self.column.name, period)
             return dated_holder
+        if profiler is not None:
+            profiler.miss(self.column.name, period)
 
         array = None
         unit = period[0]
@@ -259,7 +575,7 @@ class Holder(object):
         if unit == u'month':
             # We expect the compute call to return a yearly period.
             parameters['accept_other_period'] = True
-            dated_holder = self.compute(period = period, **parameters)
+            dated_holder = self.compute(period = period, count_lookup = False, **parameters)
             assert dated_holder.period.start <= period.start and period.stop <= dated_holder.period.stop, \
                 "Period {} returned by variable {} doesn't include requested period {}.".format(
                     dated_holder.period, self.column.name, period)
@@ -273,13 +589,38 @@ class Holder(object):
             return self.put_in_cache(array, period, parameters.get('extra_params'))
         else:
             assert unit == u'year', unit
-            return self.compute(period = period)
+            return self.compute(period = period, count_lookup = False)
+
+    def delete_array(self, period, extra_params = None):
+        """Remove the array of the given period (and extra parameters) from the cache."""
+        if self._array_by_period is None:
+            return
+        array_by_period = self.get_writable_array_by_period()
+        if extra_params:
+            values = array_by_period.get(period)
+            if type(values) == dict:
+                values.pop(tuple(extra_params), None)
+                if not values:
+                    array_by_period.pop(period, None)
+        else:
+            array_by_period.pop(period, None)
 
     def delete_arrays(self):
+        cache_budget = self.entity.simulation.cache_budget
+        if cache_budget is not None and self._array_by_period is not None:
+            for period, values in self._array_by_period.iteritems():
+                if type(values) == dict:
+                    for extra_params in values:
+                        cache_budget.remove(self, period, extra_params)
+                else:
+                    cache_budget.remove(self, period)
         if self._array is not None:
             del self._array
         if self._array_by_period is not None:
+            # When the store is shared with a clone, only the reference of this holder is dropped.
             del self._array_by_period
+        if self._array_by_period_shared:
+            del self._array_by_period_shared
 
     def get_array(self, period, extra_params = None):
         if self.column.is_permanent:
@@ -289,6 +630,9 @@ class Holder(object):
         if array_by_period is not None:
             values = array_by_period.get(period)
             if values is not None:
+                cache_budget = self.entity.simulation.cache_budget
+                if cache_budget is not None:
+                    cache_budget.touch(self, period, extra_params)
                 if extra_params:
                     return values.get(tuple(extra_params))
                 else:
@@ -297,6 +641,23 @@ class Holder(object):
                     return values
         return None
 
+    def get_writable_array_by_period(self):
+        """Return the store of the arrays of the holder (created when missing), ready to be modified.
+
+        A store shared with a clone (or with the original holder of a clone) is copied on its first modification: the
+        copy references the same arrays, so only the dict (and the dicts of arrays by extra parameters) are allocated.
+        """
+        array_by_period = self._array_by_period
+        if array_by_period is None:
+            self._array_by_period = array_by_period = PeriodArrayStore() if self.entity.simulation.period_store else {}
+        elif self._array_by_period_shared:
+            self._array_by_period = array_by_period = array_by_period.copy()
+            for period, values in array_by_period.items():
+                if type(values) == dict:
+                    array_by_period[period] = values.copy()
+            del self._array_by_period_shared
+        return array_by_period
+
     def graph(self, edges, get_input_variables_and_parameters, nodes, visited):
         column = self.column
         if self in visited:
@@ -329,8 +690,24 @@ class Holder(object):
             return None
         return formula.real_formula
 
-    def set_input(self, period, array):
-        self.formula.set_input(period, array)
+    def set_input(self, period, array, use_hook = True):
+        """Put an input array in the cache, using the set_input hook of the variable by default.
+
+        When the simulation has a cache budget, the arrays put in cache are pinned: they will never be evicted.
+        """
+        simulation = self.entity.simulation
+        simulation.input_variables_name.add(self.column.name)
+        cache_budget = simulation.cache_budget
+        if cache_budget is not None:
+            cache_budget.pinning += 1
+        try:
+            if use_hook:
+                self.formula.set_input(period, array)
+            else:
+                self.put_in_cache(array, period)
+        finally:
+            if cache_budget is not None:
+                cache_budget.pinning -= 1
 
     def put_in_cache(self, value, period, extra_params = None):
         simulation = self.entity.simulation
@@ -350,15 +727,18 @@ class Holder(object):
                 simulation.traceback[variable_infos] = dict(
                     holder = self,
                     )
-        array_by_period = self._array_by_period
-        if array_by_period is None:
-            self._array_by_period = array_by_period = {}
+        array_by_period = self.get_writable_array_by_period()
         if extra_params is None:
             array_by_period[period] = value
         else:
             if array_by_period.get(period) is None:
                 array_by_period[period] = {}
             array_by_period[period][tuple(extra_params)] = value
+        if simulation.cache_budget is not None:
+            simulation.cache_budget.add(self, period, extra_params, value)
+            if not self.column.is_permanent:
+                # The array may be evicted by a later computation, before the returned dated holder is read.
+                return DatedHolder(self, period, extra_params, value = self.get_array(period, extra_params))
         return self.get_from_cache(period, extra_params)
 
     def get_from_cache(self, period, extra_params = None):
@@ -367,6 +747,29 @@ class Holder(object):
     def get_extra_param_names(self):
         return self.formula.function.__func__.func_code.co_varnames[3:]
 
+    def sum_known_months(self, start, months_count, dtype = None):
+        """Return the sum of the cached arrays of consecutive months, or None when one of them is not cached.
+
+        When dtype is None, the sum has the type of the cached arrays.
+        """
+        array_by_period = self._array_by_period
+        if not array_by_period or months_count <= 0:
+            return None
+        if isinstance(array_by_period, PeriodArrayStore):
+            block = array_by_period.get_months_block(start, months_count)
+            if block is None:
+                return None
+            return block.sum(axis = 0, dtype = dtype or block.dtype)
+        months_array = []
+        month = start.period(u'month')
+        for month_index in xrange(months_count):
+            month_array = array_by_period.get(month)
+            if not isinstance(month_array, np.ndarray):
+                return None
+            months_array.append(month_array)
+            month = month.offset(1)
+        return np.sum(months_array, axis = 0, dtype = dtype or months_array[0].dtype)
+
     def to_value_json(self, use_label = False):
         column = self.column
         transform_dated_value_to_json = column.transform_dated_value_to_json
@@ -402,3 +805,11 @@ class Holder(object):
                         for cell in array_or_dict.tolist()
                         ]
         return value_json
+
+
+def get_month_index(period):
+    """Return the index (year * 12 + month - 1) of a period of exactly one calendar month, or None."""
+    unit, start, size = period
+    if unit != u'month' or size != 1 or start.day != 1:
+        return None
+    return start.year * 12 + start.month - 1
@@ -4,10 +4,14 @@
 """Handle legislative parameters in JSON format."""
 
 
+from bisect import bisect_right
 import collections
 import datetime
+import hashlib
 import itertools
+import json
 import logging
+import threading
 
 from . import conv, periods, taxscales
 
@@ -100,7 +104,7 @@ class CompactNode(object):
         return combined_tax_scales
 
     def copy(self, deep = False):
-        new = self.__class__()
+        new = self.__class__(instant = self.instant, name = self.name)
         for name, value in self.iteritems():
             if deep:
                 if isinstance(value, CompactNode):
@@ -143,13 +147,194 @@ class CompactNode(object):
 
     def update(self, value):
         if isinstance(value, CompactNode):
-            value = value.__dict__
+            # Use iteritems() so that the children of a LazyCompactNode are built.
+            value = dict(value.iteritems())
         return self.__dict__.update(value)
 
     def values(self):
         return self.__dict__.values()
 
 
+class LazyCompactNode(CompactNode):
+    """A CompactNode whose children are built from the legislation JSON only when they are accessed.
+
+    Created by lazy_compact_node_json. The children defined at the instant of the node are known from the start, so
+    that accessing a missing parameter raises ParameterNotFound, like with a CompactNode. Iterating over the node
+    builds all its children. Copies are plain CompactNodes.
+    """
+    # Use slots to keep the lazy state out of __dict__, which holds the (built) legislation attributes.
+    __slots__ = ('_instant_str', '_node_json', '_traced_simulation', '_unresolved_keys')
+
+    def __delitem__(self, key):
+        self._unresolved_keys.discard(key)
+        self.__dict__.pop(key, None)
+
+    def __getattr__(self, key):
+        if key in self._unresolved_keys:
+            return self._resolve(key)
+        return CompactNode.__getattr__(self, key)
+
+    def __getitem__(self, key):
+        if key in self._unresolved_keys:
+            return self._resolve(key)
+        return self.__dict__[key]
+
+    def __init__(self, node_json, instant, instant_str, name = None, traced_simulation = None):
+        # Set the lazy state first, because __setattr__ uses it.
+        self._instant_str = instant_str
+        self._node_json = node_json
+        self._traced_simulation = traced_simulation
+        self._unresolved_keys = set(
+            key
+            for key, child_json in node_json['children'].iteritems()
+            if is_node_json_dated(child_json, instant_str)
+            )
+        CompactNode.__init__(self, instant, name = name)
+
+    def __iter__(self):
+        self.resolve_all()
+        return CompactNode.__iter__(self)
+
+    def __repr__(self):
+        self.resolve_all()
+        return CompactNode.__repr__(self)
+
+    def __setattr__(self, key, value):
+        CompactNode.__setattr__(self, key, value)
+        if key not in LazyCompactNode.__slots__:
+            # The assigned value replaces the parameter which is not built yet.
+            self._unresolved_keys.discard(key)
+
+    def __setitem__(self, key, value):
+        self._unresolved_keys.discard(key)
+        self.__dict__[key] = value
+
+    def _resolve(self, key):
+        child_json = self._node_json['children'][key]
+        if child_json['@type'] == u'Node':
+            # Like compact_dated_node_json, give the full name of nodes only when they are traced.
+            child_parent_codes = self.name.split(u'.') \
+                if self._traced_simulation is not None and self.name is not None \
+                else None
+            value = lazy_compact_node_json(child_json, instant = self.instant, instant_str = self._instant_str,
+                code = key, parent_codes = child_parent_codes, traced_simulation = self._traced_simulation)
+        else:
+            value = compact_dated_node_json(generate_dated_node_json(child_json, self._instant_str), code = key,
+                instant = self.instant)
+        self.__dict__[key] = value
+        self._unresolved_keys.discard(key)
+        return value
+
+    def copy(self, deep = False):
+        self.resolve_all()
+        new = CompactNode(instant = self.instant, name = self.name)
+        new.update(self)
+        return new.copy(deep = True) if deep else new
+
+    def get(self, key, default = None):
+        if key in self._unresolved_keys:
+            return self._resolve(key)
+        return self.__dict__.get(key, default)
+
+    def items(self):
+        self.resolve_all()
+        return CompactNode.items(self)
+
+    def iteritems(self):
+        self.resolve_all()
+        return CompactNode.iteritems(self)
+
+    def iterkeys(self):
+        self.resolve_all()
+        return CompactNode.iterkeys(self)
+
+    def itervalues(self):
+        self.resolve_all()
+        return CompactNode.itervalues(self)
+
+    def keys(self):
+        self.resolve_all()
+        return CompactNode.keys(self)
+
+    def pop(self, key, default = None):
+        if key in self._unresolved_keys:
+            self._resolve(key)
+        return self.__dict__.pop(key, default)
+
+    def resolve_all(self):
+        for key in list(self._unresolved_keys):
+            self._resolve(key)
+
+    def values(self):
+        self.resolve_all()
+        return CompactNode.values(self)
+
+
+class CopyOnWriteCompactNode(LazyCompactNode):
+    """A LazyCompactNode whose children are taken from a compact node shared with other legislations.
+
+    Returned by cached_compact_node_json, for the nodes of a CompactNodeCache. A child is taken from the shared node
+    when it is first accessed: child nodes are wrapped in turn and tax scales are copied with copy_on_write(), so
+    modifying the legislation never alters the shared nodes. The values of the parameters are shared as is.
+    """
+    __slots__ = ('_shared_node',)
+
+    def __init__(self, shared_node):
+        self._unresolved_keys = set(shared_node.__dict__)
+        self._unresolved_keys.difference_update(('instant', 'name'))
+        self._shared_node = shared_node
+        CompactNode.__init__(self, shared_node.instant, name = shared_node.name)
+
+    def _resolve(self, key):
+        value = self._shared_node.__dict__[key]
+        if isinstance(value, CompactNode):
+            value = CopyOnWriteCompactNode(value)
+        elif isinstance(value, taxscales.AbstractTaxScale):
+            value = value.copy_on_write()
+        self.__dict__[key] = value
+        self._unresolved_keys.discard(key)
+        return value
+
+
+class RecordedCompactNode(object):
+    """A proxy for CompactNode which tells a recorder the dotted names of the parameters read through it.
+
+    Used by Simulation.legislation_at() while a caches.ParametersRecorder is the dependencies tracker of the simulation.
+    Child nodes are wrapped in turn, so that only the parameters (and tax scales) really read are recorded. Other
+    uses of a node (iterating over it, calling its methods, etc) record the node as a whole.
+    """
+    __slots__ = ('compact_node', 'path', 'recorder')
+
+    def __init__(self, compact_node, recorder, path = None):
+        self.compact_node = compact_node
+        self.path = path  # Dotted name of the node, None for the root of the legislation
+        self.recorder = recorder
+
+    def __getattr__(self, key):
+        compact_node = self.compact_node
+        value = getattr(compact_node, key)
+        if key in compact_node.__dict__ and key not in ('instant', 'name'):
+            return self.record(key, value)
+        if self.path is not None:
+            self.recorder.read(self.path)
+        return value
+
+    def __getitem__(self, key):
+        return self.record(key, self.compact_node[key])
+
+    def __iter__(self):
+        if self.path is not None:
+            self.recorder.read(self.path)
+        return iter(self.compact_node)
+
+    def record(self, key, value):
+        path = key if self.path is None else u'.'.join([self.path, key])
+        if isinstance(value, CompactNode):
+            return RecordedCompactNode(value, self.recorder, path = path)
+        self.recorder.read(path)
+        return value
+
+
 class TracedCompactNode(object):
     """
     A proxy for CompactNode which stores the a simulation instance. Used for simulations with trace mode enabled.
@@ -167,7 +352,7 @@ class TracedCompactNode(object):
         self.traced_attributes_name = traced_attributes_name
 
     def __delitem__(self, key):
-        del self.compact_node.__dict__[key]
+        del self.compact_node[key]
 
     # Reminder: __getattr__ is called only when attribute is not found.
     def __getattr__(self, key):
@@ -191,12 +376,97 @@ class TracedCompactNode(object):
         return value
 
     def __getitem__(self, key):
-        return self.compact_node.__dict__[key]
+        return self.compact_node[key]
 
     def __setitem__(self, key, value):
         self.compact_node.__dict__[key] = value
 
 
+class CompactNodeCache(object):
+    """A cache of compact nodes, shared by tax-benefit systems (for example by many variants of a reform).
+
+    The compact nodes are keyed by the digest of the content of their legislation JSON node, so a node which is
+    not modified by a reform is compacted only once per instant.
+    The cached nodes are never given to the tax-benefit systems: cached_compact_node_json wraps them in
+    CopyOnWriteCompactNode objects, which can be modified. When the cache holds more than max_size nodes, the least
+    recently used ones are removed.
+    The cache is locked while it is read or modified, because reading it also moves the node at the end of the LRU
+    order, and formulas computed by several threads build legislations at the same time.
+    """
+    hits_count = 0
+    max_size = None  # Maximum number of cached nodes, None for an unbounded cache
+    misses_count = 0
+
+    def __init__(self, max_size = 10000):
+        assert max_size is None or max_size >= 1, max_size
+        self.max_size = max_size
+        # The data structure of compact_node_by_key is: {(node_digest, instant_str, code): compact_node}
+        # The least recently used nodes come first.
+        self.compact_node_by_key = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, key, compact_node):
+        compact_node_by_key = self.compact_node_by_key
+        with self.lock:
+            compact_node_by_key[key] = compact_node
+            if self.max_size is not None:
+                while len(compact_node_by_key) > self.max_size:
+                    compact_node_by_key.popitem(last = False)
+
+    def clear(self):
+        with self.lock:
+            self.compact_node_by_key.clear()
+
+    def get(self, key):
+        with self.lock:
+            compact_node = self.compact_node_by_key.pop(key, None)
+            if compact_node is None:
+                self.misses_count += 1
+            else:
+                self.hits_count += 1
+                self.compact_node_by_key[key] = compact_node
+        return compact_node
+
+
+class IndexedNodeJson(collections.OrderedDict):
+    """A legislation node JSON returned by index_legislation_json, with the digest of its original content."""
+    digest = None
+
+
+class ValuesTimeline(object):
+    """The dated values of a parameter (or of a bracket item), sorted by start date to be found by bisection.
+
+    Used in place of the list of values JSON by index_legislation_json.
+    """
+    starts = None  # None when the values overlap: they are then scanned in their original order.
+    stops = None
+    values = None
+    values_json = None
+
+    def __init__(self, values_json):
+        self.values_json = values_json
+        sorted_values_json = sorted(values_json, key = lambda value_json: value_json['start'])
+        for value_json, next_value_json in itertools.izip(sorted_values_json, sorted_values_json[1:]):
+            stop_str = value_json.get('stop')
+            if stop_str is None or stop_str >= next_value_json['start']:
+                return
+        self.starts = [value_json['start'] for value_json in sorted_values_json]
+        self.stops = [value_json.get('stop') for value_json in sorted_values_json]
+        self.values = [value_json['value'] for value_json in sorted_values_json]
+
+    def get(self, instant_str):
+        starts = self.starts
+        if starts is None:
+            return generate_dated_json_value(self.values_json, instant_str)
+        index = bisect_right(starts, instant_str) - 1
+        if index < 0:
+            return None
+        stop_str = self.stops[index]
+        if stop_str is not None and stop_str < instant_str:
+            return None
+        return self.values[index]
+
+
 # Functions
 
 
@@ -300,6 +570,8 @@ def generate_dated_bracket_json(bracket_json, instant_str):
 
 
 def generate_dated_json_value(values_json, instant_str):
+    if isinstance(values_json, ValuesTimeline):
+        return values_json.get(instant_str)
     for value_json in values_json:
         value_stop_str = value_json.get('stop')
         if value_json['start'] <= instant_str and (value_stop_str is None or instant_str <= value_stop_str):
@@ -360,6 +632,164 @@ def generate_dated_node_json(node_json, instant_str):
     return dated_node_json
 
 
+def get_changed_parameters_name(legislation_json, other_legislation_json, path = None):
+    """Return the set of the dotted names of the parameters differing between two legislation JSONs.
+
+    A node that exists in only one of the legislations is named as a whole.
+    """
+    if legislation_json is other_legislation_json:
+        return set()
+    if legislation_json.get('@type') == other_legislation_json.get('@type') == u'Node':
+        children = legislation_json.get('children') or {}
+        other_children = other_legislation_json.get('children') or {}
+        changed_parameters_name = set()
+        for name in set(children).union(other_children):
+            child_path = name if path is None else u'{}.{}'.format(path, name)
+            child = children.get(name)
+            other_child = other_children.get(name)
+            if child is None or other_child is None:
+                changed_parameters_name.add(child_path)
+            else:
+                changed_parameters_name.update(get_changed_parameters_name(child, other_child, path = child_path))
+        return changed_parameters_name
+    if legislation_json == other_legislation_json:
+        return set()
+    return set([path])
+
+
+def is_node_json_dated(node_json, instant_str):
+    """Tell whether generate_dated_node_json would return a dated node (instead of None), without generating it."""
+    children_json = node_json.get('children')
+    if children_json is not None:
+        return any(
+            is_node_json_dated(child_json, instant_str)
+            for child_json in children_json.itervalues()
+            )
+    brackets_json = node_json.get('brackets')
+    if brackets_json is not None and not brackets_json:
+        return False
+    values_json = node_json.get('values')
+    if values_json is not None:
+        return generate_dated_json_value(values_json, instant_str) is not None
+    return True
+
+
+def is_same_parameter_or_node(parameter_name, other_parameter_name):
+    """Tell whether two dotted names designate the same parameter, or a node and a parameter (or node) it contains."""
+    return parameter_name == other_parameter_name or parameter_name.startswith(other_parameter_name + u'.') \
+        or other_parameter_name.startswith(parameter_name + u'.')
+
+
+def lazy_compact_node_json(node_json, instant, instant_str = None, code = None, parent_codes = None,
+        traced_simulation = None):
+    """
+    Return a LazyCompactNode for a legislation node JSON (not dated, possibly indexed) at the given instant.
+
+    The result behaves like compact_dated_node_json(generate_dated_legislation_json(node_json, instant)), but the
+    parameters are only dated and compacted when they are accessed.
+    """
+    if instant_str is None:
+        instant = periods.instant(instant)
+        instant_str = str(instant)
+    name = u'.'.join((parent_codes or []) + [code]) \
+        if code is not None \
+        else None
+    compact_node = LazyCompactNode(node_json, instant, instant_str, name = name,
+        traced_simulation = traced_simulation)
+    if traced_simulation is not None:
+        traced_children_code = [
+            key
+            for key in compact_node._unresolved_keys
+            if node_json['children'][key]['@type'] != u'Node'
+            ]
+        # Only trace Nodes which have at least one Parameter child.
+        if traced_children_code:
+            compact_node = TracedCompactNode(
+                compact_node = compact_node,
+                simulation = traced_simulation,
+                traced_attributes_name = traced_children_code,
+                )
+    return compact_node
+
+
+def cached_compact_node_json(node_json, instant, compact_node_cache, instant_str = None, code = None):
+    """
+    Compact a node of an indexed legislation JSON, reusing the compact nodes of compact_node_cache.
+
+    The result is the same as compact_dated_node_json(generate_dated_legislation_json(node_json, instant)). It shares
+    the cached nodes until it is modified (see CopyOnWriteCompactNode), so it can be modified without altering the
+    legislation of the other tax-benefit systems.
+    """
+    if instant_str is None:
+        instant = periods.instant(instant)
+        instant_str = str(instant)
+    return CopyOnWriteCompactNode(get_cached_compact_node(node_json, instant, instant_str, compact_node_cache,
+        code = code))
+
+
+def get_cached_compact_node(node_json, instant, instant_str, compact_node_cache, code = None):
+    """Return the compact node of compact_node_cache for a node of an indexed legislation JSON, compacting it if needed.
+
+    The returned node is shared by the tax-benefit systems using the cache: it must not be modified.
+    """
+    key = (node_json.digest, instant_str, code)
+    compact_node = compact_node_cache.get(key)
+    if compact_node is None:
+        compact_node = CompactNode(instant = instant, name = code)
+        for child_code, child_json in node_json['children'].iteritems():
+            if child_json['@type'] == u'Node':
+                if is_node_json_dated(child_json, instant_str):
+                    compact_node.__dict__[child_code] = get_cached_compact_node(child_json, instant, instant_str,
+                        compact_node_cache, code = child_code)
+            else:
+                dated_child_json = generate_dated_node_json(child_json, instant_str)
+                if dated_child_json is not None:
+                    compact_node.__dict__[child_code] = compact_dated_node_json(dated_child_json, code = child_code,
+                        instant = instant)
+        compact_node_cache.add(key, compact_node)
+    return compact_node
+
+
+def index_legislation_json(node_json):
+    """Return a copy of a legislation JSON whose lists of dated values are replaced with ValuesTimeline objects.
+
+    The result can be given to generate_dated_legislation_json instead of the legislation JSON, to find the value of
+    each parameter at an instant by bisection. Each node of the result has the digest of its original content.
+    """
+    indexed_node_json = IndexedNodeJson()
+    children_digest = None
+    for key, value in node_json.iteritems():
+        if key == 'children':
+            indexed_node_json[key] = type(value)(
+                (child_code, index_legislation_json(child_json))
+                for child_code, child_json in value.iteritems()
+                )
+            children_digest = [
+                (child_code, indexed_child_json.digest)
+                for child_code, indexed_child_json in sorted(indexed_node_json[key].iteritems())
+                ]
+        elif key == 'brackets':
+            indexed_node_json[key] = [
+                collections.OrderedDict(
+                    (bracket_key, ValuesTimeline(bracket_value)
+                        if bracket_key in ('amount', 'base', 'rate', 'threshold') else bracket_value)
+                    for bracket_key, bracket_value in bracket_json.iteritems()
+                    )
+                for bracket_json in value
+                ]
+        elif key == 'values':
+            indexed_node_json[key] = ValuesTimeline(value)
+        else:
+            indexed_node_json[key] = value
+    content = [
+        (key, value)
+        for key, value in sorted(node_json.iteritems())
+        if key != 'children'
+        ]
+    indexed_node_json.digest = hashlib.sha1(json.dumps([content, children_digest], default = unicode)).hexdigest()
+    return indexed_node_json
+
+
 # Level-1 Converters
 
 
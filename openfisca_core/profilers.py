@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+
+"""Measure which formulas dominate the calculation time of a simulation.
+
+A Profiler is enabled by setting it as the profiler of a simulation:
+
+    simulation.profiler = profiler = profilers.Profiler()
+    simulation.calculate('revenu_disponible')
+    print profiler.format_report(sort_by = 'self_seconds')
+    profiler.write_folded_stacks('revenu_disponible.folded')
+
+The folded stacks file can be given to flamegraph.pl (https://github.com/brendangregg/FlameGraph).
+"""
+
+
+import collections
+import time
+
+
+# Columns of the report, in order. All of them, but the variable name and the period, can be used to sort it.
+report_columns_name = (
+    'variable_name',
+    'period',
+    'calls',
+    'cache_hits',
+    'cache_misses',
+    'inclusive_seconds',
+    'self_seconds',
+    'bytes',
+    )
+
+
+class Profile(object):
+    """The measures of the formula calls of a (variable_name, period)."""
+    __slots__ = ('bytes', 'cache_hits', 'cache_misses', 'calls', 'inclusive_seconds', 'self_seconds')
+
+    def __init__(self):
+        self.bytes = 0  # Sum of the sizes of the arrays returned by the formula calls
+        self.cache_hits = 0  # Number of requests of the holder found in cache
+        self.cache_misses = 0  # Number of requests of the holder not found in cache
+        self.calls = 0  # Number of formula calls, including the additions of periods made by compute_add()
+        self.inclusive_seconds = 0.0  # Time spent in the formula calls, including the formula calls they made
+        self.self_seconds = 0.0  # Time spent in the formula calls, excluding the formula calls they made
+
+
+class Profiler(object):
+    """Measure the formula calls of a simulation, for each (variable_name, period).
+
+    Called by the formulas (enter() and exit()) and by the holders (hit() and miss()) when it is the profiler of their
+    simulation.
+    """
+
+    def __init__(self):
+        # The data structure of frames is: [[variable names path, start time, seconds spent in formula calls made]]
+        self.frames = []
+        self.profile_by_key = {}
+        # The data structure of self_seconds_by_path is: {(variable_name1, variable_name2, ...): self seconds}
+        self.self_seconds_by_path = {}
+
+    def enter(self, variable_name, period):
+        frames = self.frames
+        path = frames[-1][0] + (variable_name,) if frames else (variable_name,)
+        frames.append([path, time.time(), 0.0])
+
+    def exit(self, variable_name, period, array = None):
+        """End the current formula call. The array is None when the formula call failed."""
+        path, start_time, children_seconds = self.frames.pop()
+        assert path[-1] == variable_name, (path, variable_name)
+        inclusive_seconds = time.time() - start_time
+        self_seconds = inclusive_seconds - children_seconds
+        if self.frames:
+            self.frames[-1][2] += inclusive_seconds
+        profile = self.get_profile(variable_name, period)
+        profile.calls += 1
+        profile.inclusive_seconds += inclusive_seconds
+        profile.self_seconds += self_seconds
+        if array is not None:
+            profile.bytes += array.nbytes
+        self_seconds_by_path = self.self_seconds_by_path
+        self_seconds_by_path[path] = self_seconds_by_path.get(path, 0.0) + self_seconds
+
+    def format_report(self, sort_by = 'self_seconds', by_variable = False, limit = None):
+        """Return the report (see get_report()) as a text table."""
+        rows = [
+            [
+                u'' if value is None else u'{:.6f}'.format(value) if isinstance(value, float) else unicode(value)
+                for value in (row[column_name] for column_name in report_columns_name)
+                ]
+            for row in self.get_report(sort_by = sort_by, by_variable = by_variable, limit = limit)
+            ]
+        rows.insert(0, list(report_columns_name))
+        widths = [
+            max(len(row[index]) for row in rows)
+            for index in range(len(report_columns_name))
+            ]
+        return u'\n'.join(
+            u'  '.join(
+                cell.ljust(width) if index < 2 else cell.rjust(width)
+                for index, (cell, width) in enumerate(zip(row, widths))
+                ).rstrip()
+            for row in rows
+            )
+
+    def get_profile(self, variable_name, period):
+        key = (variable_name, period)
+        profile = self.profile_by_key.get(key)
+        if profile is None:
+            self.profile_by_key[key] = profile = Profile()
+        return profile
+
+    def get_report(self, sort_by = 'self_seconds', by_variable = False, limit = None):
+        """Return a list of ordered dicts, one for each (variable_name, period), sorted by decreasing sort_by column.
+
+        When by_variable is True, the measures of the periods of each variable are added, and the period is None.
+        """
+        assert sort_by in report_columns_name[2:], sort_by
+        rows_by_key = collections.OrderedDict()
+        for (variable_name, period), profile in self.profile_by_key.iteritems():
+            key = variable_name if by_variable else (variable_name, period)
+            row = rows_by_key.get(key)
+            if row is None:
+                rows_by_key[key] = row = collections.OrderedDict(
+                    (column_name, 0)
+                    for column_name in report_columns_name
+                    )
+                row['variable_name'] = variable_name
+                row['period'] = None if by_variable else period
+            for column_name in report_columns_name[2:]:
+                row[column_name] += getattr(profile, column_name)
+        rows = sorted(rows_by_key.itervalues(), key = lambda row: row[sort_by], reverse = True)
+        return rows if limit is None else rows[:limit]
+
+    def hit(self, variable_name, period):
+        self.get_profile(variable_name, period).cache_hits += 1
+
+    def miss(self, variable_name, period):
+        self.get_profile(variable_name, period).cache_misses += 1
+
+    def write_folded_stacks(self, file_or_path):
+        """Write the self time of each stack of formula calls in microseconds, in the folded format of FlameGraph.
+
+        Each line is like "revenu_disponible;rsa;salaire_imposable 1234".
+        """
+        if isinstance(file_or_path, basestring):
+            with open(file_or_path, 'w') as folded_file:
+                return self.write_folded_stacks(folded_file)
+        for path, self_seconds in sorted(self.self_seconds_by_path.iteritems()):
+            file_or_path.write(u'{} {}\n'.format(u';'.join(path), int(round(self_seconds * 1e6))).encode('utf-8'))
@@ -3,6 +3,8 @@
 import copy
 import collections
 
+import numpy as np
+
 from . import legislations, periods
 from taxbenefitsystems import TaxBenefitSystem
 
@@ -25,8 +27,11 @@ class Reform(TaxBenefitSystem):
     def __init__(self, reference):
         self.entity_class_by_key_plural = reference.entity_class_by_key_plural
         self._legislation_json = reference.get_legislation()
+        self._indexed_legislation = reference._indexed_legislation
         self.compact_legislation_by_instant_cache = reference.compact_legislation_by_instant_cache
+        self.compact_node_cache = reference.compact_node_cache
         self.column_by_name = reference.column_by_name.copy()
+        self.dependencies_by_variable_name = reference.dependencies_by_variable_name.copy()
         self.Scenario = reference.Scenario
         self.reference = reference
         self.key = unicode(self.__class__.__name__)
@@ -34,6 +39,28 @@ class Reform(TaxBenefitSystem):
             raise Exception("Reform {} must define an `apply` function".format(self.key))
         self.apply()
 
+    def calculate_deltas(self, reference_simulation, variables_periods, **parameters):
+        """Calculate variables with the reform and return an ordered dict {(variable_name, period): delta}.
+
+        Each delta is the array of the reform minus the array of the reference simulation. The reform is calculated by
+        a differential simulation (see new_differential_simulation()), created once the reference arrays are in cache.
+        variables_periods is given to Simulation.calculate_many().
+        """
+        reference_array_by_key = reference_simulation.calculate_many(variables_periods, **parameters)
+        simulation = self.new_differential_simulation(reference_simulation)
+        try:
+            array_by_key = simulation.calculate_many(variables_periods, **parameters)
+        finally:
+            simulation.release()
+        delta_by_key = collections.OrderedDict()
+        for key, reference_array in reference_array_by_key.iteritems():
+            array = array_by_key[key]
+            if array.dtype == np.bool_:
+                array = array.astype(np.int8)
+                reference_array = reference_array.astype(np.int8)
+            delta_by_key[key] = array - reference_array
+        return delta_by_key
+
     @property
     def full_key(self):
         key = self.key
@@ -43,6 +70,55 @@ class Reform(TaxBenefitSystem):
             key = u'.'.join([reference_full_key, key])
         return key
 
+    def get_affected_variables_name(self, reference_tax_benefit_system = None):
+        """Return the names of the variables whose values may differ between the reform and a reference.
+
+        The reference is the tax-benefit system the reform is built on, by default. Affected variables are the
+        variables whose column differs (see update_variable() and neutralize_column()), the variables using a parameter
+        that differs (see modify_legislation_json()) and, transitively, the variables using them. The dependencies are
+        found statically (see dependencies.py): when they are unknown, for example when the formula gives the
+        simulation to another function, the variable is affected as soon as something differs.
+        """
+        if reference_tax_benefit_system is None:
+            reference_tax_benefit_system = self.reference
+        column_by_name = self.column_by_name
+        reference_column_by_name = reference_tax_benefit_system.column_by_name
+        affected_variables_name = set(
+            variable_name
+            for variable_name in set(column_by_name).union(reference_column_by_name)
+            if column_by_name.get(variable_name) is not reference_column_by_name.get(variable_name)
+            )
+        changed_parameters_name = legislations.get_changed_parameters_name(self.get_legislation(),
+            reference_tax_benefit_system.get_legislation())
+
+        # The data structure of consumers_name_by_variable_name is: {variable_name: set of variables using it}
+        consumers_name_by_variable_name = {}
+        unknown_variables_name = []  # Variables whose input variables are unknown
+        for variable_name, (input_variables_name, parameters_name) in \
+                self.dependencies_by_variable_name.iteritems():
+            if input_variables_name is None:
+                unknown_variables_name.append(variable_name)
+            else:
+                for input_variable_name in input_variables_name:
+                    consumers_name_by_variable_name.setdefault(input_variable_name, set()).add(variable_name)
+            if changed_parameters_name and (parameters_name is None or any(
+                    legislations.is_same_parameter_or_node(parameter_name, changed_parameter_name)
+                    for parameter_name in parameters_name
+                    for changed_parameter_name in changed_parameters_name
+                    )):
+                affected_variables_name.add(variable_name)
+        if affected_variables_name:
+            affected_variables_name.update(unknown_variables_name)
+
+        variables_name_to_visit = list(affected_variables_name)
+        while variables_name_to_visit:
+            variable_name = variables_name_to_visit.pop()
+            for consumer_name in consumers_name_by_variable_name.get(variable_name, ()):
+                if consumer_name not in affected_variables_name:
+                    affected_variables_name.add(consumer_name)
+                    variables_name_to_visit.append(consumer_name)
+        return affected_variables_name
+
     def modify_legislation_json(self, modifier_function):
         """
         Copy the reference TaxBenefitSystem legislation_json attribute and return it.
@@ -64,6 +140,43 @@ class Reform(TaxBenefitSystem):
         self._legislation_json = reform_legislation_json
         self.compact_legislation_by_instant_cache = {}
 
+    def new_differential_simulation(self, reference_simulation):
+        """Return a simulation of the reform, reusing the arrays already calculated by a reference simulation.
+
+        The new simulation is a clone of the reference simulation, whose holders share their arrays with the reference
+        (see Holder.clone()). Only the holders of the variables affected by the reform (see
+        get_affected_variables_name()) are replaced, so that only these variables are calculated again.
+        The input arrays of the variables whose column differs are given again to set_input, while the input variables
+        whose column is the same keep their arrays.
+        """
+        reference_tax_benefit_system = reference_simulation.tax_benefit_system
+        affected_variables_name = self.get_affected_variables_name(reference_tax_benefit_system)
+        simulation = reference_simulation.clone()
+        simulation.tax_benefit_system = self
+        simulation.compact_legislation_by_instant_cache = {}
+        holder_by_name = simulation.holder_by_name
+        input_variables_name = simulation.input_variables_name
+        for variable_name in affected_variables_name:
+            holder = holder_by_name.get(variable_name)
+            if holder is None:
+                continue
+            if variable_name in input_variables_name and \
+                    holder.column is self.column_by_name.get(variable_name):
+                continue
+            del holder_by_name[variable_name]
+            if variable_name in input_variables_name:
+                new_holder = simulation.new_holder(variable_name)
+                if new_holder.column.is_permanent:
+                    if holder._array is not None:
+                        new_holder.array = holder._array
+                elif holder._array_by_period is not None:
+                    for period, values in holder._array_by_period.items():
+                        if type(values) != dict:
+                            new_holder.set_input(period, values)
+            # Drop the references to the arrays (and their entries in the cache budget).
+            holder.delete_arrays()
+        return simulation
+
 
 def update_legislation(legislation_json, path, period = None, value = None, start = None, stop = None):
     """
@@ -65,10 +65,7 @@ class AbstractScenario(object):
                     for period, array in array_by_period.iteritems():
                         if entity.count == 0:
                             entity.count = len(array)
-                        if use_set_input_hooks:
-                            holder.set_input(period, array)
-                        else:
-                            holder.put_in_cache(array, period)
+                        holder.set_input(period, array, use_hook = use_set_input_hooks)
 
             if persons.count == 0:
                 persons.count = 1
@@ -174,10 +171,7 @@ class AbstractScenario(object):
                             array = np.fromiter(variable_values_iter, dtype = column.dtype) \
                                 if column.dtype is not object \
                                 else np.array(list(variable_values_iter), dtype = column.dtype)
-                            if use_set_input_hooks:
-                                holder.set_input(variable_period, array)
-                            else:
-                                holder.put_in_cache(array, variable_period)
+                            holder.set_input(variable_period, array, use_hook = use_set_input_hooks)
 
             if self.axes is not None:
                 if len(self.axes) == 1:
@@ -195,10 +189,7 @@ class AbstractScenario(object):
                             array = np.empty(axis_entity.count, dtype = column.dtype)
                             array.fill(column.default)
                         array[axis['index']:: axis_entity.step_size] = np.linspace(axis['min'], axis['max'], axis_count)
-                        if use_set_input_hooks:
-                            holder.set_input(axis_period, array)
-                        else:
-                            holder.put_in_cache(array, axis_period)
+                        holder.set_input(axis_period, array, use_hook = use_set_input_hooks)
                 else:
                     axes_linspaces = [
                         np.linspace(0, first_axis['count'] - 1, first_axis['count'])
@@ -223,10 +214,7 @@ class AbstractScenario(object):
                                 array.fill(column.default)
                             array[axis['index']:: axis_entity.step_size] = axis['min'] \
                                 + mesh.reshape(steps_count) * (axis['max'] - axis['min']) / (axis_count - 1)
-                            if use_set_input_hooks:
-                                holder.set_input(axis_period, array)
-                            else:
-                                holder.put_in_cache(array, axis_period)
+                            holder.set_input(axis_period, array, use_hook = use_set_input_hooks)
 
     def init_from_attributes(self, repair = False, **attributes):
         conv.check(self.make_json_or_python_to_attributes(repair = repair))(attributes)
@@ -339,7 +327,7 @@ class AbstractScenario(object):
         return json_to_instance
 
     def new_simulation(self, debug = False, debug_all = False, reference = False, trace = False,
-            use_set_input_hooks = True, opt_out_cache = False):
+            use_set_input_hooks = True, opt_out_cache = False, period_store = False, cache_max_bytes = None):
         assert isinstance(reference, (bool, int)), \
             'Parameter reference must be a boolean. When True, the reference tax-benefit system is used.'
         tax_benefit_system = self.tax_benefit_system
@@ -356,6 +344,8 @@ class AbstractScenario(object):
             tax_benefit_system = tax_benefit_system,
             trace = trace,
             opt_out_cache = opt_out_cache,
+            period_store = period_store,
+            cache_max_bytes = cache_max_bytes,
             )
         self.fill_simulation(simulation, use_set_input_hooks = use_set_input_hooks)
         return simulation
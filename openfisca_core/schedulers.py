@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+
+"""Compute the independent variables of a simulation concurrently, in a pool of threads.
+
+Most NumPy operations on big arrays release the GIL, so formulas working on different holders can run at the same
+time. The requested variables are grouped using the graph of the variables (see Simulation.graph()): two variables
+sharing a calculated dependency are computed in the same thread, one after the other.
+"""
+
+
+from multiprocessing.pool import ThreadPool
+import threading
+import time
+
+
+class ThreadLocalCycleDetectionState(threading.local):
+    """The formula calls being run by each thread (see simulations.CycleDetectionState)."""
+
+    def __init__(self):
+        self.active_formula_keys = set()
+        self.depth_by_variable_name = {}
+        self.max_nb_cycles = None
+
+
+def compute_in_threads(simulation, keys, threads, get_input_variables_and_parameters, timing_by_variable_name = None,
+        **parameters):
+    """Compute the given (variable_name, period) keys and return a dict {key: dated_holder}.
+
+    The groups of keys returned by get_independent_keys_groups() are computed by a pool of threads. Meanwhile, each
+    thread detects cycles in its own formula calls.
+    get_input_variables_and_parameters must give every variable used by each formula, because a variable computed by
+    two threads at the same time may lose its cached arrays.
+    """
+    assert threads >= 1, threads
+    assert not simulation.debug and not simulation.trace, "Threads can't be used to debug or trace a simulation"
+    assert simulation.cache_budget is None, "Threads can't be used with a cache budget"
+    assert simulation.dependencies_tracker is None, "Threads can't be used while recording or releasing dependencies"
+    assert not simulation.period_store, "Threads can't be used with period stores"
+    assert simulation.profiler is None, "Threads can't be used to profile a simulation"
+
+    def compute_keys(group_keys):
+        dated_holder_by_key = {}
+        seconds_by_key = {}
+        for column_name, period in group_keys:
+            start_time = time.time()
+            dated_holder_by_key[(column_name, period)] = simulation.compute(column_name, period = period,
+                **parameters)
+            seconds_by_key[(column_name, period)] = time.time() - start_time
+        return dated_holder_by_key, seconds_by_key
+
+    keys_groups = get_independent_keys_groups(simulation, keys, get_input_variables_and_parameters)
+    if threads == 1 or len(keys_groups) <= 1:
+        results = [compute_keys(group_keys) for group_keys in keys_groups]
+    else:
+        cycle_detection_state = simulation.cycle_detection_state
+        simulation.cycle_detection_state = ThreadLocalCycleDetectionState()
+        simulation.holders_lock = threading.Lock()
+        pool = ThreadPool(min(threads, len(keys_groups)))
+        try:
+            # Start with the biggest groups, to end with a balanced load.
+            results = pool.map(compute_keys, sorted(keys_groups, key = len, reverse = True), chunksize = 1)
+        finally:
+            pool.close()
+            pool.join()
+            del simulation.holders_lock
+            simulation.cycle_detection_state = cycle_detection_state
+
+    dated_holder_by_key = {}
+    for group_dated_holder_by_key, seconds_by_key in results:
+        dated_holder_by_key.update(group_dated_holder_by_key)
+        if timing_by_variable_name is not None:
+            for (column_name, period), seconds in seconds_by_key.iteritems():
+                timing_by_variable_name[column_name] = timing_by_variable_name.get(column_name, 0) + seconds
+    return dated_holder_by_key
+
+
+def get_independent_keys_groups(simulation, keys, get_input_variables_and_parameters):
+    """Split the (variable_name, period) keys in groups that can be computed at the same time.
+
+    Two keys are in the same group when their variables use (directly or not) the same variable, unless the latter
+    has its arrays given by set_input: input arrays are only read. The groups keep the order of the keys.
+    When the input variables of a formula are unknown (None), all the keys are put in a single group, computed
+    sequentially.
+    """
+    # The data structure of unknown_variables_name is: [name of a variable whose input variables are unknown]
+    unknown_variables_name = []
+
+    def get_known_input_variables_and_parameters(column):
+        variables_name, parameters_name = get_input_variables_and_parameters(column)
+        if variables_name is None:
+            unknown_variables_name.append(column.name)
+        return variables_name, parameters_name
+
+    input_variables_name = simulation.input_variables_name
+    position_by_key = dict((key, position) for position, key in enumerate(keys))
+    # The data structure of group_index_by_variable_name is: {variable_name: index of its first group in groups}
+    group_index_by_variable_name = {}
+    groups = []
+    for key in keys:
+        nodes = []
+        simulation.graph(key[0], [], get_known_input_variables_and_parameters, nodes, set())
+        if unknown_variables_name:
+            return [list(keys)]
+        variables_name = set(
+            node['id']
+            for node in nodes
+            if node['id'] == key[0] or node['id'] not in input_variables_name
+            )
+        # Merge the groups sharing a variable with this key.
+        groups_index = sorted(set(
+            group_index_by_variable_name[variable_name]
+            for variable_name in variables_name
+            if variable_name in group_index_by_variable_name
+            ))
+        if groups_index:
+            group_index = groups_index[0]
+            group_keys, group_variables_name = groups[group_index]
+            for other_group_index in groups_index[1:]:
+                other_group_keys, other_group_variables_name = groups[other_group_index]
+                group_keys.extend(other_group_keys)
+                group_variables_name.update(other_group_variables_name)
+                groups[other_group_index] = None
+            group_keys.append(key)
+            group_variables_name.update(variables_name)
+        else:
+            group_index = len(groups)
+            groups.append(([key], variables_name))
+            group_variables_name = variables_name
+        for variable_name in group_variables_name:
+            group_index_by_variable_name[variable_name] = group_index
+    return [
+        sorted(group[0], key = position_by_key.get)
+        for group in groups
+        if group is not None
+        ]
+
+
+def new_input_variables_getter(consumer_keys_by_variable_name):
+    """Return a get_input_variables_and_parameters function using the dependencies recorded by a simulation.
+
+    consumer_keys_by_variable_name is the result of Simulation.record_dependencies(). Parameters are not recorded.
+    The variables used by other variables, but using none, have no input variables. The input variables of the other
+    variables, which were not calculated while recording, are unknown (None).
+    """
+    input_variables_name_by_variable_name = dict(
+        (variable_name, set())
+        for variable_name in consumer_keys_by_variable_name
+        )
+    for variable_name, consumer_keys in consumer_keys_by_variable_name.iteritems():
+        for consumer_variable_name, period in consumer_keys:
+            input_variables_name_by_variable_name.setdefault(consumer_variable_name, set()).add(variable_name)
+
+    def get_input_variables_and_parameters(column):
+        return input_variables_name_by_variable_name.get(column.name), None
+
+    return get_input_variables_and_parameters
@@ -14,7 +14,7 @@ import time
 import numpy as np
 from numpy.core.defchararray import startswith
 
-from openfisca_core import periods, simulations
+from openfisca_core import periods, profilers, schedulers, simulations
 from openfisca_core.columns import BoolCol, DateCol, FixedStrCol, FloatCol, IntCol
 from openfisca_core.entities import AbstractEntity
 from openfisca_core.formulas import dated_function
@@ -149,7 +149,7 @@ class revenu_disponible(Variable):
 
     def function(self, simulation, period):
         period = period.start.period(u'year').offset('first-of')
-        rsa = simulation.calculate('rsa', period)
+        rsa = simulation.calculate_add('rsa', period)
         salaire_imposable = simulation.calculate('salaire_imposable', period)
         return period, rsa + salaire_imposable * 0.7
 
@@ -169,19 +169,19 @@ class rsa(DatedVariable):
     @dated_function(datetime.date(2010, 1, 1))
     def function_2010(self, simulation, period):
         period = period.start.period(u'month').offset('first-of')
-        salaire_imposable = simulation.calculate('salaire_imposable', period)
+        salaire_imposable = simulation.calculate_divide('salaire_imposable', period)
         return period, (salaire_imposable < 500) * 100.0
 
     @dated_function(datetime.date(2011, 1, 1), datetime.date(2012, 12, 31))
     def function_2011_2012(self, simulation, period):
         period = period.start.period(u'month').offset('first-of')
-        salaire_imposable = simulation.calculate('salaire_imposable', period)
+        salaire_imposable = simulation.calculate_divide('salaire_imposable', period)
         return period, (salaire_imposable < 500) * 200.0
 
     @dated_function(datetime.date(2013, 1, 1))
     def function_2013(self, simulation, period):
         period = period.start.period(u'month').offset('first-of')
-        salaire_imposable = simulation.calculate('salaire_imposable', period)
+        salaire_imposable = simulation.calculate_divide('salaire_imposable', period)
         return period, (salaire_imposable < 500) * 300
 
 
@@ -241,8 +241,83 @@ def check_revenu_disponible(year, depcom, expected_revenu_disponible):
     # assert_near(revenu_disponible_famille, expected_revenu_disponible_famille, absolute_error_margin = 0.005)
 
 
+def new_big_simulation(year, count):
+    random_state = np.random.RandomState(0)
+    simulation = simulations.Simulation(period = periods.period(year), tax_benefit_system = tax_benefit_system)
+    famille = simulation.entity_by_key_singular["famille"]
+    famille.count = count
+    famille.roles_count = 2
+    famille.step_size = 1
+    individu = simulation.entity_by_key_singular["individu"]
+    individu.count = 2 * count
+    individu.step_size = 2
+    period = simulation.period
+    birth_days = random_state.randint(0, 25000, size = 2 * count).astype('timedelta64[D]')
+    simulation.get_or_new_holder("birth").set_input(period, np.datetime64('1940-01-01') + birth_days)
+    simulation.get_or_new_holder("depcom").set_input(period,
+        np.where(random_state.randint(0, 10, size = count) == 0, '97123', '75101'))
+    simulation.get_or_new_holder("id_famille").set_input(period, np.arange(2 * count) // 2)
+    simulation.get_or_new_holder("role_dans_famille").set_input(period, np.tile([PARENT1, PARENT2], count))
+    simulation.get_or_new_holder("salaire_brut").set_input(period, random_state.uniform(0, 100000, size = 2 * count))
+    return simulation
+
+
+def measure_cycle_detection(year, count):
+    """Measure the cycle detection done around each formula call (check_for_cycle then clean_cycle_detection_data)."""
+    simulation = new_big_simulation(year, 1)
+    formula = simulation.get_or_new_holder('salaire_net').formula
+    period = simulation.period
+    check_for_cycle = formula.check_for_cycle
+    clean_cycle_detection_data = formula.clean_cycle_detection_data
+    start_time = time.time()
+    for _ in xrange(count):
+        check_for_cycle(period)
+        clean_cycle_detection_data(period)
+    print 'Cycle detection: {:2.3f} us per formula call'.format((time.time() - start_time) * 1e6 / count)
+
+
+def measure_profile(year, count):
+    """Print the formulas sorted by decreasing self time, and write their folded stacks when requested."""
+    simulation = new_big_simulation(year, count)
+    simulation.profiler = profiler = profilers.Profiler()
+    simulation.calculate('revenu_disponible_famille')
+    print profiler.format_report(sort_by = 'self_seconds', by_variable = True).encode('utf-8')
+    if args.folded_stacks is not None:
+        profiler.write_folded_stacks(args.folded_stacks)
+
+
+def measure_threads(year, count, threads):
+    """Compare the sequential and the threaded computation of independent variables."""
+    variables_name = ['age', 'dom_tom_individu', 'revenu_disponible_famille']
+    consumer_keys_by_variable_name = new_big_simulation(year, 1).record_dependencies(variables_name)
+    get_input_variables_and_parameters = schedulers.new_input_variables_getter(consumer_keys_by_variable_name)
+    simulation = new_big_simulation(year, count)
+    start_time = time.time()
+    expected_array_by_key = simulation.calculate_many(variables_name)
+    print '{} persons, sequential: {:2.6f} s'.format(2 * count, time.time() - start_time)
+    simulation = new_big_simulation(year, count)
+    start_time = time.time()
+    array_by_key = simulation.calculate_many(variables_name, threads = threads,
+        get_input_variables_and_parameters = get_input_variables_and_parameters)
+    print '{} persons, {} threads: {:2.6f} s'.format(2 * count, threads, time.time() - start_time)
+    for key, array in array_by_key.iteritems():
+        assert (array == expected_array_by_key[key]).all(), key
+
+
 def main():
     parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument('--folded-stacks', default = None,
+        help = "path of the file where the folded stacks of the profile are written, for flamegraph.pl")
+    parser.add_argument('--cycles-count', default = 1000000, type = int,
+        help = "number of formula calls whose cycle detection is measured")
+    parser.add_argument('-p', '--profile', action = 'store_true', default = False,
+        help = "print the time spent by each formula of a big simulation")
+    parser.add_argument('--profile-count', default = 100000, type = int,
+        help = "number of families of the profiled simulation")
+    parser.add_argument('-t', '--threads', default = None, type = int,
+        help = "measure also the computation of independent variables by this number of threads")
+    parser.add_argument('--threads-count', default = 1000000, type = int,
+        help = "number of families of the simulation computed by threads")
     parser.add_argument('-v', '--verbose', action = 'store_true', default = False, help = "increase output verbosity")
     global args
     args = parser.parse_args()
@@ -260,6 +335,12 @@ def main():
     check_revenu_disponible(2012, '98456', np.array([2330.0, 2330.0, 25130.0, 2330.0, 50330.0, 2330.0]))
     check_revenu_disponible(2013, '98456', np.array([3530.0, 3530.0, 25130.0, 3530.0, 50330.0, 3530.0]))
 
+    measure_cycle_detection(2013, args.cycles_count)
+    if args.profile:
+        measure_profile(2013, args.profile_count)
+    if args.threads is not None:
+        measure_threads(2013, args.threads_count, args.threads)
+
 
 if __name__ == "__main__":
     sys.exit(main())
@@ -0,0 +1,109 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+"""
+Measure the calculation of tax scales, and compare it to the previous implementation, which built matrices of size
+array length × number of brackets.
+
+The previous implementation is skipped when its matrices would be bigger than --max-matrix-size items.
+"""
+
+
+from __future__ import division
+
+from contextlib import contextmanager
+import argparse
+import sys
+import time
+
+import numpy as np
+from numpy import maximum as max_, minimum as min_
+
+from openfisca_core import taxscales
+from openfisca_core.tools import assert_near
+
+
+args = None
+
+
+@contextmanager
+def measure_time(title):
+    t1 = time.time()
+    yield
+    t2 = time.time()
+    print(u'{}\t: {:.8f} seconds elapsed'.format(title, t2 - t1).encode('utf-8'))
+
+
+def calc_amount_with_matrices(tax_scale, base):
+    base1 = np.tile(base, (len(tax_scale.thresholds), 1)).T
+    thresholds1 = np.tile(np.hstack((tax_scale.thresholds, np.inf)), (len(base), 1))
+    a = max_(min_(base1, thresholds1[:, 1:]) - thresholds1[:, :-1], 0)
+    return np.dot(tax_scale.amounts, a.T > 0)
+
+
+def calc_linear_average_rate_with_matrices(tax_scale, base):
+    tiled_base = np.tile(base, (len(tax_scale.thresholds) - 1, 1)).T
+    tiled_thresholds = np.tile(tax_scale.thresholds, (len(base), 1))
+    bracket_dummy = (tiled_base >= tiled_thresholds[:, :-1]) * (tiled_base < tiled_thresholds[:, 1:])
+    rates_array = np.array(tax_scale.rates)
+    thresholds_array = np.array(tax_scale.thresholds)
+    rate_slope = (rates_array[1:] - rates_array[:-1]) / (thresholds_array[1:] - thresholds_array[:-1])
+    average_rate_slope = np.dot(bracket_dummy, rate_slope.T)
+    bracket_average_start_rate = np.dot(bracket_dummy, rates_array[:-1])
+    bracket_threshold = np.dot(bracket_dummy, thresholds_array[:-1])
+    return base * (bracket_average_start_rate + (base - bracket_threshold) * average_rate_slope)
+
+
+def calc_marginal_rate_with_matrices(tax_scale, base):
+    base1 = np.tile(base, (len(tax_scale.thresholds), 1)).T
+    factor = np.ones(len(base))
+    thresholds1 = np.outer(factor, np.array(list(tax_scale.thresholds) + [np.inf]))
+    a = max_(min_(base1, thresholds1[:, 1:]) - thresholds1[:, :-1], 0)
+    return np.dot(tax_scale.rates, a.T)
+
+
+def new_tax_scales(brackets_count):
+    thresholds = np.arange(brackets_count) * 1000.
+    amount_tax_scale = taxscales.AmountTaxScale()
+    marginal_tax_scale = taxscales.MarginalRateTaxScale()
+    for index, threshold in enumerate(thresholds):
+        amount_tax_scale.add_bracket(threshold, 10. * (index + 1))
+        marginal_tax_scale.add_bracket(threshold, 0.5 * index / brackets_count)
+    return (
+        (amount_tax_scale, calc_amount_with_matrices),
+        (marginal_tax_scale.to_average(), calc_linear_average_rate_with_matrices),
+        (marginal_tax_scale, calc_marginal_rate_with_matrices),
+        )
+
+
+def measure_tax_scales(array_length, brackets_count):
+    base = np.random.uniform(-1000, 1000 * (brackets_count + 1), size = array_length)
+    for tax_scale, calc_with_matrices in new_tax_scales(brackets_count):
+        title = u'{} n={} k={}'.format(tax_scale.__class__.__name__, array_length, brackets_count)
+        with measure_time(u'{} calc'.format(title)):
+            result = tax_scale.calc(base)
+        if array_length * brackets_count > args.max_matrix_size:
+            continue
+        with measure_time(u'{} matrices'.format(title)):
+            expected_result = calc_with_matrices(tax_scale, base)
+        assert_near(result, expected_result, absolute_error_margin = 1e-6)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument('--array-lengths', default = '1000,100000,10000000', help = "comma-separated array lengths")
+    parser.add_argument('--brackets-counts', default = '2,5,15,50', help = "comma-separated numbers of brackets")
+    parser.add_argument('--max-matrix-size', default = 10 ** 8, type = int,
+        help = "maximum number of items of the matrices of the previous implementation")
+    global args
+    args = parser.parse_args()
+
+    print(unicode(args).format('utf-8'))
+    for array_length in (int(float(length)) for length in args.array_lengths.split(',')):
+        for brackets_count in (int(count) for count in args.brackets_counts.split(',')):
+            measure_tax_scales(array_length, brackets_count)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,19 +2,39 @@
 
 
 import collections
+import time
 
-from . import periods, holders
+from . import caches, legislations, periods, holders, schedulers, tracers
+from .entities import EntityMembership
 from .tools import empty_clone, stringify_array
 
 
+class CycleDetectionState(object):
+    """The formula calls being run, to detect circular definitions."""
+    __slots__ = ('active_formula_keys', 'depth_by_variable_name', 'max_nb_cycles')
+
+    def __init__(self):
+        self.active_formula_keys = set()  # The (variable_name, period) formula calls being run
+        self.depth_by_variable_name = {}  # The number of formula calls being run for each variable
+        self.max_nb_cycles = None
+
+
 class Simulation(object):
+    cache_budget = None
     compact_legislation_by_instant_cache = None
+    cycle_default_values_count = 0  # Number of formula calls giving default values, because of an allowed cycle
+    cycles_count = 0  # Number of formula calls refused because of a cycle
     debug = False
     debug_all = False  # When False, log only formula calls with non-default parameters.
+    dependencies_tracker = None  # A caches.DependenciesRecorder or a caches.ArraysReleaser
     entity_by_key_plural = None
     entity_by_key_singular = None
+    entity_membership_by_key_plural = None
+    holders_lock = None  # A lock used to create holders, while formulas are computed by several threads
     period = None
+    period_store = False  # When True, holders store their arrays in a PeriodArrayStore instead of a dict.
     persons = None
+    profiler = None  # A profilers.Profiler, measuring the formula calls
     reference_compact_legislation_by_instant_cache = None
     stack_trace = None
     steps_count = 1
@@ -23,16 +43,16 @@ class Simulation(object):
     traceback = None
 
     def __init__(self, debug = False, debug_all = False, period = None, tax_benefit_system = None,
-    trace = False, opt_out_cache = False):
+    trace = False, opt_out_cache = False, period_store = False, cache_max_bytes = None):
         assert isinstance(period, periods.Period)
         self.period = period
         self.holder_by_name = {}
+        self.entity_membership_by_key_plural = {}
+        self.input_variables_name = set()  # Names of the variables having arrays given by set_input
 
         # To keep track of the values (formulas and periods) being calculated to detect circular definitions.
         # See use in formulas.py.
-        # The data structure of requested_periods_by_variable_name is: {variable_name: [period1, period2]}
-        self.requested_periods_by_variable_name = {}
-        self.max_nb_cycles = None
+        self.cycle_detection_state = CycleDetectionState()
 
         if debug:
             self.debug = True
@@ -44,6 +64,13 @@ class Simulation(object):
         if trace:
             self.trace = True
         self.opt_out_cache = opt_out_cache
+        if period_store:
+            self.period_store = True
+        if cache_max_bytes is not None:
+            # Evicting a month from a PeriodArrayStore doesn't free its row of the buffer, so the budget can't be
+            # enforced.
+            assert not period_store, "cache_max_bytes can't be used with period_store"
+            self.cache_budget = caches.CacheBudget(cache_max_bytes)
         if debug or trace:
             self.stack_trace = collections.deque()
             self.traceback = collections.OrderedDict()
@@ -86,6 +113,20 @@ class Simulation(object):
             period = self.period
         return self.compute_divide(column_name, period = period, **parameters).array
 
+    def calculate_many(self, variables_periods, timing_by_variable_name = None, threads = None,
+            get_input_variables_and_parameters = None, **parameters):
+        """Calculate several variables at once and return an ordered dict {(variable_name, period): array}.
+
+        See compute_many().
+        """
+        return collections.OrderedDict(
+            (key, dated_holder.array)
+            for key, dated_holder in self.compute_many(variables_periods,
+                timing_by_variable_name = timing_by_variable_name, threads = threads,
+                get_input_variables_and_parameters = get_input_variables_and_parameters,
+                **parameters).iteritems()
+            )
+
     def calculate_output(self, column_name, period = None):
         """Calculate the value using calculate_output hooks in formula classes."""
         if period is None:
@@ -101,7 +142,7 @@ class Simulation(object):
         new_dict = new.__dict__
 
         for key, value in self.__dict__.iteritems():
-            if key not in ('debug', 'debug_all', 'entity_by_key_plural', 'persons', 'trace'):
+            if key not in ('cycle_detection_state', 'debug', 'debug_all', 'entity_by_key_plural', 'persons', 'trace'):
                 new_dict[key] = value
 
         if debug:
@@ -114,6 +155,9 @@ class Simulation(object):
             new_dict['stack_trace'] = collections.deque()
             new_dict['traceback'] = collections.OrderedDict()
 
+        new_dict['cycle_detection_state'] = cycle_detection_state = CycleDetectionState()
+        cycle_detection_state.max_nb_cycles = self.max_nb_cycles
+
         new_dict['entity_by_key_plural'] = entity_by_key_plural = dict(
             (key_plural, entity.clone(simulation = new))
             for key_plural, entity in self.entity_by_key_plural.iteritems()
@@ -123,9 +167,16 @@ class Simulation(object):
             for entity in entity_by_key_plural.itervalues()
             )
         new_dict['holder_by_name'] = {
-            name: holder.clone()
+            name: holder.clone(entity = entity_by_key_plural[holder.entity.key_plural])
             for name, holder in self.holder_by_name.iteritems()
             }
+        if self.cache_budget is not None:
+            new_dict['cache_budget'] = self.cache_budget.clone(new_dict['holder_by_name'])
+        if self.dependencies_tracker is not None:
+            new_dict['dependencies_tracker'] = self.dependencies_tracker.clone(new)
+        new_dict['input_variables_name'] = self.input_variables_name.copy()
+        # Memberships are immutable, but the clone may change its own index or role arrays.
+        new_dict['entity_membership_by_key_plural'] = self.entity_membership_by_key_plural.copy()
         for entity in entity_by_key_plural.itervalues():
             if entity.is_persons_entity:
                 new_dict['persons'] = entity
@@ -144,9 +195,66 @@ class Simulation(object):
             caller_input_variables_infos = calling_frame['input_variables_infos']
             if variable_infos not in caller_input_variables_infos:
                 caller_input_variables_infos.append(variable_infos)
+        if self.dependencies_tracker is not None:
+            self.dependencies_tracker.use(column_name)
         holder = self.get_or_new_holder(column_name)
         return holder.compute(period = period, **parameters)
 
+    def compute_many(self, variables_periods, timing_by_variable_name = None, threads = None,
+            get_input_variables_and_parameters = None, **parameters):
+        """Compute several variables at once and return an ordered dict {(variable_name, period): dated_holder}.
+
+        variables_periods is a list of variable names or of (variable_name, period) pairs. When no period is given,
+        the period of the simulation is used. Duplicated requests are computed only once, and the sub-computations
+        shared by the requested variables are kept in the cache of the holders.
+
+        When timing_by_variable_name is a dict, the number of seconds spent computing each requested variable is
+        added to it. It includes the computation of its dependencies that were not already known.
+
+        When threads is given, the requested variables that don't share any dependency are computed by a pool of
+        threads. get_input_variables_and_parameters gives the dependencies of each variable (see graph() and
+        schedulers.compute_in_threads()). By default, the dependencies found in the source code of the formulas are
+        used (see TaxBenefitSystem.get_input_variables_and_parameters()).
+        """
+        keys = []
+        known_keys = set()
+        period_by_raw_period = {None: self.period}
+        for variable_period in variables_periods:
+            if isinstance(variable_period, basestring):
+                column_name, raw_period = variable_period, None
+            else:
+                column_name, raw_period = variable_period
+            period = period_by_raw_period.get(raw_period)
+            if period is None:
+                period = raw_period if isinstance(raw_period, periods.Period) else periods.period(raw_period)
+                period_by_raw_period[raw_period] = period
+            key = (column_name, period)
+            if key not in known_keys:
+                keys.append(key)
+                known_keys.add(key)
+
+        if threads is not None:
+            if get_input_variables_and_parameters is None:
+                get_input_variables_and_parameters = self.tax_benefit_system.get_input_variables_and_parameters
+            dated_holder_by_key = schedulers.compute_in_threads(self, keys, threads,
+                get_input_variables_and_parameters, timing_by_variable_name = timing_by_variable_name, **parameters)
+            return collections.OrderedDict(
+                (key, dated_holder_by_key[key])
+                for key in keys
+                )
+
+        dated_holder_by_key = collections.OrderedDict()
+        for key in keys:
+            column_name, period = key
+            if timing_by_variable_name is None:
+                dated_holder_by_key[key] = self.compute(column_name, period = period, **parameters)
+            else:
+                start_time = time.time()
+                dated_holder_by_key[key] = self.compute(column_name, period = period, **parameters)
+                timing_by_variable_name[column_name] = timing_by_variable_name.get(column_name, 0) + \
+                    time.time() - start_time
+        return dated_holder_by_key
+
     def compute_add(self, column_name, period = None, **parameters):
         if period is None:
             period = self.period
@@ -158,6 +266,8 @@ class Simulation(object):
             caller_input_variables_infos = calling_frame['input_variables_infos']
             if variable_infos not in caller_input_variables_infos:
                 caller_input_variables_infos.append(variable_infos)
+        if self.dependencies_tracker is not None:
+            self.dependencies_tracker.use(column_name)
         holder = self.get_or_new_holder(column_name)
         return holder.compute_add(period = period, **parameters)
 
@@ -172,6 +282,8 @@ class Simulation(object):
             caller_input_variables_infos = calling_frame['input_variables_infos']
             if variable_infos not in caller_input_variables_infos:
                 caller_input_variables_infos.append(variable_infos)
+        if self.dependencies_tracker is not None:
+            self.dependencies_tracker.use(column_name)
         holder = self.get_or_new_holder(column_name)
         return holder.compute_add_divide(period = period, **parameters)
 
@@ -186,6 +298,8 @@ class Simulation(object):
             caller_input_variables_infos = calling_frame['input_variables_infos']
             if variable_infos not in caller_input_variables_infos:
                 caller_input_variables_infos.append(variable_infos)
+        if self.dependencies_tracker is not None:
+            self.dependencies_tracker.use(column_name)
         holder = self.get_or_new_holder(column_name)
         return holder.compute_divide(period = period, **parameters)
 
@@ -200,6 +314,8 @@ class Simulation(object):
             caller_input_variables_infos = calling_frame['input_variables_infos']
             if variable_infos not in caller_input_variables_infos:
                 caller_input_variables_infos.append(variable_infos)
+        if self.dependencies_tracker is not None:
+            self.dependencies_tracker.use(column_name)
         return self.get_or_new_holder(column_name).get_array(period)
 
     def get_compact_legislation(self, instant):
@@ -212,6 +328,17 @@ class Simulation(object):
             self.compact_legislation_by_instant_cache[instant] = compact_legislation
         return compact_legislation
 
+    def get_entity_membership(self, entity):
+        """Return the membership index of the given entity, rebuilding it when its index or role arrays changed."""
+        assert not entity.is_persons_entity
+        entity_index_array = self.holder_by_name[entity.index_for_person_variable_name].array
+        role_array = self.holder_by_name[entity.role_for_person_variable_name].array
+        membership = self.entity_membership_by_key_plural.get(entity.key_plural)
+        if membership is None or not membership.is_up_to_date(entity_index_array, role_array, entity.count):
+            self.entity_membership_by_key_plural[entity.key_plural] = membership = EntityMembership(
+                entity_index_array, role_array, entity.count)
+        return membership
+
     def get_holder(self, column_name, default = UnboundLocalError):
         if default is UnboundLocalError:
             return self.holder_by_name[column_name]
@@ -220,11 +347,15 @@ class Simulation(object):
     def get_or_new_holder(self, column_name):
         holder = self.holder_by_name.get(column_name)
         if holder is None:
-            entity = self.get_variable_entity(column_name)
-            column = self.tax_benefit_system.get_column(column_name)
-            self.holder_by_name[column_name] = holder = holders.Holder(column = column, entity = entity)
-            if column.formula_class is not None:
-                holder.formula = column.formula_class(holder = holder)
+            holders_lock = self.holders_lock
+            if holders_lock is None:
+                holder = self.new_holder(column_name)
+            else:
+                with holders_lock:
+                    # Another thread may have created the holder while waiting for the lock.
+                    holder = self.holder_by_name.get(column_name)
+                    if holder is None:
+                        holder = self.new_holder(column_name)
         return holder
 
     def get_reference_compact_legislation(self, instant):
@@ -240,11 +371,217 @@ class Simulation(object):
     def graph(self, column_name, edges, get_input_variables_and_parameters, nodes, visited):
         self.get_or_new_holder(column_name).graph(edges, get_input_variables_and_parameters, nodes, visited)
 
+    def invalidate_parameters(self, parameters_name):
+        """Delete the arrays calculated from the given parameters, and return the names of the variables invalidated.
+
+        The parameters read by each formula call must have been recorded (see record_parameters_access()). The
+        holders of the formulas having read one of the given parameters (or a node containing it) are emptied, and so
+        are the holders of the formulas using them, transitively. The other arrays are kept in cache. Input variables
+        are never invalidated.
+        Called by set_tax_benefit_system(), which replaces the tax-benefit system and finds the changed parameters.
+        """
+        recorder = self.dependencies_tracker
+        assert isinstance(recorder, caches.ParametersRecorder), \
+            "Parameters access must be recorded to invalidate parameters"
+        parameters_name = set(parameters_name)
+        invalid_variables_name = set(
+            variable_name
+            for (variable_name, period), read_parameters_name in recorder.parameters_name_by_formula_key.iteritems()
+            if any(
+                legislations.is_same_parameter_or_node(read_parameter_name, parameter_name)
+                for read_parameter_name in read_parameters_name
+                for parameter_name in parameters_name
+                )
+            )
+        consumer_keys_by_variable_name = recorder.consumer_keys_by_variable_name
+        variables_name_to_visit = list(invalid_variables_name)
+        while variables_name_to_visit:
+            variable_name = variables_name_to_visit.pop()
+            for consumer_variable_name, period in consumer_keys_by_variable_name.get(variable_name, ()):
+                if consumer_variable_name not in invalid_variables_name:
+                    invalid_variables_name.add(consumer_variable_name)
+                    variables_name_to_visit.append(consumer_variable_name)
+        invalid_variables_name.difference_update(self.input_variables_name)
+        for variable_name in invalid_variables_name:
+            holder = self.holder_by_name.get(variable_name)
+            if holder is not None:
+                holder.delete_arrays()
+        return invalid_variables_name
+
     def legislation_at(self, instant, reference = False):
         assert isinstance(instant, periods.Instant), "Expected an instant. Got: {}".format(instant)
         if reference:
-            return self.get_reference_compact_legislation(instant)
-        return self.get_compact_legislation(instant)
+            legislation = self.get_reference_compact_legislation(instant)
+        else:
+            legislation = self.get_compact_legislation(instant)
+        dependencies_tracker = self.dependencies_tracker
+        if isinstance(dependencies_tracker, caches.ParametersRecorder):
+            return legislations.RecordedCompactNode(legislation, dependencies_tracker)
+        return legislation
+
+    @property
+    def max_nb_cycles(self):
+        return self.cycle_detection_state.max_nb_cycles
+
+    @max_nb_cycles.setter
+    def max_nb_cycles(self, max_nb_cycles):
+        self.cycle_detection_state.max_nb_cycles = max_nb_cycles
+
+    def new_holder(self, column_name):
+        entity = self.get_variable_entity(column_name)
+        column = self.tax_benefit_system.get_column(column_name)
+        self.holder_by_name[column_name] = holder = holders.Holder(column = column, entity = entity)
+        if column.formula_class is not None:
+            holder.formula = column.formula_class(holder = holder)
+        return holder
+
+    def record_dependencies(self, variables_name, period = None):
+        """Calculate the given variables and return, for each variable, the formula calls using it.
+
+        The result can be given to release_arrays_after_last_use() of simulations similar to this one.
+        """
+        assert self.dependencies_tracker is None
+        self.dependencies_tracker = recorder = caches.DependenciesRecorder()
+        try:
+            for variable_name in variables_name:
+                self.calculate(variable_name, period = period)
+        finally:
+            del self.dependencies_tracker
+        return recorder.consumer_keys_by_variable_name
+
+    def record_evaluation_plan(self, variables_name, period = None):
+        """Calculate the given variables and return the list of the (variable_name, period) formula calls done.
+
+        The formula calls are listed in a topological order: each one comes after the formula calls it uses. The plan
+        can be given to run_evaluation_plan() of simulations similar to this one.
+        """
+        assert self.dependencies_tracker is None
+        self.dependencies_tracker = recorder = caches.EvaluationPlanRecorder(self)
+        try:
+            for variable_name in variables_name:
+                self.calculate(variable_name, period = period)
+        finally:
+            del self.dependencies_tracker
+        return recorder.formula_keys
+
+    def record_parameters_access(self):
+        """Record, from now on, the parameters read by each formula call and the formula calls using each variable.
+
+        Unlike record_dependencies(), the recording goes on while the simulation is used, so that the arrays
+        calculated from changed parameters can be deleted by invalidate_parameters(). It must start before any formula
+        is calculated.
+        """
+        assert self.dependencies_tracker is None
+        assert not self.trace, "Parameters access can't be recorded while tracing a simulation"
+        # The parameters read by arrays already calculated are unknown, so they could never be invalidated.
+        assert not any(
+            holder._array is not None or holder._array_by_period
+            for variable_name, holder in self.holder_by_name.iteritems()
+            if variable_name not in self.input_variables_name and not holder.column.is_input_variable()
+            ), "Parameters access must be recorded before calculating formulas"
+        self.dependencies_tracker = caches.ParametersRecorder()
+
+    def record_trace(self, variables_name, period = None, capacity = 4096):
+        """Calculate the given variables and return a tracers.TraceRecorder, with a record of each formula call.
+
+        This is a low overhead alternative to the trace mode, whose records can be exported after the calculation.
+        """
+        assert self.dependencies_tracker is None
+        self.dependencies_tracker = recorder = tracers.TraceRecorder(self, capacity = capacity)
+        try:
+            for variable_name in variables_name:
+                self.calculate(variable_name, period = period)
+        finally:
+            del self.dependencies_tracker
+        return recorder
+
+    def release(self):
+        """Delete the arrays, the holders and the entities of the simulation, which can't be used anymore.
+
+        This breaks the reference cycles between the simulation, its entities, its holders and their formulas. So the
+        memory of a clone, including its references to the stores shared with the original simulation, is freed as soon
+        as the clone is no longer referenced, without waiting for the garbage collector.
+        """
+        for holder in self.holder_by_name.itervalues():
+            holder.delete_arrays()
+            if holder.formula is not None:
+                del holder.formula
+        self.holder_by_name = {}
+        for entity in self.entity_by_key_plural.itervalues():
+            if entity.simulation is not None:
+                del entity.simulation
+        self.entity_by_key_plural = {}
+        self.entity_by_key_singular = {}
+        if self.persons is not None:
+            del self.persons
+        if self.cache_budget is not None:
+            del self.cache_budget
+        if self.dependencies_tracker is not None:
+            del self.dependencies_tracker
+        if self.traceback is not None:
+            self.traceback = collections.OrderedDict()
+
+    def release_arrays_after_last_use(self, consumer_keys_by_variable_name, output_variables_name):
+        """Free the arrays of each intermediate variable once all the formula calls using it have run.
+
+        consumer_keys_by_variable_name is the result of record_dependencies().
+        """
+        self.dependencies_tracker = caches.ArraysReleaser(self, consumer_keys_by_variable_name,
+            output_variables_name)
+
+    @property
+    def requested_periods_by_variable_name(self):
+        """The periods of the formula calls being run for each variable (read-only, see cycle_detection_state).
+
+        Built on each access from the active formula calls, so the periods of each variable are sorted instead of being
+        in call order.
+        """
+        requested_periods_by_variable_name = {}
+        for variable_name, period in sorted(self.cycle_detection_state.active_formula_keys):
+            requested_periods_by_variable_name.setdefault(variable_name, []).append(period)
+        return requested_periods_by_variable_name
+
+    def run_evaluation_plan(self, evaluation_plan):
+        """Call the formulas of an evaluation plan (see record_evaluation_plan()) in turn.
+
+        The variables used by each formula are then already in cache: formulas are not called recursively, except for
+        the dependencies missing from the plan (dynamic dependencies, cycles, etc) that are still computed on demand.
+        Once the plan has run, the requested variables can be calculated from the cache.
+        The formulas are called through their holder, which doesn't call them when their array is already in cache.
+        The variables whose arrays are not cached (see opt_out_cache) are skipped: they are computed on demand.
+        """
+        cache_blacklist = self.tax_benefit_system.cache_blacklist if self.opt_out_cache else None
+        get_or_new_holder = self.get_or_new_holder
+        for column_name, period in evaluation_plan:
+            if cache_blacklist and column_name in cache_blacklist:
+                continue
+            # The formula may return a period larger than the requested one, like when it was recorded.
+            get_or_new_holder(column_name).compute(period = period, accept_other_period = True)
+
+    def set_tax_benefit_system(self, tax_benefit_system):
+        """Replace the tax-benefit system with one differing only by its parameters, like a reform modifying the
+        legislation JSON, and return the names of the variables invalidated.
+
+        The parameters access must be recorded (see record_parameters_access()). The compact legislations are built
+        again, and only the arrays calculated from changed parameters are deleted (see invalidate_parameters()).
+        """
+        assert isinstance(self.dependencies_tracker, caches.ParametersRecorder), \
+            "Parameters access must be recorded to change the tax-benefit system"
+        column_by_name = tax_benefit_system.column_by_name
+        for variable_name, holder in self.holder_by_name.iteritems():
+            assert column_by_name.get(variable_name) is holder.column, \
+                "Variable {} differs in the new tax-benefit system".format(variable_name)
+        changed_parameters_name = legislations.get_changed_parameters_name(tax_benefit_system.get_legislation(),
+            self.tax_benefit_system.get_legislation())
+        # The parameters read by legislation_at(instant, reference = True) are recorded under the same names.
+        changed_parameters_name.update(legislations.get_changed_parameters_name(
+            tax_benefit_system.base_tax_benefit_system.get_legislation(),
+            self.tax_benefit_system.base_tax_benefit_system.get_legislation(),
+            ))
+        self.tax_benefit_system = tax_benefit_system
+        self.compact_legislation_by_instant_cache = {}
+        self.reference_compact_legislation_by_instant_cache = {}
+        return self.invalidate_parameters(changed_parameters_name)
 
     def stringify_input_variables_infos(self, input_variables_infos):
         return u', '.join(
@@ -8,17 +8,22 @@ from os import path
 from imp import find_module, load_module
 # import weakref
 
-from . import conv, legislations, legislationsxml
+from . import conv, dependencies, legislations, legislationsxml
 from variables import AbstractVariable
 from formulas import neutralize_column
 
 
 class TaxBenefitSystem(object):
     _base_tax_benefit_system = None
+    # (legislation_json, compact_legislation_by_instant_cache, indexed_legislation_json) triple
+    _indexed_legislation = None
     compact_legislation_by_instant_cache = None
+    compact_node_cache = None  # A legislations.CompactNodeCache, which can be shared by many tax-benefit systems
     entity_class_by_key_plural = None
     person_key_plural = None
     preprocess_legislation = None
+    # When True, compact legislations build their parameters on first access. Incompatible with compact_node_cache.
+    lazy_compact_legislation = False
     json_to_attributes = staticmethod(conv.pipe(
         conv.test_isinstance(dict),
         conv.struct({}),
@@ -31,6 +36,9 @@ class TaxBenefitSystem(object):
         # TODO: Currently: Don't use a weakref, because they are cleared by Paste (at least) at each call.
         self.compact_legislation_by_instant_cache = {}  # weakref.WeakValueDictionary()
         self.column_by_name = collections.OrderedDict()
+        # The data structure of dependencies_by_variable_name is: {variable_name: (variables_name, parameters_name)}
+        # See dependencies.get_formula_class_dependencies().
+        self.dependencies_by_variable_name = {}
         self.automatically_loaded_variable = set()
         self.legislation_xml_info_list = []
         self._legislation_json = legislation_json
@@ -53,19 +61,15 @@ class TaxBenefitSystem(object):
         return base_tax_benefit_system
 
     def get_compact_legislation(self, instant, traced_simulation = None):
-        legislation = self.get_legislation()
+        legislation = self.get_indexed_legislation()
         if traced_simulation is None:
             compact_legislation = self.compact_legislation_by_instant_cache.get(instant)
             if compact_legislation is None and legislation is not None:
-                dated_legislation_json = legislations.generate_dated_legislation_json(legislation, instant)
-                compact_legislation = legislations.compact_dated_node_json(dated_legislation_json)
+                compact_legislation = self.new_compact_legislation(legislation, instant)
                 self.compact_legislation_by_instant_cache[instant] = compact_legislation
         else:
-            dated_legislation_json = legislations.generate_dated_legislation_json(legislation, instant)
-            compact_legislation = legislations.compact_dated_node_json(
-                dated_legislation_json,
-                traced_simulation = traced_simulation,
-                )
+            compact_legislation = self.new_compact_legislation(legislation, instant,
+                traced_simulation = traced_simulation)
         return compact_legislation
 
     def get_reference_compact_legislation(self, instant, traced_simulation = None):
@@ -84,6 +88,16 @@ class TaxBenefitSystem(object):
             return attributes, error
         return cls(**attributes), None
 
+    def new_compact_legislation(self, legislation, instant, traced_simulation = None):
+        if self.lazy_compact_legislation:
+            assert self.compact_node_cache is None, \
+                "lazy_compact_legislation and compact_node_cache can't be used together"
+            return legislations.lazy_compact_node_json(legislation, instant, traced_simulation = traced_simulation)
+        if self.compact_node_cache is not None and traced_simulation is None:
+            return legislations.cached_compact_node_json(legislation, instant, self.compact_node_cache)
+        dated_legislation_json = legislations.generate_dated_legislation_json(legislation, instant)
+        return legislations.compact_dated_node_json(dated_legislation_json, traced_simulation = traced_simulation)
+
     def new_scenario(self):
         scenario = self.Scenario()
         scenario.tax_benefit_system = self
@@ -114,6 +128,8 @@ class TaxBenefitSystem(object):
         # We need the tax benefit system to identify columns mentioned by conversion variables.
         column = variable.to_column(self)
         self.column_by_name[column.name] = column
+        self.dependencies_by_variable_name[column.name] = dependencies.get_formula_class_dependencies(
+            column.formula_class)
 
         return column
 
@@ -160,8 +176,17 @@ class TaxBenefitSystem(object):
     def get_column(self, column_name):
         return self.column_by_name.get(column_name)
 
+    def get_input_variables_and_parameters(self, column):
+        """Return the variables and the parameters used by the formula of a column, as found in its source code.
+
+        This method can be given to Simulation.graph() and to Simulation.calculate_many().
+        """
+        return self.dependencies_by_variable_name.get(column.name, (None, None))
+
     def update_column(self, column_name, new_column):
         self.column_by_name[column_name] = new_column
+        self.dependencies_by_variable_name[column_name] = dependencies.get_formula_class_dependencies(
+            new_column.formula_class)
 
     def neutralize_column(self, column_name):
         self.update_column(column_name, neutralize_column(self.reference.get_column(column_name)))
@@ -187,6 +212,27 @@ class TaxBenefitSystem(object):
             legislation_json = self.preprocess_legislation(legislation_json)
         self._legislation_json = legislation_json
 
+    def get_indexed_legislation(self):
+        """Return the legislation JSON, with its dated values indexed for fast lookups at any instant.
+
+        The indexed legislation is built again when the legislation JSON is replaced, and when
+        compact_legislation_by_instant_cache is reset (by giving it a new dict), for example after the legislation JSON
+        has been modified in place.
+        """
+        legislation = self.get_legislation()
+        if legislation is None:
+            return None
+        compact_legislation_by_instant_cache = self.compact_legislation_by_instant_cache
+        indexed_legislation = self._indexed_legislation
+        if indexed_legislation is None or indexed_legislation[0] is not legislation \
+                or indexed_legislation[1] is not compact_legislation_by_instant_cache:
+            self._indexed_legislation = indexed_legislation = (
+                legislation,
+                compact_legislation_by_instant_cache,
+                legislations.index_legislation_json(legislation),
+                )
+        return indexed_legislation[2]
+
     def get_legislation(self):
         if self._legislation_json is None:
             self.compute_legislation()
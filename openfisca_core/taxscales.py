@@ -27,8 +27,11 @@ class AbstractTaxScale(object):
       * tax scale: barème
       * threshold: seuil
     """
+    arrays = None  # Dict of the NumPy arrays used by calc, compiled from the brackets, None when they have changed
+    lists_name = ('thresholds',)  # Names of the lists of brackets attributes
     name = None
     option = None
+    shared = False  # True when the lists of brackets are shared with other tax scales (see copy_on_write)
     thresholds = None
     unit = None
 
@@ -49,17 +52,56 @@ class AbstractTaxScale(object):
     def __str__(self):
         raise NotImplementedError('Method "__str__" is not implemented for {}'.format(self.__class__.__name__))
 
+    def before_brackets_change(self):
+        """Prepare the lists of brackets to be modified in place.
+
+        Copy them when they are shared with other tax scales, and forget the arrays compiled from them. The methods of
+        the tax scales call it, but it must be called before modifying the lists directly.
+        """
+        if self.shared:
+            for name in self.lists_name:
+                setattr(self, name, list(getattr(self, name)))
+            self.shared = False
+        self.arrays = None
+
     def calc(self, base):
         raise NotImplementedError('Method "calc" is not implemented for {}'.format(self.__class__.__name__))
 
+    def compile(self):
+        """Return a dict of the NumPy arrays used by calc."""
+        return dict(
+            thresholds = np.array(self.thresholds, dtype = np.float64),
+            )
+
     def copy(self):
         new = empty_clone(self)
         new.__dict__ = copy.deepcopy(self.__dict__)
+        # The lists of the copy are its own.
+        new.__dict__.pop('shared', None)
+        return new
+
+    def copy_on_write(self):
+        """Return a copy of the tax scale sharing its lists of brackets, until one of them modifies its brackets.
+
+        The methods modifying the brackets (add_bracket, multiply_rates, etc) copy the shared lists first (see
+        before_brackets_change). The compiled arrays are shared too.
+        """
+        new = empty_clone(self)
+        new.__dict__ = self.__dict__.copy()
+        new.shared = True
         return new
 
+    def get_arrays(self):
+        """Return the NumPy arrays used by calc, compiled on the first call after the brackets have changed."""
+        arrays = self.arrays
+        if arrays is None:
+            self.arrays = arrays = self.compile()
+        return arrays
+
 
 class AbstractRateTaxScale(AbstractTaxScale):
     """Abstract class for various types of rate-based tax scales (marginal rate, linear average rate)"""
+    lists_name = ('thresholds', 'rates')
     rates = None
 
     def __init__(self, name = None, option = None, unit = None):
@@ -76,6 +118,7 @@ class AbstractRateTaxScale(AbstractTaxScale):
             ))
 
     def add_bracket(self, threshold, rate):
+        self.before_brackets_change()
         if threshold in self.thresholds:
             i = self.thresholds.index(threshold)
             self.rates[i] += rate
@@ -84,9 +127,15 @@ class AbstractRateTaxScale(AbstractTaxScale):
             self.thresholds.insert(i, threshold)
             self.rates.insert(i, rate)
 
+    def compile(self):
+        arrays = super(AbstractRateTaxScale, self).compile()
+        arrays['rates'] = np.array(self.rates, dtype = np.float64)
+        return arrays
+
     def multiply_rates(self, factor, inplace = True, new_name = None):
         if inplace:
             assert new_name is None
+            self.before_brackets_change()
             for i, rate in enumerate(self.rates):
                 self.rates[i] = rate * factor
             return self
@@ -100,6 +149,7 @@ class AbstractRateTaxScale(AbstractTaxScale):
     def multiply_thresholds(self, factor, decimals = None, inplace = True, new_name = None):
         if inplace:
             assert new_name is None
+            self.before_brackets_change()
             for i, threshold in enumerate(self.thresholds):
                 if decimals is not None:
                     self.thresholds[i] = np.around(threshold * factor, decimals = decimals)
@@ -120,6 +170,7 @@ class AbstractRateTaxScale(AbstractTaxScale):
 
 class AmountTaxScale(AbstractTaxScale):
     amounts = None
+    lists_name = ('thresholds', 'amounts')
 
     def __init__(self, name = None, option = None, unit = None):
         super(AmountTaxScale, self).__init__(name = name, option = option, unit = unit)
@@ -135,6 +186,7 @@ class AmountTaxScale(AbstractTaxScale):
             ))
 
     def add_bracket(self, threshold, amount):
+        self.before_brackets_change()
         if threshold in self.thresholds:
             i = self.thresholds.index(threshold)
             self.amounts[i] += amount
@@ -144,10 +196,16 @@ class AmountTaxScale(AbstractTaxScale):
             self.amounts.insert(i, amount)
 
     def calc(self, base):
-        base1 = np.tile(base, (len(self.thresholds), 1)).T
-        thresholds1 = np.tile(np.hstack((self.thresholds, np.inf)), (len(base), 1))
-        a = max_(min_(base1, thresholds1[:, 1:]) - thresholds1[:, :-1], 0)
-        return np.dot(self.amounts, a.T > 0)
+        """Return the sum of the amounts of the brackets whose threshold is strictly below base."""
+        arrays = self.get_arrays()
+        return arrays['cumulated_amounts'][np.searchsorted(arrays['thresholds'], base, side = 'left')]
+
+    def compile(self):
+        arrays = super(AmountTaxScale, self).compile()
+        arrays['amounts'] = amounts = np.array(self.amounts, dtype = np.float64)
+        # Sum of the amounts of the brackets below each threshold
+        arrays['cumulated_amounts'] = np.concatenate(([0], np.cumsum(amounts)))
+        return arrays
 
 
 class LinearAverageRateTaxScale(AbstractRateTaxScale):
@@ -155,19 +213,22 @@ class LinearAverageRateTaxScale(AbstractRateTaxScale):
         if len(self.rates) == 1:
             return base * self.rates[0]
 
-        tiled_base = np.tile(base, (len(self.thresholds) - 1, 1)).T
-        tiled_thresholds = np.tile(self.thresholds, (len(base), 1))
-        bracket_dummy = (tiled_base >= tiled_thresholds[:, :-1]) * (tiled_base < tiled_thresholds[:, 1:])
-        rates_array = np.array(self.rates)
-        thresholds_array = np.array(self.thresholds)
-        rate_slope = (rates_array[1:] - rates_array[:-1]) / (thresholds_array[1:] - thresholds_array[:-1])
-        average_rate_slope = np.dot(bracket_dummy, rate_slope.T)
-
-        bracket_average_start_rate = np.dot(bracket_dummy, rates_array[:-1])
-        bracket_threshold = np.dot(bracket_dummy, thresholds_array[:-1])
-        log.info("bracket_average_start_rate :  {}".format(bracket_average_start_rate))
-        log.info("average_rate_slope:  {}".format(average_rate_slope))
-        return base * (bracket_average_start_rate + (base - bracket_threshold) * average_rate_slope)
+        arrays = self.get_arrays()
+        thresholds = arrays['thresholds']
+        # Index of the bracket of each base. The bases outside of the brackets get a zero tax.
+        bracket_index = np.searchsorted(thresholds, base, side = 'right') - 1
+        in_brackets = (bracket_index >= 0) & (bracket_index < len(thresholds) - 1)
+        bracket_index = np.clip(bracket_index, 0, len(thresholds) - 2)
+        average_rate = arrays['rates'][bracket_index] + (base - thresholds[bracket_index]) * \
+            arrays['rate_slope'][bracket_index]
+        return np.where(in_brackets, base * average_rate, 0)
+
+    def compile(self):
+        arrays = super(LinearAverageRateTaxScale, self).compile()
+        rates = arrays['rates']
+        thresholds = arrays['thresholds']
+        arrays['rate_slope'] = (rates[1:] - rates[:-1]) / (thresholds[1:] - thresholds[:-1])
+        return arrays
 
     def to_marginal(self):
         marginal_tax_scale = MarginalRateTaxScale(name = self.name, option = self.option, unit = self.unit)
@@ -192,19 +253,59 @@ class MarginalRateTaxScale(AbstractRateTaxScale):
             self.combine_bracket(tax_scale.rates[-1], tax_scale.thresholds[-1])  # Pour traiter le dernier threshold
 
     def calc(self, base, factor = 1, round_base_decimals = None):
-        base1 = np.tile(base, (len(self.thresholds), 1)).T
-        if isinstance(factor, (float, int)):
-            factor = np.ones(len(base)) * factor
-        thresholds1 = np.outer(factor, np.array(self.thresholds + [np.inf]))
-        if round_base_decimals is not None:
-            thresholds1 = np.round(thresholds1, round_base_decimals)
-        a = max_(min_(base1, thresholds1[:, 1:]) - thresholds1[:, :-1], 0)
+        """Compute the tax on base, with thresholds multiplied by factor (a number or an array like base).
+
+        The memory used is proportional to the size of base, whatever the number of brackets.
+        """
+        base = np.asarray(base)
+        if not self.thresholds:
+            return np.zeros(len(base))
+        arrays = self.get_arrays()
+        rates = arrays['rates']
+        if np.ndim(factor) > 0:
+            return self.calc_by_bracket(base, factor, rates, round_base_decimals = round_base_decimals)
+        if factor == 1 and round_base_decimals is None:
+            thresholds = arrays['thresholds']
+            # Tax of all the brackets below each threshold
+            cumulated_brackets_tax = arrays['cumulated_brackets_tax']
+        else:
+            thresholds = factor * arrays['thresholds']
+            if round_base_decimals is not None:
+                thresholds = np.round(thresholds, round_base_decimals)
+                brackets_tax = np.round(rates[:-1] * np.round(np.diff(thresholds), round_base_decimals),
+                    round_base_decimals)
+            else:
+                brackets_tax = rates[:-1] * np.diff(thresholds)
+            cumulated_brackets_tax = np.concatenate(([0], np.cumsum(brackets_tax)))
+        # Index of the bracket of each base (-1 when base is below the first threshold)
+        bracket_index = np.searchsorted(thresholds, base, side = 'right') - 1
+        in_brackets = bracket_index >= 0
+        bracket_index = max_(bracket_index, 0)
+        bracket_base = base - thresholds[bracket_index]
         if round_base_decimals is None:
-            return np.dot(self.rates, a.T)
+            bracket_tax = rates[bracket_index] * bracket_base
         else:
-            r = np.tile(self.rates, (len(base), 1))
-            b = np.round(a, round_base_decimals)
-            return np.round(r * b, round_base_decimals).sum(axis = 1)
+            bracket_tax = np.round(rates[bracket_index] * np.round(bracket_base, round_base_decimals),
+                round_base_decimals)
+        return np.where(in_brackets, cumulated_brackets_tax[bracket_index] + bracket_tax, 0)
+
+    def calc_by_bracket(self, base, factor, rates, round_base_decimals = None):
+        """Compute the tax with a factor by row, adding the tax of each bracket in turn."""
+        factor = np.asarray(factor)
+        tax = np.zeros(len(base))
+        thresholds = list(self.thresholds) + [np.inf]
+        for threshold_low, threshold_high, rate in itertools.izip(thresholds[:-1], thresholds[1:], rates):
+            threshold_low = factor * threshold_low
+            threshold_high = factor * threshold_high
+            if round_base_decimals is not None:
+                threshold_low = np.round(threshold_low, round_base_decimals)
+                threshold_high = np.round(threshold_high, round_base_decimals)
+            bracket_base = max_(min_(base, threshold_high) - threshold_low, 0)
+            if round_base_decimals is None:
+                tax += rate * bracket_base
+            else:
+                tax += np.round(rate * np.round(bracket_base, round_base_decimals), round_base_decimals)
+        return tax
 
     def combine_bracket(self, rate, threshold_low = 0, threshold_high = False):
         # Insert threshold_low and threshold_high without modifying rates
@@ -226,6 +327,12 @@ class MarginalRateTaxScale(AbstractRateTaxScale):
             self.add_bracket(self.thresholds[i], rate)
             i += 1
 
+    def compile(self):
+        arrays = super(MarginalRateTaxScale, self).compile()
+        arrays['cumulated_brackets_tax'] = np.concatenate(
+            ([0], np.cumsum(arrays['rates'][:-1] * np.diff(arrays['thresholds']))))
+        return arrays
+
     def inverse(self):
         """Returns a new instance of MarginalRateTaxScale
 
@@ -274,3 +381,55 @@ class MarginalRateTaxScale(AbstractRateTaxScale):
 
             average_tax_scale.add_bracket(float('Inf'), rate)
         return average_tax_scale
+
+
+def calc_marginal_rate_tax_scales(tax_scales, base, factor = 1, round_base_decimals = None,
+        max_chunk_size = 1000000):
+    """Compute the taxes of many MarginalRateTaxScales on the same base, returned as a (scales × base) array.
+
+    The brackets of all the tax scales are merged, so that the bracket of each base is looked up only once for all the
+    tax scales. The base is processed by chunks, whose temporary (scales × chunk) arrays have at most max_chunk_size
+    items.
+    A factor by row and rounded bases are not supported by the merged brackets: each tax scale is computed in turn.
+    """
+    base = np.asarray(base)
+    taxes = np.zeros((len(tax_scales), len(base)))
+    if np.ndim(factor) > 0 or round_base_decimals is not None:
+        for tax_scale, tax in itertools.izip(tax_scales, taxes):
+            tax[:] = tax_scale.calc(base, factor = factor, round_base_decimals = round_base_decimals)
+        return taxes
+    tax_scales_arrays = [
+        tax_scale.get_arrays()
+        for tax_scale in tax_scales
+        if tax_scale.thresholds
+        ]
+    if not tax_scales_arrays:
+        return taxes
+    thresholds = np.unique(np.concatenate([
+        tax_scale_arrays['thresholds']
+        for tax_scale_arrays in tax_scales_arrays
+        ]))
+    # Rates of each tax scale in the merged brackets (0 below the first threshold of the tax scale)
+    rates = np.zeros((len(tax_scales), len(thresholds)))
+    for tax_scale, tax_scale_rates in itertools.izip(tax_scales, rates):
+        if tax_scale.thresholds:
+            tax_scale_arrays = tax_scale.get_arrays()
+            bracket_index = np.searchsorted(tax_scale_arrays['thresholds'], thresholds, side = 'right') - 1
+            tax_scale_rates[:] = np.where(bracket_index >= 0, tax_scale_arrays['rates'][max_(bracket_index, 0)], 0)
+    thresholds = factor * thresholds
+    # Tax of all the merged brackets below each threshold
+    cumulated_brackets_tax = np.zeros_like(rates)
+    np.cumsum(rates[:, :-1] * np.diff(thresholds), axis = 1, out = cumulated_brackets_tax[:, 1:])
+    chunk_length = max(max_chunk_size // len(tax_scales), 1)
+    for start in xrange(0, len(base), chunk_length):
+        base_chunk = base[start:start + chunk_length]
+        bracket_index = np.searchsorted(thresholds, base_chunk, side = 'right') - 1
+        in_brackets = bracket_index >= 0
+        bracket_index = max_(bracket_index, 0)
+        # Compute the taxes of the chunk in place, to keep only two (scales × chunk) temporary arrays.
+        chunk_taxes = rates[:, bracket_index]
+        chunk_taxes *= base_chunk - thresholds[bracket_index]
+        chunk_taxes += cumulated_brackets_tax[:, bracket_index]
+        chunk_taxes[:, ~in_brackets] = 0
+        taxes[:, start:start + chunk_length] = chunk_taxes
+    return taxes
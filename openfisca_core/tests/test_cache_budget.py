@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+
+from nose.tools import assert_raises
+import numpy as np
+
+from openfisca_core.columns import IntCol
+from openfisca_core.tests import dummy_country
+from openfisca_core.tests.dummy_country import Individus
+from openfisca_core.tools import assert_near
+from openfisca_core.variables import Variable
+
+
+class input(Variable):
+    column = IntCol
+    entity_class = Individus
+    label = u"Input variable"
+
+
+class intermediate(Variable):
+    column = IntCol
+    entity_class = Individus
+    label = u"Intermediate result"
+
+    def function(self, simulation, period):
+        return period, simulation.calculate('input', period) + 1
+
+
+class output(Variable):
+    column = IntCol
+    entity_class = Individus
+    label = u'Output variable'
+
+    def function(self, simulation, period):
+        return period, simulation.calculate('intermediate', period) * 2
+
+
+# TaxBenefitSystem instance declared after formulas
+tax_benefit_system = dummy_country.DummyTaxBenefitSystem()
+tax_benefit_system.add_variables(input, intermediate, output)
+scenario = tax_benefit_system.new_scenario().init_from_attributes(
+    period = 2016,
+    input_variables = {
+        'input': [1, 2, 3],
+        },
+    )
+
+
+def test_unbounded_cache():
+    simulation = scenario.new_simulation(cache_max_bytes = 10 ** 9)
+    assert_near(simulation.calculate('output'), [4, 6, 8], absolute_error_margin = 0)
+    assert simulation.cache_budget.evictions_count == 0
+    assert simulation.get_holder('intermediate').get_array(simulation.period) is not None
+
+
+def test_evictions():
+    simulation = scenario.new_simulation(cache_max_bytes = 0)
+    assert_near(simulation.calculate('output'), [4, 6, 8], absolute_error_margin = 0)
+    assert simulation.cache_budget.evictions_count == 1
+    # Input arrays are pinned.
+    assert simulation.get_holder('input').get_array(simulation.period) is not None
+    assert simulation.get_holder('intermediate').get_array(simulation.period) is None
+    # Evicted arrays are computed again when requested.
+    assert_near(simulation.calculate('intermediate'), [2, 3, 4], absolute_error_margin = 0)
+    assert simulation.get_holder('output').get_array(simulation.period) is None
+
+
+def test_input_array_setter():
+    simulation = scenario.new_simulation(cache_max_bytes = 0)
+    input_holder = simulation.get_holder('input')
+    # Replace the array given through set_input by an array given to the holder.
+    input_holder.delete_arrays()
+    input_holder.array = np.array([1, 2, 3])
+    assert_near(simulation.calculate('output'), [4, 6, 8], absolute_error_margin = 0)
+    # The input array, which can't be computed again, is never evicted.
+    assert_near(simulation.calculate('intermediate'), [2, 3, 4], absolute_error_margin = 0)
+    assert simulation.cache_budget.evictions_count == 2
+
+
+def test_evicted_dated_holder():
+    simulation = scenario.new_simulation(cache_max_bytes = 0)
+    intermediate_dated_holder = simulation.compute('intermediate')
+    simulation.compute('output')
+    assert simulation.get_holder('intermediate').get_array(simulation.period) is None
+    assert_near(intermediate_dated_holder.array, [2, 3, 4], absolute_error_margin = 0)
+    array_by_key = simulation.calculate_many(['intermediate', 'output'])
+    assert_near(array_by_key[('intermediate', simulation.period)], [2, 3, 4], absolute_error_margin = 0)
+    assert_near(array_by_key[('output', simulation.period)], [4, 6, 8], absolute_error_margin = 0)
+
+
+def test_clone():
+    simulation = scenario.new_simulation(cache_max_bytes = 0)
+    simulation.calculate('output')
+    new_simulation = simulation.clone()
+    assert new_simulation.cache_budget is not simulation.cache_budget
+    assert_near(new_simulation.calculate('intermediate'), [2, 3, 4], absolute_error_margin = 0)
+    assert simulation.get_holder('output').get_array(simulation.period) is not None
+
+
+def test_period_store():
+    # The rows of the evicted months would stay in the buffer of the store.
+    assert_raises(AssertionError, scenario.new_simulation, cache_max_bytes = 0, period_store = True)
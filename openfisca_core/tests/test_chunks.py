@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+
+from nose.tools import assert_raises
+
+from openfisca_core import chunks
+from openfisca_core.tools import assert_near
+from openfisca_core.tests.test_countries import tax_benefit_system
+
+
+scenario = tax_benefit_system.new_scenario().init_from_attributes(
+    period = 2013,
+    input_variables = {
+        # Families are not sorted, and family 3 has no member.
+        'id_famille': [2, 0, 1, 0, 2, 4, 1],
+        'role_dans_famille': [0, 0, 0, 1, 1, 0, 2],
+        'salaire_brut': [10000, 20000, 30000, 40000, 50000, 60000, 70000],
+        'depcom': ['75101', '97123', '75101', '75101', '98456'],
+        },
+    )
+
+
+def test_iter_chunks():
+    chunks_positions = [
+        positions_by_entity_key_plural
+        for input_variables, positions_by_entity_key_plural in chunks.iter_chunks(scenario, 'familles', 2)
+        ]
+    assert len(chunks_positions) == 3
+    assert_near(chunks_positions[0]['familles'], [0, 1], absolute_error_margin = 0)
+    assert_near(chunks_positions[0]['individus'], [1, 2, 3, 6], absolute_error_margin = 0)
+    assert_near(chunks_positions[1]['familles'], [2], absolute_error_margin = 0)
+    assert_near(chunks_positions[2]['individus'], [5], absolute_error_margin = 0)
+
+
+def test_calculate():
+    variables_name = ['revenu_disponible', 'revenu_disponible_famille', 'dom_tom']
+    expected_array_by_variable_name = {
+        variable_name: scenario.new_simulation().calculate(variable_name)
+        for variable_name in variables_name
+        }
+    for chunk_size in (1, 2, 10):
+        array_by_variable_name = chunks.calculate(scenario, variables_name, 'familles', chunk_size)
+        assert_near(array_by_variable_name['revenu_disponible'], expected_array_by_variable_name['revenu_disponible'],
+            absolute_error_margin = 0.005)
+        # Family 3 has no member, so its values are the default ones.
+        assert_near(array_by_variable_name['revenu_disponible_famille'],
+            expected_array_by_variable_name['revenu_disponible_famille'], absolute_error_margin = 0.005)
+        assert (array_by_variable_name['dom_tom'] == [False, True, False, False, True]).all()
+
+
+def test_not_nested_entity():
+    with assert_raises(AssertionError):
+        list(chunks.iter_chunks(scenario, 'individus', 2))
+
+
+def test_calculate_in_processes():
+    variables_name = ['revenu_disponible', 'revenu_disponible_famille', 'depcom']
+    expected_array_by_variable_name = chunks.calculate(scenario, variables_name, 'familles', 2)
+    array_by_variable_name = chunks.calculate_in_processes(scenario, variables_name, 'familles', 2, processes = 2)
+    assert_near(array_by_variable_name['revenu_disponible'], expected_array_by_variable_name['revenu_disponible'],
+        absolute_error_margin = 0)
+    assert_near(array_by_variable_name['revenu_disponible_famille'],
+        expected_array_by_variable_name['revenu_disponible_famille'], absolute_error_margin = 0)
+    assert (array_by_variable_name['depcom'] == expected_array_by_variable_name['depcom']).all()
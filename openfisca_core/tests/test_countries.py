@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 import datetime
+import StringIO
 
 import numpy as np
 from numpy.core.defchararray import startswith
@@ -9,7 +10,7 @@ from nose.tools import raises
 from openfisca_core.columns import BoolCol, DateCol, FixedStrCol, FloatCol, IntCol
 from openfisca_core.formulas import dated_function, set_input_divide_by_period
 from openfisca_core.variables import Variable, EntityToPersonColumn, DatedVariable, PersonToEntityColumn
-from openfisca_core import periods
+from openfisca_core import periods, profilers, schedulers
 from dummy_country import Familles, Individus, DummyTaxBenefitSystem
 from openfisca_core.tools import assert_near
 
@@ -355,3 +356,190 @@ def test_variable_name_conflict():
         def function(self, simulation, period):
             return period, self.zeros()
     tax_benefit_system.add_variable(revenu_disponible)
+
+
+def test_calculate_many():
+    simulation = tax_benefit_system.new_scenario().init_single_entity(
+        period = 2013,
+        parent1 = dict(
+            salaire_brut = 4000,
+            ),
+        ).new_simulation()
+    timing_by_variable_name = {}
+    array_by_key = simulation.calculate_many(
+        [
+            'revenu_disponible',
+            ('salaire_net', 2013),
+            ('salaire_net', periods.period(2013)),
+            ('salaire_brut', '2013-01'),
+            ],
+        timing_by_variable_name = timing_by_variable_name,
+        )
+    assert array_by_key.keys() == [
+        ('revenu_disponible', periods.period(2013)),
+        ('salaire_net', periods.period(2013)),
+        ('salaire_brut', periods.period('2013-01')),
+        ]
+    assert_near(array_by_key[('salaire_net', periods.period(2013))], [3200], absolute_error_margin = 0.005)
+    assert_near(array_by_key[('salaire_brut', periods.period('2013-01'))], [4000. / 12], absolute_error_margin = 0.005)
+    assert sorted(timing_by_variable_name) == ['revenu_disponible', 'salaire_brut', 'salaire_net']
+
+
+def test_calculate_many_in_threads():
+    year = 2013
+    scenario = tax_benefit_system.new_scenario().init_single_entity(
+        axes = [
+            dict(
+                count = 3,
+                name = 'salaire_brut',
+                max = 100000,
+                min = 0,
+                ),
+            ],
+        period = year,
+        parent1 = dict(birth = datetime.date(1980, 1, 1)),
+        parent2 = dict(birth = datetime.date(1990, 1, 1)),
+        )
+    variables_name = ['salaire_net', 'age', 'salaire_imposable', 'dom_tom']
+    consumer_keys_by_variable_name = scenario.new_simulation().record_dependencies(variables_name)
+    get_input_variables_and_parameters = schedulers.new_input_variables_getter(consumer_keys_by_variable_name)
+
+    simulation = scenario.new_simulation()
+    keys = [(variable_name, periods.period(year)) for variable_name in variables_name]
+    assert schedulers.get_independent_keys_groups(simulation, keys, get_input_variables_and_parameters) == [
+        [keys[0], keys[2], keys[3]],
+        [keys[1]],
+        ]
+
+    timing_by_variable_name = {}
+    array_by_key = simulation.calculate_many(variables_name, timing_by_variable_name = timing_by_variable_name,
+        threads = 2, get_input_variables_and_parameters = get_input_variables_and_parameters)
+    assert array_by_key.keys() == keys
+    assert sorted(timing_by_variable_name) == sorted(variables_name)
+    expected_array_by_key = scenario.new_simulation().calculate_many(variables_name)
+    for key, array in array_by_key.iteritems():
+        assert (array == expected_array_by_key[key]).all(), key
+    assert simulation.holders_lock is None
+    assert not simulation.cycle_detection_state.active_formula_keys
+
+    # Use the dependencies found in the source code of the formulas.
+    assert tax_benefit_system.dependencies_by_variable_name['dom_tom_individu'] == (frozenset(['dom_tom']),
+        frozenset())
+    simulation = scenario.new_simulation()
+    assert schedulers.get_independent_keys_groups(simulation, keys,
+        tax_benefit_system.get_input_variables_and_parameters) == [[keys[0], keys[2], keys[3]], [keys[1]]]
+
+    # When the input variables of a formula are unknown, the keys are not split.
+    def get_input_variables_and_parameters(column):
+        if column.name == 'dom_tom':
+            return None, None
+        return tax_benefit_system.get_input_variables_and_parameters(column)
+
+    assert schedulers.get_independent_keys_groups(simulation, keys, get_input_variables_and_parameters) == [keys]
+    array_by_key = simulation.calculate_many(variables_name, threads = 2)
+    for key, array in array_by_key.iteritems():
+        assert (array == expected_array_by_key[key]).all(), key
+
+
+def test_evaluation_plan():
+    year = 2013
+    scenario = tax_benefit_system.new_scenario().init_single_entity(
+        axes = [
+            dict(
+                count = 3,
+                name = 'salaire_brut',
+                max = 100000,
+                min = 0,
+                ),
+            ],
+        famille = dict(depcom = '97123'),
+        period = year,
+        parent1 = dict(),
+        parent2 = dict(),
+        )
+    evaluation_plan = scenario.new_simulation().record_evaluation_plan(['rsa'], period = '2013-01')
+    year_period = periods.period(year)
+    # Each formula call comes after the formula calls it uses.
+    assert evaluation_plan == [
+        ('dom_tom', year_period),
+        ('dom_tom_individu', year_period),
+        ('salaire_net', year_period),
+        ('salaire_imposable', periods.period('2013-01')),
+        ('rsa', periods.period('2013-01')),
+        ]
+
+    simulation = scenario.new_simulation()
+    simulation.run_evaluation_plan(evaluation_plan)
+    expected_simulation = scenario.new_simulation()
+    assert (simulation.calculate('rsa', '2013-01') == expected_simulation.calculate('rsa', '2013-01')).all()
+    for variable_name, period in evaluation_plan:
+        array_by_period = simulation.get_holder(variable_name)._array_by_period
+        expected_array_by_period = expected_simulation.get_holder(variable_name)._array_by_period
+        assert sorted(array_by_period) == sorted(expected_array_by_period), variable_name
+        for period, array in array_by_period.iteritems():
+            assert (array == expected_array_by_period[period]).all(), (variable_name, period)
+
+
+def test_record_trace():
+    scenario = tax_benefit_system.new_scenario().init_single_entity(
+        axes = [
+            dict(
+                count = 3,
+                name = 'salaire_brut',
+                max = 100000,
+                min = 0,
+                ),
+            ],
+        famille = dict(depcom = '97123'),
+        period = 2013,
+        parent1 = dict(),
+        parent2 = dict(),
+        )
+    simulation = scenario.new_simulation()
+    trace_recorder = simulation.record_trace(['rsa'], period = '2013-01', capacity = 2)
+    assert simulation.dependencies_tracker is None
+    records = trace_recorder.get_records()
+    assert len(records) == 5
+    assert (records['duration'] >= 0).all()
+    assert (trace_recorder.get_self_durations() <= records['duration']).all()
+    records_json = trace_recorder.to_json()
+    assert [record_json['variable_name'] for record_json in records_json] == \
+        ['rsa', 'salaire_imposable', 'dom_tom_individu', 'dom_tom', 'salaire_net']
+    assert [record_json['parent'] for record_json in records_json] == [-1, 0, 1, 2, 1]
+    assert records_json[0]['period'] == u'2013-01'
+    assert records_json[0]['stats'] == dict(count = 6, default_count = 2, max = 300, mean = 200, min = 0)
+    assert records_json[3]['stats'] == dict(count = 3, default_count = 0, max = True, mean = 1.0, min = True)
+
+
+def test_profiler():
+    scenario = tax_benefit_system.new_scenario().init_single_entity(
+        famille = dict(depcom = '97123'),
+        period = 2013,
+        parent1 = dict(salaire_brut = 24000),
+        )
+    simulation = scenario.new_simulation()
+    simulation.profiler = profiler = profilers.Profiler()
+    simulation.calculate_add('rsa', 2013)
+    simulation.calculate('rsa', '2013-01')
+    assert not profiler.frames
+
+    rows = profiler.get_report(sort_by = 'calls', by_variable = True)
+    row_by_variable_name = dict((row['variable_name'], row) for row in rows)
+    # The addition of the months of rsa is profiled like a formula call.
+    assert rows[0]['calls'] == 13
+    assert row_by_variable_name['rsa']['calls'] == 13
+    assert row_by_variable_name['rsa']['cache_hits'] == 1
+    # The lookups of the months of rsa, made by calculate_add(), are not counted.
+    assert row_by_variable_name['rsa']['cache_misses'] == 1
+    assert row_by_variable_name['salaire_imposable']['calls'] == 12
+    assert row_by_variable_name['salaire_imposable']['cache_misses'] == 12
+    assert row_by_variable_name['rsa']['bytes'] == 13 * 4
+    assert row_by_variable_name['dom_tom']['calls'] == 1
+    for row in rows:
+        assert row['self_seconds'] <= row['inclusive_seconds'] + 1e-9
+    assert profiler.format_report(limit = 2).count(u'\n') == 2
+
+    folded_file = StringIO.StringIO()
+    profiler.write_folded_stacks(folded_file)
+    folded_paths = [line.rsplit(' ', 1)[0] for line in folded_file.getvalue().splitlines()]
+    assert 'rsa;rsa;salaire_imposable;dom_tom_individu;dom_tom' in folded_paths
@@ -1,9 +1,9 @@
 # -*- coding: utf-8 -*-
 
 
-from nose.tools import raises
+from nose.tools import assert_raises, raises
 
-from openfisca_core import periods
+from openfisca_core import caches, periods
 from openfisca_core.columns import IntCol
 from openfisca_core.formulas import CycleError
 from openfisca_core.variables import Variable
@@ -172,3 +172,70 @@ def test_cycle_1_level():
     variable7 = simulation.calculate('variable7')
     # variable8 = simulation.calculate('variable8')
     assert_near(variable7, [22])
+
+
+def test_cycles_counts():
+    simulation = tax_benefit_system.new_scenario().init_single_entity(
+        period = reference_period,
+        parent1 = dict(),
+        ).new_simulation()
+    simulation.calculate('variable7')
+    assert simulation.cycles_count == 1
+    assert simulation.cycle_default_values_count == 1
+    assert not simulation.cycle_detection_state.active_formula_keys
+    assert not simulation.cycle_detection_state.depth_by_variable_name
+    assert_raises(CycleError, simulation.calculate, 'variable3')
+    assert simulation.cycles_count == 2
+    assert simulation.cycle_default_values_count == 1
+
+
+def test_requested_periods_by_variable_name():
+    simulation = tax_benefit_system.new_scenario().init_single_entity(
+        period = reference_period,
+        parent1 = dict(),
+        ).new_simulation()
+    simulation.max_nb_cycles = 1
+    formula = simulation.get_or_new_holder('variable7').formula
+    formula.check_for_cycle(reference_period)
+    formula.check_for_cycle(reference_period.last_year)
+    assert simulation.requested_periods_by_variable_name == {
+        'variable7': [reference_period.last_year, reference_period],
+        }
+    # Without a period, the call to clean is ambiguous...
+    assert_raises(AssertionError, formula.clean_cycle_detection_data)
+    formula.clean_cycle_detection_data(reference_period.last_year)
+    # ... unless the variable has a single active call.
+    formula.clean_cycle_detection_data()
+    assert simulation.requested_periods_by_variable_name == {}
+    assert not simulation.cycle_detection_state.active_formula_keys
+
+
+def test_evaluation_plan_with_cycles():
+    scenario = tax_benefit_system.new_scenario().init_single_entity(
+        period = reference_period,
+        parent1 = dict(),
+        )
+    evaluation_plan = scenario.new_simulation().record_evaluation_plan(['variable7', 'cotisation'],
+        period = periods.period('2013-12'))
+    # The formula calls where cycles are allowed are not planned, but computed recursively.
+    assert evaluation_plan == [
+        ('variable7', periods.period('2013-12')),
+        ('cotisation', periods.period('2013-12')),
+        ]
+    simulation = scenario.new_simulation()
+    simulation.run_evaluation_plan(evaluation_plan)
+    assert_near(simulation.calculate('variable7', '2013-12'), [22])
+    assert_near(simulation.calculate('cotisation', '2013-12'), [2])
+
+
+def test_evaluation_plan_with_error():
+    simulation = tax_benefit_system.new_scenario().init_single_entity(
+        period = reference_period,
+        parent1 = dict(),
+        ).new_simulation()
+    simulation.dependencies_tracker = recorder = caches.EvaluationPlanRecorder(simulation)
+    # The formula calls raising an error are not planned.
+    assert_raises(CycleError, simulation.calculate, 'variable3')
+    assert recorder.formula_keys == []
+    simulation.calculate('cotisation', '2013-12')
+    assert recorder.formula_keys == [('cotisation', periods.period('2013-12'))]
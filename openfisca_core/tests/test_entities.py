@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+
+import numpy as np
+
+from openfisca_core.tests import dummy_country
+from openfisca_core.tools import assert_near
+
+
+tax_benefit_system = dummy_country.DummyTaxBenefitSystem()
+
+
+def new_simulation():
+    return tax_benefit_system.new_scenario().init_from_attributes(
+        period = 2015,
+        input_variables = {
+            'id_famille': [1, 0, 1, 0, 1],
+            'role_dans_famille': [0, 0, 1, 1, 2],
+            },
+        ).new_simulation()
+
+
+def test_entity_membership():
+    simulation = new_simulation()
+    familles = simulation.entity_by_key_plural['familles']
+    membership = simulation.get_entity_membership(familles)
+    assert_near(membership.offsets, [0, 2, 5], absolute_error_margin = 0)
+    assert_near(membership.sorted_persons, [1, 3, 0, 2, 4], absolute_error_margin = 0)
+    persons_positions, members_positions = membership.get_role_positions(1)
+    assert_near(persons_positions, [2, 3], absolute_error_margin = 0)
+    assert_near(members_positions, [1, 0], absolute_error_margin = 0)
+    assert simulation.get_entity_membership(familles) is membership
+
+
+def test_entity_membership_invalidation():
+    simulation = new_simulation()
+    familles = simulation.entity_by_key_plural['familles']
+    membership = simulation.get_entity_membership(familles)
+    simulation.get_holder('role_dans_famille').array = np.array([1, 1, 0, 0, 2])
+    new_membership = simulation.get_entity_membership(familles)
+    assert new_membership is not membership
+    persons_positions, members_positions = new_membership.get_role_positions(1)
+    assert_near(persons_positions, [0, 1], absolute_error_margin = 0)
+
+
+def test_entity_membership_aggregate():
+    simulation = new_simulation()
+    membership = simulation.get_entity_membership(simulation.entity_by_key_plural['familles'])
+    array = np.array([1., 2., -3., 4., 0.])
+    assert_near(membership.aggregate(array, 'add'), [6, -2], absolute_error_margin = 0)
+    assert_near(membership.aggregate(array, 'count'), [2, 2], absolute_error_margin = 0)
+    assert_near(membership.aggregate(array, 'max'), [4, 1], absolute_error_margin = 0)
+    assert_near(membership.aggregate(array, 'min'), [2, -3], absolute_error_margin = 0)
+    assert (membership.aggregate(array > 3, 'or') == [True, False]).all()
+    assert_near(membership.aggregate(array, 'max', roles = [1, 2]), [4, 0], absolute_error_margin = 0)
+    assert_near(membership.aggregate(array, 'min', default = 99, roles = [2]), [99, 0], absolute_error_margin = 0)
+    # The sums of entity members without persons are 0, with the default value of integers or floats.
+    for dtype in (np.float32, np.int32):
+        shifted_array = (array + 5).astype(dtype)
+        assert_near(membership.aggregate(shifted_array, 'add', default = 99, roles = [2]), [0, 5],
+            absolute_error_margin = 0)
+        assert_near(membership.aggregate(shifted_array, 'count', default = 99, roles = [2]), [0, 1],
+            absolute_error_margin = 0)
@@ -2,12 +2,16 @@
 
 
 import numpy as np
+from nose.tools import assert_raises
 
-from openfisca_core.columns import IntCol
-from openfisca_core.variables import Variable
+from openfisca_core.columns import FloatCol, IntCol
+from openfisca_core.variables import PersonToEntityColumn, Variable
 from openfisca_core.formula_helpers import switch
+from openfisca_core.reforms import Reform
+from openfisca_core import dependencies, legislations, profilers
 from openfisca_core.tests import dummy_country
-from openfisca_core.tests.dummy_country import Individus
+from openfisca_core.tests.dummy_country import Familles, Individus
+from openfisca_core.tools import assert_near
 
 
 class choice(Variable):
@@ -26,6 +30,144 @@ class uses_multiplication(Variable):
         return period, result
 
 
+class uses_computed_variable_name(Variable):
+    column = IntCol
+    entity_class = Individus
+    label = u'Variable with formula that calculates a variable whose name is not a literal'
+
+    def function(self, simulation, period):
+        variable_name = 'choice'
+        return period, simulation.calculate(variable_name, period)
+
+
+class uses_parameters(Variable):
+    column = IntCol
+    entity_class = Individus
+    label = u'Variable with formula that uses parameters'
+
+    def function(self, simulation, period):
+        legislation = simulation.legislation_at(period.start)
+        tax_scale = legislation.impot.bareme
+        choice = simulation.calculate('choice', period)
+        return period, tax_scale.calc(choice) * legislation.impot.taux * \
+            simulation.legislation_at(period.start)['csg'].taux
+
+
+class uses_computed_parameter_name(Variable):
+    column = FloatCol
+    entity_class = Individus
+    label = u'Variable with formula that uses a parameter and reads its legislation node with a computed key'
+
+    def function(self, simulation, period):
+        csg = simulation.legislation_at(period.start).csg
+        choice = simulation.calculate('choice', period)
+        return period, csg.activite.deductible.abattement.calc(choice) * csg[self.name] * \
+            getattr(simulation.legislation_at(period.start).impot, self.name)
+
+
+class uses_parameters_famille(PersonToEntityColumn):
+    entity_class = Familles
+    label = u'Variable converting a variable with formula that uses parameters'
+    operation = 'add'
+    variable = uses_parameters
+
+
+class uses_csg(Variable):
+    column = FloatCol
+    entity_class = Individus
+    label = u'Variable with formula that uses parameters of the test legislation'
+
+    def function(self, simulation, period):
+        activite = simulation.legislation_at(period.start).csg.activite
+        choice = simulation.calculate('choice', period)
+        return period, activite.deductible.abattement.calc(choice * 1000.) + choice * activite.crds.activite.taux
+
+
+class uses_csg_twice(Variable):
+    column = FloatCol
+    entity_class = Individus
+    label = u'Variable with formula that uses a variable using parameters'
+
+    def function(self, simulation, period):
+        return period, simulation.calculate('uses_csg', period) * 2
+
+
+def calculate_choice(simulation, period):
+    return simulation.calculate('choice', period)
+
+
+def get_csg_taux(legislation):
+    return legislation.csg.activite.deductible.taux
+
+
+class uses_helper(Variable):
+    column = IntCol
+    entity_class = Individus
+    label = u'Variable with formula that gives the simulation to a function'
+
+    def function(self, simulation, period):
+        return period, calculate_choice(simulation, period)
+
+
+class uses_whole_legislation(Variable):
+    column = FloatCol
+    entity_class = Individus
+    label = u'Variable with formula that gives the legislation to a function'
+
+    def function(self, simulation, period):
+        legislation = simulation.legislation_at(period.start)
+        return period, simulation.calculate('choice', period) * get_csg_taux(legislation)
+
+
+class uses_calculate_alias(Variable):
+    column = IntCol
+    entity_class = Individus
+    label = u'Variable with formula that calculates a variable through an alias of simulation.calculate'
+
+    def function(self, simulation, period):
+        calculate = simulation.calculate
+        return period, calculate('choice', period)
+
+
+class uses_legislation_at_alias(Variable):
+    column = FloatCol
+    entity_class = Individus
+    label = u'Variable with formula that reads the legislation through an alias of simulation.legislation_at'
+
+    def function(self, simulation, period):
+        legislation_at = simulation.legislation_at
+        return period, self.zeros() + legislation_at(period.start).csg.activite.deductible.taux
+
+
+class uses_simulation_in_container(Variable):
+    column = IntCol
+    entity_class = Individus
+    label = u'Variable with formula that gives the simulation to a function inside a list'
+
+    def function(self, simulation, period):
+        return period, calculate_choice(*[simulation, period])
+
+
+class uses_simulation_alias(Variable):
+    column = IntCol
+    entity_class = Individus
+    label = u'Variable with formula that binds the simulation to another name'
+
+    def function(self, simulation, period):
+        other_simulation = simulation
+        return period, other_simulation.calculate('choice', period)
+
+
+class uses_legislation_node_in_container(Variable):
+    column = FloatCol
+    entity_class = Individus
+    label = u'Variable with formula that gives a legislation node to a function inside a list'
+
+    def function(self, simulation, period):
+        csg = simulation.legislation_at(period.start).csg
+        return period, self.zeros() + get_csg_taux(*[csg]) * csg.activite.crds.activite.taux
+
+
 class uses_switch(Variable):
     column = IntCol
     entity_class = Individus
@@ -45,7 +187,10 @@ class uses_switch(Variable):
 
 # TaxBenefitSystem instance declared after formulas
 tax_benefit_system = dummy_country.DummyTaxBenefitSystem()
-tax_benefit_system.add_variables(choice, uses_multiplication, uses_switch)
+tax_benefit_system.add_variables(choice, uses_calculate_alias, uses_computed_parameter_name,
+    uses_computed_variable_name, uses_csg, uses_csg_twice, uses_helper, uses_legislation_at_alias,
+    uses_legislation_node_in_container, uses_multiplication, uses_parameters, uses_parameters_famille,
+    uses_simulation_alias, uses_simulation_in_container, uses_switch, uses_whole_legislation)
 scenario = tax_benefit_system.new_scenario().init_from_attributes(
     period = 2013,
     input_variables = {
@@ -55,6 +200,18 @@ scenario = tax_benefit_system.new_scenario().init_from_attributes(
     )
 
 
+def double_abattement(legislation_json):
+    abattement_json = legislation_json['children']['csg']['children']['activite']['children']['deductible'][
+        'children']['abattement']
+    abattement_json['brackets'][0]['rate'][0]['value'] = 0.035
+    return legislation_json
+
+
+class abattement_doubling(Reform):
+    def apply(self):
+        self.modify_legislation_json(modifier_function = double_abattement)
+
+
 def test_switch():
     simulation = scenario.new_simulation(debug = True)
     uses_switch = simulation.calculate('uses_switch')
@@ -72,3 +229,93 @@ def test_compare_multiplication_and_switch():
     uses_multiplication = simulation.calculate('uses_multiplication')
     uses_switch = simulation.calculate('uses_switch')
     assert np.all(uses_switch == uses_multiplication)
+
+
+def test_static_dependencies():
+    dependencies_by_variable_name = tax_benefit_system.dependencies_by_variable_name
+    assert dependencies_by_variable_name['choice'] == (frozenset(), frozenset())
+    assert dependencies_by_variable_name['uses_computed_variable_name'] == (None, frozenset())
+    assert dependencies_by_variable_name['uses_parameters'] == (
+        frozenset(['choice']),
+        frozenset(['csg.taux', 'impot.bareme', 'impot.taux']),
+        )
+    assert dependencies_by_variable_name['uses_switch'] == (frozenset(['choice']), frozenset())
+    # The legislation nodes read with a computed key are kept with the longer paths of their parameters.
+    assert dependencies_by_variable_name['uses_computed_parameter_name'] == (
+        frozenset(['choice']),
+        frozenset(['csg', 'csg.activite.deductible.abattement', 'impot']),
+        )
+    # The simulation or the whole legislation given to another function can be used in any way.
+    assert dependencies_by_variable_name['uses_helper'] == (None, None)
+    assert dependencies_by_variable_name['uses_whole_legislation'] == (frozenset(['choice']), None)
+    # Any other use of the simulation than calling one of its methods hides the dependencies.
+    for variable_name in ('uses_calculate_alias', 'uses_legislation_at_alias', 'uses_simulation_alias',
+            'uses_simulation_in_container'):
+        assert dependencies_by_variable_name[variable_name] == (None, None), variable_name
+    assert dependencies_by_variable_name['uses_legislation_node_in_container'] == (
+        frozenset(),
+        frozenset(['csg', 'csg.activite.crds.activite.taux']),
+        )
+    column = tax_benefit_system.get_column('uses_switch')
+    assert tax_benefit_system.get_input_variables_and_parameters(column) == \
+        dependencies.get_formula_class_dependencies(column.formula_class)
+
+
+def test_dependencies_tracker_after_error():
+    simulation = scenario.new_simulation()
+    simulation.record_parameters_access()
+    # The test legislation has no "impot" node.
+    assert_raises(legislations.ParameterNotFound, simulation.calculate, 'uses_parameters')
+    assert simulation.dependencies_tracker.formula_keys_stack == []
+
+
+def test_profiler_after_error():
+    simulation = scenario.new_simulation()
+    simulation.profiler = profiler = profilers.Profiler()
+    assert_raises(legislations.ParameterNotFound, simulation.calculate, 'uses_parameters_famille')
+    assert not profiler.frames
+    for variable_name in ('uses_parameters', 'uses_parameters_famille'):
+        profile = profiler.profile_by_key[(variable_name, simulation.period)]
+        assert profile.calls == 1
+        assert profile.bytes == 0
+
+
+def test_invalidate_parameters():
+    simulation = scenario.new_simulation()
+    simulation.record_parameters_access()
+    uses_csg_twice = simulation.calculate('uses_csg_twice')
+    uses_multiplication = simulation.calculate('uses_multiplication')
+    parameters_name_by_formula_key = simulation.dependencies_tracker.parameters_name_by_formula_key
+    assert parameters_name_by_formula_key == {
+        ('uses_csg', simulation.period): set(['csg.activite.deductible.abattement', 'csg.activite.crds.activite.taux']),
+        }
+    assert simulation.invalidate_parameters(['csg.activite.crds.retraite']) == set()
+
+    # Double the rate of the first bracket of the abattement: 0.0175 * 4 is added to uses_csg.
+    reform = abattement_doubling(tax_benefit_system)
+    assert simulation.set_tax_benefit_system(reform) == set(['uses_csg', 'uses_csg_twice'])
+    assert simulation.tax_benefit_system is reform
+    assert simulation.get_holder('uses_csg_twice').get_array(simulation.period) is None
+    assert simulation.get_holder('uses_multiplication').get_array(simulation.period) is uses_multiplication
+    assert simulation.get_holder('choice').get_array(simulation.period) is not None
+    assert_near(simulation.calculate('uses_csg_twice'), uses_csg_twice + 2 * 0.0175 * 4, absolute_error_margin = 1e-6)
+    assert simulation.calculate('uses_multiplication') is uses_multiplication
+
+
+def test_record_parameters_access_after_calculation():
+    simulation = scenario.new_simulation()
+    simulation.calculate('uses_csg')
+    # The parameters read by uses_csg are unknown, so its array could not be invalidated.
+    assert_raises(AssertionError, simulation.record_parameters_access)
+
+
+def test_record_parameters_access_in_clone():
+    simulation = scenario.new_simulation()
+    simulation.record_parameters_access()
+    simulation.calculate('uses_multiplication')
+    parameters_name_by_formula_key = simulation.dependencies_tracker.parameters_name_by_formula_key
+    clone = simulation.clone()
+    clone.calculate('uses_csg_twice')
+    assert parameters_name_by_formula_key == {}
+    assert 'uses_csg' not in simulation.dependencies_tracker.consumer_keys_by_variable_name
+    assert ('uses_csg', clone.period) in clone.dependencies_tracker.parameters_name_by_formula_key
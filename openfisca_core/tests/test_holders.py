@@ -1,8 +1,12 @@
 # -*- coding: utf-8 -*-
 
 
+import gc
+import weakref
+
 import numpy
 
+from openfisca_core import holders, periods, profilers
 from . import test_countries
 
 
@@ -26,3 +30,198 @@ def test_new_test_case_array():
     salaire_brut = simulation.get_holder('salaire_brut').new_test_case_array(simulation.period)
     assert (salaire_brut - numpy.linspace(axis_min, axis_max, axis_count) == 0).all(), \
         u'salaire_brut: {}'.format(salaire_brut)
+
+
+def test_period_array_store():
+    store = holders.PeriodArrayStore()
+    for month in (3, 1, 2):
+        store[periods.period('2014-{:02d}'.format(month))] = numpy.array([month, 10 * month])
+    store[periods.period(2013)] = numpy.array([0, 0])
+    assert store.keys() == [periods.period(key) for key in ('2014-01', '2014-02', '2014-03', 2013)]
+
+    block = store.get_months_block(periods.instant('2014-01'), 3)
+    assert (block == [[1, 10], [2, 20], [3, 30]]).all()
+    assert (store[periods.period('2014-02')] == block[1]).all()
+    assert store.get_months_block(periods.instant('2014-01'), 4) is None
+
+    last_period, last_array = store.get_last_item(periods.period('2014-05'))
+    assert last_period == periods.period(2013)
+    last_period, last_array = store.get_last_item(periods.period('2014-02'), cover_stop = True)
+    assert last_period == periods.period('2014-02')
+
+    new_store = store.copy()
+    new_store[periods.period('2014-01')] = numpy.array([-1, -1])
+    assert (store[periods.period('2014-01')] == [1, 10]).all()
+    assert (new_store.get_months_block(periods.instant('2014-01'), 1) == [[-1, -1]]).all()
+    del new_store[periods.period('2014-02')]
+    assert new_store.get_months_block(periods.instant('2014-01'), 3) is None
+    assert store.get_months_block(periods.instant('2014-01'), 3) is not None
+
+
+def test_period_array_store_memory():
+    store = holders.PeriodArrayStore()
+    store[periods.period('2000-01')] = numpy.array([1, 1])
+    # A far month is stored apart, instead of adding 180 empty rows to the buffer.
+    store[periods.period('2015-01')] = numpy.array([2, 2])
+    assert len(store._buffer) == 1
+    assert (store[periods.period('2015-01')] == [2, 2]).all()
+
+    for month in range(2, 13):
+        store[periods.period('2000-{:02d}'.format(month))] = numpy.array([month, month])
+    assert len(store._buffer) <= 12 + holders.PeriodArrayStore.max_gap_months
+    for month in range(1, 12):
+        del store[periods.period('2000-{:02d}'.format(month))]
+    # The buffer shrinks to its filled rows...
+    assert len(store._buffer) == 1
+    assert (store[periods.period('2000-12')] == [12, 12]).all()
+    assert (store.get_months_block(periods.instant('2000-12'), 1) == [[12, 12]]).all()
+    # ... and is freed once empty.
+    del store[periods.period('2000-12')]
+    assert store._buffer is None
+    assert store.keys() == [periods.period('2015-01')]
+
+
+def test_period_array_store_overwrite():
+    store = holders.PeriodArrayStore()
+    for month in (1, 2, 3):
+        store[periods.period('2014-{:02d}'.format(month))] = numpy.array([month, month])
+    january = store[periods.period('2014-01')]
+    february = store[periods.period('2014-02')]
+    store[periods.period('2014-01')] = numpy.array([-1, -1])
+    # The arrays returned before are not modified by the new arrays of their months.
+    assert (january == [1, 1]).all()
+    assert (store[periods.period('2014-01')] == [-1, -1]).all()
+    del store[periods.period('2014-02')]
+    store[periods.period('2014-02')] = numpy.array([-2, -2])
+    assert (february == [2, 2]).all()
+    assert (store.get_months_block(periods.instant('2014-01'), 3) == [[-1, -1], [-2, -2], [3, 3]]).all()
+
+
+def test_period_store_simulation():
+    def calculate(period_store):
+        simulation = test_countries.tax_benefit_system.new_scenario().init_single_entity(
+            axes = [
+                dict(
+                    count = 3,
+                    name = 'salaire_brut',
+                    max = 100000,
+                    min = 0,
+                    ),
+                ],
+            period = 2014,
+            parent1 = {},
+            ).new_simulation(period_store = period_store)
+        assert isinstance(simulation.get_holder('salaire_brut')._array_by_period, holders.PeriodArrayStore) \
+            == period_store
+        return simulation.calculate('revenu_disponible')
+
+    assert (calculate(True) == calculate(False)).all()
+
+
+def test_compute_add_known_months():
+    def new_simulation(period_store):
+        return test_countries.tax_benefit_system.new_scenario().init_single_entity(
+            axes = [
+                dict(
+                    count = 3,
+                    name = 'salaire_brut',
+                    max = 10000,
+                    min = 0,
+                    ),
+                ],
+            period = 2013,
+            parent1 = {},
+            ).new_simulation(period_store = period_store)
+
+    expected_rsa = new_simulation(False).calculate_add('rsa', 2013)
+    for period_store in (False, True):
+        simulation = new_simulation(period_store)
+        for month in range(1, 13):
+            simulation.calculate('rsa', '2013-{:02d}'.format(month))
+        assert (simulation.calculate_add('rsa', 2013) == expected_rsa).all()
+        assert (simulation.calculate_add('rsa', '2013-03:3') == expected_rsa / 4).all()
+        assert (simulation.calculate_add_divide('rsa', '2013-02:2') == expected_rsa / 6).all()
+
+
+def test_compute_add_from_empty_cache():
+    def new_simulation(**kwargs):
+        return test_countries.tax_benefit_system.new_scenario().init_single_entity(
+            axes = [
+                dict(
+                    count = 3,
+                    name = 'salaire_brut',
+                    max = 10000,
+                    min = 0,
+                    ),
+                ],
+            period = 2013,
+            parent1 = {},
+            ).new_simulation(**kwargs)
+
+    simulation = new_simulation()
+    months_rsa = [simulation.calculate('rsa', '2013-{:02d}'.format(month)) for month in range(1, 13)]
+    for kwargs in (dict(), dict(period_store = True), dict(cache_max_bytes = 0)):
+        simulation = new_simulation(**kwargs)
+        simulation.profiler = profiler = profilers.Profiler()
+        assert (simulation.calculate_add('rsa', 2013) == sum(months_rsa)).all()
+        # Each month is computed once (the first one when the year is requested), before they are added.
+        rsa_calls_by_period = dict(
+            (period, profile.calls)
+            for (variable_name, period), profile in profiler.profile_by_key.iteritems()
+            if variable_name == 'rsa'
+            )
+        year = periods.period(2013)
+        assert set(rsa_calls_by_period) == set([year] + [periods.period('2013-{:02d}'.format(month))
+            for month in range(2, 13)])
+        # The addition is profiled too.
+        assert rsa_calls_by_period.pop(year) == 2
+        assert set(rsa_calls_by_period.itervalues()) == set([1])
+        simulation = new_simulation(**kwargs)
+        assert (simulation.calculate_add_divide('rsa', '2013-02:2') == sum(months_rsa[1:3])).all()
+
+
+def test_clone_copy_on_write():
+    for period_store in (False, True):
+        simulation = test_countries.tax_benefit_system.new_scenario().init_single_entity(
+            period = 2013,
+            parent1 = dict(salaire_brut = 12000),
+            ).new_simulation(period_store = period_store)
+        simulation.calculate('salaire_net')
+        holder = simulation.get_holder('salaire_net')
+        new_simulation = simulation.clone()
+        new_holder = new_simulation.get_holder('salaire_net')
+        assert new_holder._array_by_period is holder._array_by_period
+
+        new_holder.put_in_cache(numpy.array([0.]), periods.period(2013))
+        assert new_holder._array_by_period is not holder._array_by_period
+        assert new_simulation.calculate('salaire_net')[0] == 0
+        assert simulation.calculate('salaire_net')[0] != 0
+
+        # The original holder copies the shared store too, before modifying it.
+        other_simulation = simulation.clone()
+        holder.delete_array(periods.period(2013))
+        assert holder.get_array(periods.period(2013)) is None
+        assert other_simulation.get_holder('salaire_net').get_array(periods.period(2013)) is not None
+
+
+def test_release_clone():
+    simulation = test_countries.tax_benefit_system.new_scenario().init_single_entity(
+        period = 2013,
+        parent1 = dict(salaire_brut = 12000),
+        ).new_simulation()
+    simulation.calculate('salaire_net')
+    new_simulation = simulation.clone()
+    new_simulation.calculate('revenu_disponible')
+    new_holder_reference = weakref.ref(new_simulation.get_holder('revenu_disponible'))
+    new_simulation_reference = weakref.ref(new_simulation)
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        new_simulation.release()
+        del new_simulation
+        assert new_simulation_reference() is None
+        assert new_holder_reference() is None
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    assert simulation.get_holder('salaire_net').get_array(periods.period(2013)) is not None
@@ -1,10 +1,14 @@
 # -*- coding: utf-8 -*-
 
 
+import numpy as np
+
+from openfisca_core import profilers
 from openfisca_core.tests import dummy_country
 from openfisca_core.variables import Variable
 from openfisca_core.columns import IntCol
 from openfisca_core.tests.dummy_country import Individus
+from openfisca_core.tools import assert_near
 
 
 class input(Variable):
@@ -79,3 +83,44 @@ def test_with_no_blacklist():
     simulation.calculate('output')
     intermediate_cache = simulation.get_or_new_holder('intermediate')
     assert(len(intermediate_cache._array_by_period) > 0)
+
+
+def test_release_arrays_after_last_use():
+    consumer_keys_by_variable_name = scenario2.new_simulation().record_dependencies(['output'])
+    assert sorted(consumer_keys_by_variable_name) == ['input', 'intermediate']
+
+    simulation = scenario2.new_simulation()
+    simulation.release_arrays_after_last_use(consumer_keys_by_variable_name, ['output'])
+    assert simulation.calculate('output') == 1
+    assert simulation.get_or_new_holder('intermediate')._array_by_period is None
+    # Input and output variables are kept.
+    assert len(simulation.get_or_new_holder('input')._array_by_period) > 0
+    assert len(simulation.get_or_new_holder('output')._array_by_period) > 0
+    # Released variables are computed again when requested.
+    assert simulation.calculate('intermediate') == 1
+
+
+def test_release_arrays_of_input_array_setter():
+    consumer_keys_by_variable_name = scenario2.new_simulation().record_dependencies(['output'])
+    simulation = tax_benefit_system2.new_scenario().init_from_attributes(period = 2016).new_simulation()
+    # The input array is given to the holder, not through set_input.
+    simulation.get_or_new_holder('input').array = np.array([1])
+    simulation.release_arrays_after_last_use(consumer_keys_by_variable_name, ['output'])
+    assert simulation.calculate('output') == 1
+    assert simulation.get_or_new_holder('intermediate')._array_by_period is None
+    # The input array, which can't be computed again, is kept.
+    assert_near(simulation.get_or_new_holder('input').array, [1], absolute_error_margin = 0)
+
+
+def test_evaluation_plan_with_cache_opt_out():
+    evaluation_plan = scenario.new_simulation().record_evaluation_plan(['output'])
+    assert [variable_name for variable_name, period in evaluation_plan] == ['intermediate', 'output']
+    simulation = scenario.new_simulation(opt_out_cache = True)
+    simulation.profiler = profiler = profilers.Profiler()
+    simulation.run_evaluation_plan(evaluation_plan)
+    # The blacklisted variable is calculated only once, when output needs it.
+    assert profiler.profile_by_key[('intermediate', simulation.period)].calls == 1
+    assert simulation.calculate('output') == 1
+    # Running the plan again doesn't call the formulas of the cached variables.
+    simulation.run_evaluation_plan(evaluation_plan)
+    assert profiler.profile_by_key[('output', simulation.period)].calls == 1
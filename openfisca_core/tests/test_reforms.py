@@ -1,17 +1,18 @@
 # -*- coding: utf-8 -*-
 
 import datetime
+from multiprocessing.pool import ThreadPool
 
 from nose.tools import raises
 from nose.tools import assert_equal
 
-from .. import columns, periods
+from .. import columns, legislations, periods
 from ..reforms import Reform, compose_reforms, updated_legislation_items
 from ..formulas import dated_function
 from ..variables import Variable, DatedVariable
 from ..periods import Instant
 from ..tools import assert_near
-from .dummy_country import Familles
+from .dummy_country import Familles, Individus
 from .test_countries import TestTaxBenefitSystem
 
 tax_benefit_system = TestTaxBenefitSystem()
@@ -309,3 +310,189 @@ def test_modify_legislation():
     instant = Instant((2013, 1, 1))
     compact_legislation = reform.get_compact_legislation(instant)
     assert compact_legislation.new_node.new_param is True
+
+
+def test_compact_node_cache():
+    reference = TestTaxBenefitSystem()
+    reference.compact_node_cache = legislations.CompactNodeCache()
+
+    def modify_legislation_json(reference_legislation_json_copy):
+        reference_legislation_json_copy['children']['csg']['children']['activite']['children']['deductible'][
+            'children']['taux']['values'][0]['value'] = 0.06
+        return reference_legislation_json_copy
+
+    class test_modify_taux(Reform):
+        def apply(self):
+            self.modify_legislation_json(modifier_function = modify_legislation_json)
+
+    reform = test_modify_taux(reference)
+    assert reform.compact_node_cache is reference.compact_node_cache
+
+    instant = Instant((2013, 1, 1))
+    reference_compact_legislation = reference.get_compact_legislation(instant)
+    assert_equal(reference.compact_node_cache.hits_count, 0)
+    reform_compact_legislation = reform.get_compact_legislation(instant)
+    assert reference.compact_node_cache.hits_count > 0
+    assert_equal(reference_compact_legislation.csg.activite.deductible.taux, 0.051)
+    assert_equal(reform_compact_legislation.csg.activite.deductible.taux, 0.06)
+    # Unmodified nodes are shared, until a tax-benefit system modifies its legislation.
+    reference_abattement = reference_compact_legislation.csg.activite.crds.activite.abattement
+    reform_abattement = reform_compact_legislation.csg.activite.crds.activite.abattement
+    assert reform_abattement is not reference_abattement
+    assert reform_abattement.rates is reference_abattement.rates
+    assert reform_abattement.thresholds is reference_abattement.thresholds
+    rates = list(reference_abattement.rates)
+    reform_abattement.multiply_rates(2)
+    assert reform_abattement.rates is not reference_abattement.rates
+    assert_equal(reform_abattement.rates, [rate * 2 for rate in rates])
+    assert_equal(reference_abattement.rates, rates)
+    reform_compact_legislation.csg.activite.crds.activite.taux = 0.01
+    assert_equal(reference_compact_legislation.csg.activite.crds.activite.taux, 0.005)
+    new_reform_compact_legislation = test_modify_taux(reference).get_compact_legislation(instant)
+    assert_equal(new_reform_compact_legislation.csg.activite.crds.activite.abattement.rates, rates)
+    assert_equal(new_reform_compact_legislation.csg.activite.crds.activite.taux, 0.005)
+
+
+def test_compact_node_cache_max_size():
+    compact_node_cache = legislations.CompactNodeCache(max_size = 2)
+    reference = TestTaxBenefitSystem()
+    reference.compact_node_cache = compact_node_cache
+    compact_legislation = reference.get_compact_legislation(Instant((2013, 1, 1)))
+    assert_equal(len(compact_node_cache.compact_node_by_key), 2)
+    assert_equal(compact_legislation.csg.activite.deductible.taux, 0.051)
+
+
+def test_compact_node_cache_in_threads():
+    compact_node_cache = legislations.CompactNodeCache(max_size = 5)
+    # The tax-benefit systems sharing the cache build their compact legislations at the same time.
+    instants = [Instant((year, 1, 1)) for year in range(2002, 2015)]
+    references = []
+    for instant in instants:
+        reference = TestTaxBenefitSystem()
+        reference.compact_node_cache = compact_node_cache
+        # Load the legislation before the threads, like simulations do.
+        reference.get_indexed_legislation()
+        references.append(reference)
+
+    def get_taux(index):
+        return references[index].get_compact_legislation(instants[index]).csg.activite.deductible.taux
+
+    pool = ThreadPool(4)
+    try:
+        taux_list = pool.map(get_taux, range(len(instants)))
+    finally:
+        pool.close()
+        pool.join()
+    expected_taux_list = [
+        legislations.compact_dated_node_json(legislations.generate_dated_legislation_json(
+            tax_benefit_system.get_legislation(), instant)).csg.activite.deductible.taux
+        for instant in instants
+        ]
+    assert_equal(taux_list, expected_taux_list)
+    assert len(compact_node_cache.compact_node_by_key) <= 5
+
+
+def test_changed_parameters_name():
+    def modify_legislation_json(reference_legislation_json_copy):
+        reference_legislation_json_copy['children']['csg']['children']['activite']['children']['deductible'][
+            'children']['taux']['values'][0]['value'] = 0.06
+        return reference_legislation_json_copy
+
+    class test_modify_taux(Reform):
+        def apply(self):
+            self.modify_legislation_json(modifier_function = modify_legislation_json)
+
+    reform = test_modify_taux(tax_benefit_system)
+    assert legislations.get_changed_parameters_name(reform.get_legislation(), tax_benefit_system.get_legislation()) \
+        == set([u'csg.activite.deductible.taux'])
+    # No variable of the test country uses this parameter.
+    assert reform.get_affected_variables_name() == set()
+
+
+def test_differential_simulation():
+    class rsa(Variable):
+        column = columns.FloatCol
+        entity_class = Individus
+        label = u"RSA"
+
+        def function(self, simulation, period):
+            period = period.start.period(u'month').offset('first-of')
+            salaire_imposable = simulation.calculate_divide('salaire_imposable', period)
+            return period, (salaire_imposable < 5000) * 400.0
+
+    class test_new_rsa(Reform):
+        def apply(self):
+            self.update_variable(rsa)
+
+    class test_salaire_brut_neutralization(Reform):
+        def apply(self):
+            self.neutralize_column('salaire_brut')
+
+    for reform_class in (test_new_rsa, test_salaire_brut_neutralization):
+        reform = reform_class(tax_benefit_system)
+        scenario = reform.new_scenario().init_single_entity(
+            period = 2013,
+            famille = dict(depcom = '75101'),
+            parent1 = dict(salaire_brut = 24000),
+            parent2 = dict(salaire_brut = 96000),
+            )
+        reference_simulation = scenario.new_simulation(reference = True)
+        delta_by_key = reform.calculate_deltas(reference_simulation, ['revenu_disponible', 'salaire_imposable'])
+        expected_delta = scenario.new_simulation().calculate('revenu_disponible') - \
+            reference_simulation.calculate('revenu_disponible')
+        assert_near(delta_by_key[('revenu_disponible', periods.period(2013))], expected_delta,
+            absolute_error_margin = 0)
+
+    assert test_new_rsa(tax_benefit_system).get_affected_variables_name() == \
+        set(['rsa', 'revenu_disponible', 'revenu_disponible_famille'])
+    simulation = reform.new_differential_simulation(reference_simulation)
+    # Unaffected variables reuse the arrays of the reference simulation.
+    assert simulation.get_holder('dom_tom')._array_by_period is \
+        reference_simulation.get_holder('dom_tom')._array_by_period
+    assert 'salaire_net' not in simulation.holder_by_name
+    assert_near(simulation.calculate('salaire_brut'), [0, 0], absolute_error_margin = 0)
+
+
+def calculate_salaire_net(simulation, period):
+    return simulation.calculate('salaire_net', period)
+
+
+def test_differential_simulation_with_unknown_dependencies():
+    class revenu_net(Variable):
+        column = columns.FloatCol
+        entity_class = Individus
+        label = u"Revenu net, calculated by another function"
+
+        def function(self, simulation, period):
+            period = period.start.period(u'year').offset('first-of')
+            return period, calculate_salaire_net(simulation, period)
+
+    class salaire_net(Variable):
+        column = columns.FloatCol
+        entity_class = Individus
+        label = u"Salaire net"
+
+        def function(self, simulation, period):
+            period = period.start.period(u'year').offset('first-of')
+            return period, simulation.calculate('salaire_brut', period) * 0.5
+
+    class test_revenu_net(Reform):
+        def apply(self):
+            self.add_variable(revenu_net)
+
+    class test_new_salaire_net(Reform):
+        def apply(self):
+            self.update_variable(salaire_net)
+
+    base = test_revenu_net(tax_benefit_system)
+    reform = test_new_salaire_net(base)
+    assert base.dependencies_by_variable_name['revenu_net'] == (None, None)
+    assert 'revenu_net' in reform.get_affected_variables_name()
+
+    scenario = base.new_scenario().init_single_entity(
+        period = 2013,
+        parent1 = dict(salaire_brut = 24000),
+        )
+    reference_simulation = scenario.new_simulation()
+    delta_by_key = reform.calculate_deltas(reference_simulation, ['revenu_net'])
+    assert_near(delta_by_key[('revenu_net', periods.period(2013))], [-7200], absolute_error_margin = 0)
@@ -1,8 +1,8 @@
 # -*- coding: utf-8 -*-
 
-from nose.tools import assert_equal
+from nose.tools import assert_equal, assert_raises
 
-from openfisca_core import legislations
+from openfisca_core import legislations, periods, taxscales
 from openfisca_core.tests.dummy_country import DummyTaxBenefitSystem
 
 
@@ -16,3 +16,120 @@ def test_multiple_xml_based_tax_benefit_system():
     compact_legislation = legislations.compact_dated_node_json(dated_legislation_json)
     assert_equal(compact_legislation.csg.activite.deductible.taux, 0.051)
     assert_equal(compact_legislation.csg.activite.crds.activite.taux, 0.005)
+
+
+def test_indexed_legislation():
+    tax_benefit_system = DummyTaxBenefitSystem()
+    legislation_json = tax_benefit_system.get_legislation()
+    indexed_legislation_json = tax_benefit_system.get_indexed_legislation()
+    assert tax_benefit_system.get_indexed_legislation() is indexed_legislation_json
+    for instant in ('1990-01-01', '2002-12-31', '2012-01-01', '2015-06-01', '2100-01-01'):
+        assert_equal(
+            legislations.generate_dated_legislation_json(indexed_legislation_json, instant),
+            legislations.generate_dated_legislation_json(legislation_json, instant),
+            )
+
+
+def test_indexed_legislation_after_cache_reset():
+    for compact_node_cache in (None, legislations.CompactNodeCache()):
+        tax_benefit_system = DummyTaxBenefitSystem()
+        tax_benefit_system.compact_node_cache = compact_node_cache
+        instant = periods.instant('2013-01-01')
+        assert_equal(tax_benefit_system.get_compact_legislation(instant).csg.activite.deductible.taux, 0.051)
+        # Modify the legislation JSON in place, then reset the cache of compact legislations.
+        tax_benefit_system.get_legislation()['children']['csg']['children']['activite']['children']['deductible'][
+            'children']['taux']['values'][0]['value'] = 0.06
+        tax_benefit_system.compact_legislation_by_instant_cache = {}
+        assert_equal(tax_benefit_system.get_compact_legislation(instant).csg.activite.deductible.taux, 0.06)
+
+
+def test_values_timeline():
+    values_json = [
+        dict(start = u'2010-01-01', value = 3),
+        dict(start = u'2005-01-01', stop = u'2009-12-31', value = 2),
+        dict(start = u'2000-01-01', stop = u'2003-12-31', value = 1),
+        ]
+    values_timeline = legislations.ValuesTimeline(values_json)
+    assert values_timeline.starts is not None
+    for instant_str, value in (('1999-12-31', None), ('2000-01-01', 1), ('2004-01-01', None), ('2009-12-31', 2),
+            ('2010-01-01', 3), ('2020-01-01', 3)):
+        assert_equal(values_timeline.get(instant_str), value)
+        assert_equal(legislations.generate_dated_json_value(values_json, instant_str), value)
+    # Overlapping values are scanned in their original order.
+    values_timeline = legislations.ValuesTimeline([dict(start = u'2000-01-01', value = 1)] + values_json)
+    assert values_timeline.starts is None
+    assert_equal(values_timeline.get(u'2010-01-01'), 1)
+
+
+def compact_node_to_json(compact_node):
+    if isinstance(compact_node, legislations.TracedCompactNode):
+        compact_node = compact_node.compact_node
+    if isinstance(compact_node, legislations.CompactNode):
+        return {
+            key: compact_node_to_json(value)
+            for key, value in compact_node.iteritems()
+            }
+    if isinstance(compact_node, taxscales.AbstractTaxScale):
+        return (compact_node.__class__.__name__, compact_node.thresholds, getattr(compact_node, 'rates', None),
+            getattr(compact_node, 'amounts', None))
+    return compact_node
+
+
+def test_lazy_compact_legislation():
+    tax_benefit_system = DummyTaxBenefitSystem()
+    legislation_json = tax_benefit_system.get_indexed_legislation()
+    for instant in ('2002-12-31', '2012-01-01', '2015-06-01'):
+        lazy_compact_legislation = legislations.lazy_compact_node_json(legislation_json, instant)
+        assert not lazy_compact_legislation.__dict__.get('csg')
+        compact_legislation = legislations.compact_dated_node_json(
+            legislations.generate_dated_legislation_json(legislation_json, instant))
+        assert_equal(compact_node_to_json(lazy_compact_legislation), compact_node_to_json(compact_legislation))
+
+    lazy_compact_legislation = legislations.lazy_compact_node_json(legislation_json, '2012-01-01')
+    assert_equal(lazy_compact_legislation.csg.activite.deductible.taux, 0.051)
+    assert_equal(lazy_compact_legislation['csg']['activite']['crds']['activite']['taux'], 0.005)
+    assert_raises(legislations.ParameterNotFound, getattr, lazy_compact_legislation.csg, 'inexistent')
+
+
+def test_lazy_compact_legislation_copy_and_update():
+    tax_benefit_system = DummyTaxBenefitSystem()
+    legislation_json = tax_benefit_system.get_indexed_legislation()
+    compact_legislation = legislations.compact_dated_node_json(
+        legislations.generate_dated_legislation_json(legislation_json, '2012-01-01'))
+    for deep in (False, True):
+        copied_legislation = legislations.lazy_compact_node_json(legislation_json, '2012-01-01').copy(deep = deep)
+        assert type(copied_legislation) is legislations.CompactNode
+        assert_equal(compact_node_to_json(copied_legislation), compact_node_to_json(compact_legislation))
+
+    updated_node = legislations.CompactNode(instant = compact_legislation.instant)
+    updated_node.update(legislations.lazy_compact_node_json(legislation_json, '2012-01-01'))
+    assert_equal(updated_node.csg.activite.deductible.taux, 0.051)
+
+    lazy_compact_legislation = legislations.lazy_compact_node_json(legislation_json, '2012-01-01')
+    csg = legislations.CompactNode(instant = compact_legislation.instant, name = u'csg')
+    lazy_compact_legislation['csg'] = csg
+    assert lazy_compact_legislation['csg'] is csg
+    assert lazy_compact_legislation.get('csg') is csg
+    lazy_compact_legislation.csg = csg = legislations.CompactNode(instant = compact_legislation.instant)
+    assert lazy_compact_legislation['csg'] is csg
+
+
+def test_lazy_compact_legislation_without_compact_node_cache():
+    tax_benefit_system = DummyTaxBenefitSystem()
+    tax_benefit_system.lazy_compact_legislation = True
+    tax_benefit_system.compact_node_cache = legislations.CompactNodeCache()
+    assert_raises(AssertionError, tax_benefit_system.get_compact_legislation, periods.instant('2012-01-01'))
+
+
+def test_lazy_compact_legislation_in_simulation():
+    tax_benefit_system = DummyTaxBenefitSystem()
+    tax_benefit_system.lazy_compact_legislation = True
+    simulation = tax_benefit_system.new_scenario().init_single_entity(
+        period = 2012,
+        parent1 = {},
+        ).new_simulation(trace = True)
+    compact_legislation = simulation.legislation_at(simulation.period.start)
+    assert isinstance(compact_legislation, legislations.LazyCompactNode)
+    simulation.stack_trace.append(dict(parameters_infos = []))
+    assert_equal(compact_legislation.csg.activite.deductible.taux, 0.051)
+    assert_equal(simulation.stack_trace[-1]['parameters_infos'][0]['name'], u'csg.activite.deductible.taux')
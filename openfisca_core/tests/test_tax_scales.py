@@ -3,7 +3,7 @@
 
 import numpy as np
 
-from openfisca_core.taxscales import MarginalRateTaxScale
+from openfisca_core.taxscales import AmountTaxScale, MarginalRateTaxScale, calc_marginal_rate_tax_scales
 from openfisca_core.tools import assert_near
 
 
@@ -70,6 +70,90 @@ def test_round_marginal_tax_scale():
         )
 
 
+def test_marginal_tax_scale_with_factor():
+    base = np.array([-10, 0, 50, 150, 250, 350, 1000.])
+
+    marginal_tax_scale = MarginalRateTaxScale()
+    marginal_tax_scale.add_bracket(100, 0.1)
+    marginal_tax_scale.add_bracket(200, 0.2)
+    marginal_tax_scale.add_bracket(300, 0.5)
+
+    assert_near(marginal_tax_scale.calc(base), [0, 0, 0, 5, 20, 55, 380], absolute_error_margin = 1e-10)
+    assert_near(marginal_tax_scale.calc(base, factor = 0.5), [0, 0, 0, 15, 65, 115, 440],
+        absolute_error_margin = 1e-10)
+    factor = np.array([1, 1, 1, 0.5, 0.5, 1, 0.5])
+    assert_near(marginal_tax_scale.calc(base, factor = factor), [0, 0, 0, 15, 65, 55, 440],
+        absolute_error_margin = 1e-10)
+    assert_near(marginal_tax_scale.calc(base, factor = 1 / 3., round_base_decimals = 0),
+        [0, 0, 2, 35, 85, 135, 460], absolute_error_margin = 1e-10)
+    assert_near(marginal_tax_scale.calc(base, factor = np.ones(7) / 3., round_base_decimals = 0),
+        [0, 0, 2, 35, 85, 135, 460], absolute_error_margin = 1e-10)
+    assert_near(MarginalRateTaxScale().calc(base), np.zeros(7), absolute_error_margin = 0)
+
+
+def test_compiled_tax_scale():
+    base = np.array([50, 150, 250.])
+
+    marginal_tax_scale = MarginalRateTaxScale()
+    marginal_tax_scale.add_bracket(100, 0.1)
+    marginal_tax_scale.add_bracket(200, 0.2)
+    assert_near(marginal_tax_scale.calc(base), [0, 5, 20], absolute_error_margin = 1e-10)
+    arrays = marginal_tax_scale.arrays
+    assert_near(arrays['cumulated_brackets_tax'], [0, 10], absolute_error_margin = 1e-10)
+    assert marginal_tax_scale.get_arrays() is arrays
+    assert marginal_tax_scale.thresholds == [100, 200]
+
+    copied_tax_scale = marginal_tax_scale.copy()
+    # Modifying a tax scale compiles its arrays again.
+    copied_tax_scale.multiply_thresholds(2)
+    assert copied_tax_scale.thresholds == [200, 400]
+    assert_near(copied_tax_scale.calc(base), [0, 0, 5], absolute_error_margin = 1e-10)
+    # Its lists can be modified in place after before_brackets_change().
+    copied_tax_scale.before_brackets_change()
+    copied_tax_scale.rates[0] = 0.3
+    assert_near(copied_tax_scale.calc(base), [0, 0, 15], absolute_error_margin = 1e-10)
+    assert marginal_tax_scale.get_arrays() is arrays
+    assert_near(marginal_tax_scale.calc(base), [0, 5, 20], absolute_error_margin = 1e-10)
+    marginal_tax_scale.add_bracket(200, 0.1)
+    assert_near(marginal_tax_scale.calc(base), [0, 5, 25], absolute_error_margin = 1e-10)
+    marginal_tax_scale.multiply_rates(2)
+    assert_near(marginal_tax_scale.calc(base), [0, 10, 50], absolute_error_margin = 1e-10)
+
+
+def test_amount_tax_scale():
+    base = np.array([-1, 0, 50, 100, 150, 1000.])
+
+    amount_tax_scale = AmountTaxScale()
+    amount_tax_scale.add_bracket(0, 10)
+    amount_tax_scale.add_bracket(100, 5)
+    assert_near(amount_tax_scale.calc(base), [0, 0, 10, 10, 15, 15], absolute_error_margin = 0)
+    amount_tax_scale.before_brackets_change()
+    amount_tax_scale.amounts[1] = 20
+    assert_near(amount_tax_scale.calc(base), [0, 0, 10, 10, 30, 30], absolute_error_margin = 0)
+
+
+def test_calc_marginal_rate_tax_scales():
+    base = np.array([-10, 0, 50, 150, 250, 350, 1000.])
+
+    marginal_tax_scale = MarginalRateTaxScale()
+    marginal_tax_scale.add_bracket(100, 0.1)
+    marginal_tax_scale.add_bracket(200, 0.2)
+    marginal_tax_scale.add_bracket(300, 0.5)
+    tax_scales = [
+        marginal_tax_scale,
+        marginal_tax_scale.multiply_rates(2, inplace = False),
+        marginal_tax_scale.multiply_thresholds(0.75, inplace = False),
+        MarginalRateTaxScale(),
+        ]
+    for factor, round_base_decimals in ((1, None), (0.5, None), (1, 0), (np.linspace(0.5, 1.5, len(base)), None)):
+        taxes = calc_marginal_rate_tax_scales(tax_scales, base, factor = factor,
+            round_base_decimals = round_base_decimals, max_chunk_size = 3 * len(tax_scales))
+        assert taxes.shape == (len(tax_scales), len(base))
+        for tax_scale, tax in zip(tax_scales, taxes):
+            assert_near(tax, tax_scale.calc(base, factor = factor, round_base_decimals = round_base_decimals),
+                absolute_error_margin = 1e-10)
+
+
 if __name__ == '__main__':
     import logging
     import sys
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+
+"""Trace the formula calls of a simulation with a low overhead, in a buffer of fixed-size records.
+
+The trace mode of simulations (Simulation(trace = True)) builds a dict for each formula call, searches lists of
+input variables and compares every input array to its default value. A TraceRecorder only writes a few numbers by
+formula call. The statistics of the arrays are computed from the holders, only when the trace is exported.
+"""
+
+
+import collections
+import time
+
+import numpy as np
+
+
+# A record by formula call. The ids of the variables and of the periods are indexes in the lists of the recorder.
+record_dtype = np.dtype([
+    ('variable_id', np.int32),
+    ('period_id', np.int32),
+    ('parent', np.int32),  # Index of the record of the calling formula call, -1 for a requested variable
+    ('start', np.float64),  # Time (in seconds since the epoch) of the start of the formula call
+    ('duration', np.float64),  # Inclusive duration (in seconds) of the formula call, -1 when it didn't end
+    ])
+
+
+class TraceRecorder(object):
+    """A dependencies tracker (like caches.DependenciesRecorder) writing a record for each formula call.
+
+    The buffer of records is preallocated, and doubled when it is full.
+    """
+    count = 0  # Number of records written in the buffer
+    simulation = None
+
+    def __init__(self, simulation, capacity = 4096):
+        assert capacity >= 1, capacity
+        self.simulation = simulation
+        self.period_id_by_period = {}
+        self.periods = []
+        self.records = np.empty(capacity, dtype = record_dtype)
+        self.durations = self.records['duration']
+        self.records_index_stack = []
+        self.variable_id_by_name = {}
+        self.variables_name = []
+
+    def clone(self, simulation):
+        return self.__class__(simulation, capacity = len(self.records))
+
+    def enter(self, variable_name, period):
+        index = self.count
+        records = self.records
+        if index == len(records):
+            self.records = records = np.concatenate((records, np.empty(len(records), dtype = record_dtype)))
+            self.durations = records['duration']
+        variable_id = self.variable_id_by_name.get(variable_name)
+        if variable_id is None:
+            self.variable_id_by_name[variable_name] = variable_id = len(self.variables_name)
+            self.variables_name.append(variable_name)
+        period_id = self.period_id_by_period.get(period)
+        if period_id is None:
+            self.period_id_by_period[period] = period_id = len(self.periods)
+            self.periods.append(period)
+        records_index_stack = self.records_index_stack
+        records[index] = (
+            variable_id,
+            period_id,
+            records_index_stack[-1] if records_index_stack else -1,
+            time.time(),
+            -1,
+            )
+        records_index_stack.append(index)
+        self.count = index + 1
+
+    def exit(self, variable_name, period, computed = True):
+        index = self.records_index_stack.pop()
+        self.durations[index] = time.time() - self.records[index]['start']
+
+    def get_array_stats(self, index):
+        """Return the statistics of the array calculated by a formula call, or None when it is no longer in cache.
+
+        The array is read from the holder, at the requested period of the formula call.
+        """
+        record = self.records[index]
+        holder = self.simulation.holder_by_name.get(self.variables_name[record['variable_id']])
+        if holder is None:
+            return None
+        array = holder.get_array(self.periods[record['period_id']])
+        if array is None:
+            return None
+        stats = collections.OrderedDict([
+            ('count', int(array.size)),
+            ('default_count', int(np.count_nonzero(array == holder.column.default))),
+            ])
+        if array.size and array.dtype.kind in 'biuf':
+            stats['min'] = array.min().item()
+            stats['max'] = array.max().item()
+            stats['mean'] = float(array.mean())
+        return stats
+
+    def get_records(self):
+        """Return the records written, as a structured array of record_dtype."""
+        return self.records[:self.count]
+
+    def get_self_durations(self):
+        """Return the duration of each formula call, minus the durations of the formula calls it made."""
+        records = self.get_records()
+        self_durations = records['duration'].copy()
+        called = (records['parent'] >= 0) & (records['duration'] >= 0)
+        np.subtract.at(self_durations, records['parent'][called], records['duration'][called])
+        return self_durations
+
+    def to_json(self, with_stats = True):
+        records_json = []
+        for index, record in enumerate(self.get_records()):
+            record_json = collections.OrderedDict([
+                ('variable_name', self.variables_name[record['variable_id']]),
+                ('period', unicode(self.periods[record['period_id']])),
+                ('parent', int(record['parent'])),
+                ('duration', float(record['duration'])),
+                ])
+            if with_stats:
+                record_json['stats'] = self.get_array_stats(index)
+            records_json.append(record_json)
+        return records_json
+
+    def use(self, variable_name):
+        pass
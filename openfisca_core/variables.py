@@ -162,7 +162,7 @@ class AbstractConversionVariable(AbstractVariable):
 
             if roles is None or len(roles) > 1:
                 operation = self.attributes.pop('operation')
-                assert operation in ('add', 'or'), 'Invalid operation: {}'.format(operation)
+                assert operation in ('add', 'count', 'max', 'min', 'or'), 'Invalid operation: {}'.format(operation)
                 formula_class_attributes['operation'] = operation
 
                 if operation == 'add':
@@ -170,8 +170,10 @@ class AbstractConversionVariable(AbstractVariable):
                         column = columns.IntCol()
                     else:
                         column = reference_column.empty_clone()
+                elif operation == 'count':
+                    column = columns.IntCol()
                 else:
-                    assert operation == 'or'
+                    assert operation in ('max', 'min', 'or')
                     column = reference_column.empty_clone()
             else:
                 column = reference_column.empty_clone()
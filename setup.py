@@ -7,7 +7,7 @@ from setuptools import setup, find_packages
 
 setup(
     name = 'OpenFisca-Core',
-    version = '2.0.2',
+    version = '2.22.31',
     author = 'OpenFisca Team',
     author_email = 'contact@openfisca.fr',
     classifiers = [